@@ -8,4 +8,13 @@ from simwraplib.minimalrun import MinimalRun
 from simwraplib.scriptrun import ScriptRun
 from simwraplib.thread import Thread
 from simwraplib.study import Study
-from simwraplib.inpututils import InputMod, InputDict, InputList, KeywordInputMod
+from simwraplib.history import RuntimeHistory
+from simwraplib.retry import RetryPolicy
+from simwraplib.journal import StudyJournal
+from simwraplib.cache import ResultCache
+from simwraplib.meshcache import MeshCache
+from simwraplib.population import Population
+from simwraplib.source import SourceSnapshot
+from simwraplib.environment import Environment
+from simwraplib.inpututils import InputMod, InputDict, InputList, Sweep, KeywordInputMod
+from simwraplib.sampling import Parameter, latin_hypercube, sobol, halton
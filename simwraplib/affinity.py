@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+import os
+import re
+import glob
+import subprocess as sp
+
+def parse_cpulist(cpulist):
+
+    """
+        Convert a Linux cpu list string such as "0-3,8,10-11"
+        to a list of integer cpu ids
+    """
+
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += list(range(int(first), int(last)+1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def format_cpulist(cpus):
+
+    return ",".join(str(c) for c in cpus)
+
+def get_core_layout():
+
+    """
+        Physical cores this process may use, grouped by NUMA node as
+        a list of lists of cpu ids. Only the first logical cpu of
+        each physical core is kept so hyperthread siblings are never
+        handed to different runs. Falls back to a single node of every
+        cpu if the topology cannot be read from /sys.
+    """
+
+    try:
+        allowed = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        allowed = list(range(os.cpu_count()))
+
+    # One logical cpu per physical core
+    physical = []
+    seen = set()
+    for cpu in allowed:
+        try:
+            with open("/sys/devices/system/cpu/cpu" + str(cpu)
+                      + "/topology/thread_siblings_list") as f:
+                siblings = tuple(parse_cpulist(f.read()))
+        except IOError:
+            siblings = (cpu,)
+        if siblings in seen:
+            continue
+        seen.add(siblings)
+        physical.append(cpu)
+
+    # Group by NUMA node
+    layout = []
+    nodefiles = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    nodefiles.sort(key=lambda f: int(re.findall(r"node(\d+)", f)[-1]))
+    for nodefile in nodefiles:
+        with open(nodefile) as f:
+            nodecpus = set(parse_cpulist(f.read()))
+        node = [cpu for cpu in physical if cpu in nodecpus]
+        if node:
+            layout.append(node)
+
+    grouped = set(cpu for node in layout for cpu in node)
+    rest = [cpu for cpu in physical if cpu not in grouped]
+    if rest:
+        layout.append(rest)
+
+    return layout
+
+_mpi_flavours = {}
+
+def mpi_flavour(mpiexec="mpiexec"):
+
+    """
+        Which MPI launcher mpiexec is: "openmpi", "mpich" (hydra,
+        including Intel MPI) or None if unknown
+    """
+
+    if mpiexec not in _mpi_flavours:
+        try:
+            proc = sp.run([mpiexec, "--version"], stdout=sp.PIPE,
+                          stderr=sp.STDOUT, universal_newlines=True, timeout=30)
+            out = proc.stdout
+        except (OSError, sp.SubprocessError):
+            out = ""
+        if ("Open MPI" in out or "OpenRTE" in out):
+            _mpi_flavours[mpiexec] = "openmpi"
+        elif ("HYDRA" in out or "MPICH" in out or "Intel(R) MPI" in out):
+            _mpi_flavours[mpiexec] = "mpich"
+        else:
+            _mpi_flavours[mpiexec] = None
+
+    return _mpi_flavours[mpiexec]
+
+def binding(cores, nprocs, mpiexec="mpiexec"):
+
+    """
+        Options which bind a run to its cores, returned as a prefix for
+        the whole command and options for mpiexec. MPI runs use the
+        launcher's own binding (--cpu-set with --bind-to core for Open
+        MPI, -bind-to user: for MPICH/hydra), anything else including
+        serial runs is confined by running the command under taskset.
+    """
+
+    if not cores:
+        return "", ""
+
+    cpulist = format_cpulist(cores)
+    flavour = mpi_flavour(mpiexec)
+    if nprocs > 1 and flavour == "openmpi":
+        return "", " --cpu-set " + cpulist + " --bind-to core"
+    elif nprocs > 1 and flavour == "mpich":
+        return "", " -bind-to user:" + cpulist
+    elif flavour == "openmpi":
+        # Stop mpiexec rebinding a serial run inside the taskset mask
+        return "taskset -c " + cpulist + " ", " --bind-to none"
+    else:
+        return "taskset -c " + cpulist + " ", ""
+
+class CorePool:
+
+    """
+        Free physical cores, handed out so concurrent runs never share
+        a core. A run is placed on a single NUMA node when one has
+        enough free cores (the fullest such node, keeping emptier nodes
+        free for larger runs), otherwise it is spread over the nodes
+        with the most free cores.
+    """
+
+    def __init__(self, layout=None):
+
+        if layout is None:
+            layout = get_core_layout()
+        self.layout = layout
+        self.node = dict((cpu, n) for n, node in enumerate(layout)
+                         for cpu in node)
+        self.free = [list(node) for node in layout]
+
+    def __len__(self):
+
+        return len(self.node)
+
+    def nfree(self):
+
+        return sum(len(node) for node in self.free)
+
+    def take(self, n):
+
+        """
+            Remove n free cores from the pool and return them,
+            or None if there are not enough
+        """
+
+        if n > self.nfree():
+            return None
+
+        fits = [node for node in self.free if len(node) >= n]
+        if fits:
+            node = min(fits, key=len)
+            cores = node[:n]
+            del node[:n]
+            return cores
+
+        cores = []
+        for node in sorted(self.free, key=len, reverse=True):
+            k = min(n - len(cores), len(node))
+            cores += node[:k]
+            del node[:k]
+            if len(cores) == n:
+                break
+
+        return sorted(cores)
+
+    def give(self, cores):
+
+        # Return cores to the node they belong to
+        for cpu in cores:
+            node = self.free[self.node[cpu]]
+            node.append(cpu)
+            node.sort()
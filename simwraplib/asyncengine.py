@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+import asyncio
+import threading
+import time
+
+from .scheduler import (BackfillPolicy, Request, estimate_runtime, setup_needs,
+                        get_corepool, as_needs, infer_needs, check_needs,
+                        take, give)
+from .graph import RunGraph, as_runlists
+from .history import record_runtime
+from .retry import retry_delay
+from .journal import journal_state, journal_done
+from .cache import reuse_result, save_result
+
+class SkippedError(Exception):
+
+    """
+        Run was not performed because a run it depends on failed
+    """
+
+    pass
+
+class AsyncScheduler:
+
+    """
+        asyncio counterpart of Scheduler, handing out licenses for up
+        to maxproc processors to coroutines in a single event loop.
+        Waiting requests are started by the same policy (largest first
+        with backfilling) as soon as licenses are released. Other 
+        resources and per processor defaults are limited as for 
+        Scheduler. With affinity, each grant also carries the cores
+        to bind to.
+
+        Example usage from a coroutine:
+
+            grant = await scheduler.acquire(nprocs, runtime)
+            try:
+                await run.execute_async(nprocs)
+            finally:
+                scheduler.release(grant)
+
+    """
+
+    def __init__(self, maxproc, policy=None, affinity=False,
+                 resources=None, perproc=None):
+
+        self.maxproc = maxproc
+        self.capacity = as_needs(maxproc, resources)
+        self.free = dict(self.capacity)
+        self.perproc = dict(perproc or {})
+        if policy is None:
+            self.policy = BackfillPolicy()
+        else:
+            self.policy = policy
+        self.corepool = get_corepool(maxproc, affinity)
+
+        self.waiting = []
+        self.running = {}
+        self.arrivals = 0
+
+    async def acquire(self, nproc=1, runtime=None, resources=None):
+
+        """
+            Wait until nproc licenses and any other resources are 
+            granted, returns the grant which must be passed to release
+        """
+
+        req = Request(None, nproc, runtime, self.arrivals)
+        req.needs = infer_needs(nproc, resources, self.perproc)
+        check_needs(req.needs, self.capacity)
+        req.cores = None
+        self.arrivals += 1
+        req.future = asyncio.get_running_loop().create_future()
+        self.waiting.append(req)
+        self.dispatch()
+
+        try:
+            await req.future
+        except asyncio.CancelledError:
+            if req in self.waiting:
+                self.waiting.remove(req)
+            elif req in self.running:
+                self.release(req)
+            raise
+
+        return req
+
+    def release(self, grant):
+
+        give(self.free, grant.needs)
+        del self.running[grant]
+        if grant.cores is not None:
+            self.corepool.give(grant.cores)
+        self.dispatch()
+
+    def dispatch(self):
+
+        now = time.time()
+        selected = self.policy.select(self.waiting, list(self.running.values()),
+                                      self.free, now)
+        for req in selected:
+            self.waiting.remove(req)
+            take(self.free, req.needs)
+            self.running[req] = (req.needs, self.policy.endtime(req, now))
+            if self.corepool is not None:
+                req.cores = self.corepool.take(req.nproc)
+            req.future.set_result(True)
+
+async def perform_run_async(scheduler, run):
+
+    """
+        Setup, execute and finish a single run, trying again after
+        transient failures according to the run's retry policy.
+        Licenses are released while waiting to retry.
+    """
+
+    # Skip runs finished before the study was restarted
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, journal_done, run):
+        return run
+
+    while True:
+        try:
+            return await attempt_run_async(scheduler, run)
+        except Exception as e:
+            delay = retry_delay(run, e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+
+async def attempt_run_async(scheduler, run):
+
+    """
+        Single attempt at a run. Setup and finish are ordinary
+        (blocking) methods so they run in the default thread pool
+        executor, the executable itself is an asyncio subprocess.
+    """
+
+    #Setup run, unless it is being retried after it was set up
+    loop = asyncio.get_running_loop()
+    if not getattr(run, "setup_done", False):
+        setupprocs, resources = setup_needs(run)
+        grant = None
+        if setupprocs > 0 or resources:
+            grant = await scheduler.acquire(setupprocs, resources=resources)
+        try:
+            await loop.run_in_executor(None, journal_state, run, "setup")
+            await loop.run_in_executor(None, run.setup)
+            run.setup_done = True
+        except Exception as e:
+            await loop.run_in_executor(None, journal_state, run, "failed",
+                                       getattr(e, "returncode", None))
+            raise
+        finally:
+            if grant is not None:
+                scheduler.release(grant)
+
+        # Reuse the results of an identical run which finished before
+        if await loop.run_in_executor(None, reuse_result, run):
+            await loop.run_in_executor(None, journal_state, run, "done", 0)
+            return run
+
+    # Wait until all processors required are available
+    runprocs = await loop.run_in_executor(None, run.get_nprocs)
+    runtime = await loop.run_in_executor(None, estimate_runtime, run, runprocs)
+    grant = await scheduler.acquire(runprocs, runtime=runtime,
+                                    resources=run.get_resources())
+    run.cores = grant.cores
+
+    try:
+        await loop.run_in_executor(None, journal_state, run, "running")
+        start = time.time()
+        await run.execute_async(nprocs=runprocs)
+        await loop.run_in_executor(None, record_runtime, run,
+                                   time.time() - start, runprocs)
+        await loop.run_in_executor(None, run.finish)
+        await loop.run_in_executor(None, save_result, run)
+        await loop.run_in_executor(None, journal_state, run, "done", 0)
+    except Exception as e:
+        await loop.run_in_executor(None, journal_state, run, "failed",
+                                   getattr(e, "returncode", None))
+        raise
+    finally:
+        scheduler.release(grant)
+
+    return run
+
+async def perform_runlist_async(scheduler, runlist):
+
+    # Perform runs sequentially
+    for run in runlist:
+        await perform_run_async(scheduler, run)
+
+    return runlist
+
+async def perform_node_async(scheduler, run, parents):
+
+    # Wait for everything this run depends on, futures may belong
+    # to this loop or be concurrent futures from another thread
+    results = await asyncio.gather(*[asyncio.wrap_future(p) for p in parents],
+                                   return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise SkippedError("Run in " + run.rundir + " skipped as a run"
+                               + " it depends on did not finish")
+
+    return await perform_run_async(scheduler, run)
+
+class AsyncEngine:
+
+    """
+        Perform all runs of a study from one asyncio event loop,
+        without an operating system process per runlist. Each runlist
+        (or each run when dag is True, see RunGraph) becomes a future
+        which completes when it has finished, or raises if it failed.
+
+        Constructor arguments:
+
+            threadlist - list of runlists as for Study
+
+            maxproc - maximum number of licenses handed out at once
+
+            dag - if True, every distinct run is its own future and
+                  starts when the runs it depends on have finished
+
+            affinity - if True, bind each run to its own set of cores
+
+            resources, perproc - capacities of other resources and
+                                 per processor defaults, see Scheduler
+
+    """
+
+    def __init__(self, threadlist, maxproc, dag=False, affinity=False,
+                 resources=None, perproc=None):
+
+        self.threadlist = threadlist
+        self.scheduler = AsyncScheduler(maxproc, affinity=affinity,
+                                        resources=resources, perproc=perproc)
+        self.dag = dag
+        if dag:
+            self.graph = RunGraph(threadlist)
+
+    def launch(self, submit):
+
+        """
+            Create a future for every task using submit, which takes a
+            coroutine and returns a future for it
+        """
+
+        if not self.dag:
+            return [submit(perform_runlist_async(self.scheduler, runlist))
+                    for runlist in as_runlists(self.threadlist)]
+
+        futures = {}
+        for key in self.graph.topological_order():
+            parents = [futures[p] for p in sorted(self.graph.parents[key])]
+            futures[key] = submit(perform_node_async(self.scheduler,
+                                            self.graph.runs[key], parents))
+
+        return [futures[key] for key in sorted(futures)]
+
+    def start(self):
+
+        """
+            Start every task without blocking and return their futures.
+            From inside a running event loop (e.g. a notebook or an
+            asyncio service) these are asyncio tasks in that loop,
+            otherwise a background thread is started to run the loop
+            and concurrent.futures.Future objects are returned.
+        """
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is not None:
+            return self.launch(loop.create_task)
+
+        self.loop = asyncio.new_event_loop()
+        self.loopthread = threading.Thread(target=self.loop.run_forever,
+                                           daemon=True)
+        self.loopthread.start()
+        return self.launch(lambda coro:
+                   asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def run(self):
+
+        """
+            Perform every task and return once all have finished,
+            returning the result or exception of each future
+        """
+
+        futures = self.launch(asyncio.ensure_future)
+        return await asyncio.gather(*futures, return_exceptions=True)
@@ -0,0 +1,323 @@
+#! /usr/bin/env python
+import os
+import json
+import stat
+import time
+import errno
+import shutil as sh
+import hashlib
+import tempfile
+
+# Hashes of unchanged files are kept for the life of the process,
+# keyed by path, size and modification time
+_hashes = {}
+
+def hash_file(path, indexdir=None):
+
+    """
+        sha256 of the contents of path. Hashes are kept for the life
+        of the process and, if indexdir is given, in a file there per
+        path, size and modification time, so other processes (e.g. the
+        workers of a study) only read the file again if it changes.
+    """
+
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo in _hashes:
+        return _hashes[memo]
+
+    index = None
+    if indexdir is not None:
+        name = hashlib.sha256(repr(memo).encode()).hexdigest()
+        index = os.path.join(indexdir, name)
+        try:
+            with open(index) as f:
+                _hashes[memo] = f.read().strip()
+            return _hashes[memo]
+        except IOError:
+            pass
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    _hashes[memo] = h.hexdigest()
+
+    if index is not None:
+        try:
+            if not os.path.isdir(indexdir):
+                os.makedirs(indexdir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=indexdir, prefix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(_hashes[memo])
+            os.replace(tmp, index)
+        except (IOError, OSError) as e:
+            print("Could not index hash of " + path + ": " + str(e))
+    return _hashes[memo]
+
+def hash_path(h, path):
+
+    """
+        Add the contents of the file or directory at path to hash h,
+        directories by the name and contents of every file below them
+    """
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                f = os.path.join(root, name)
+                h.update(os.path.relpath(f, path).encode())
+                h.update(hash_file(f).encode())
+    elif os.path.isfile(path):
+        h.update(hash_file(path).encode())
+    else:
+        h.update(b"missing")
+
+def snapshot(folder):
+
+    # Size and modification time of every file below folder
+    state = {}
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            f = os.path.join(root, name)
+            if os.path.islink(f):
+                continue
+            stat = os.stat(f)
+            state[os.path.relpath(f, folder)] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+def link_or_copy(src, dst):
+
+    # Hard link where possible (same filesystem), otherwise copy
+    try:
+        os.link(src, dst)
+    except OSError:
+        sh.copy2(src, dst)
+
+def freeze_copy(src, dst):
+
+    # Copy of src at dst which cannot be written to in place
+    sh.copy2(src, dst)
+    mode = os.stat(dst).st_mode
+    os.chmod(dst, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def link_frozen(src, dst):
+
+    """
+        Hard link (or copy) src at dst if it is read only, so writing
+        to one cannot change the other, otherwise a writable copy
+    """
+
+    if os.stat(src).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        sh.copy2(src, dst)
+    else:
+        link_or_copy(src, dst)
+
+def folder_size(folder):
+
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(folder) for name in files)
+
+def evict_lru(cachedir, maxsize=None, maxentries=None, keep=()):
+
+    """
+        Remove the least recently used entries (subfolders with an
+        entry.json holding their size and last use) of cachedir until
+        they total no more than maxsize bytes and maxentries entries.
+        Entries named in keep are never removed.
+    """
+
+    entries = []
+    for name in os.listdir(cachedir):
+        meta = os.path.join(cachedir, name, "entry.json")
+        try:
+            with open(meta) as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            continue
+        entries.append((info.get("used", 0), name, info.get("size", 0)))
+
+    entries.sort()
+    total = sum(size for used, name, size in entries)
+    count = len(entries)
+    for used, name, size in entries:
+        if ((maxsize is None or total <= maxsize) and
+            (maxentries is None or count <= maxentries)):
+            break
+        if name in keep:
+            continue
+        sh.rmtree(os.path.join(cachedir, name), ignore_errors=True)
+        total -= size
+        count -= 1
+
+class ResultCache:
+
+    """
+        Cache of the results of finished runs, keyed on a hash of the
+        type of run, its executable, every file copied from the base
+        directory and the input once modified by prepare_inputs (see
+        Run.cache_files). If a run with the same key has finished
+        before, the files it produced are linked into the new run
+        directory instead of running it again.
+
+        Each entry is a folder in cachedir holding read only copies of
+        the files created or changed by execute and finish. Restored
+        files are hard linked to them where possible, so a run which
+        tries to write to a reused result fails rather than changing
+        the cached copy for every other run. Entries beyond maxsize
+        bytes or maxentries in total are evicted, least recently used
+        first.
+
+        Example usage from a higher level:
+
+            cache = ResultCache("/scratch/me/simcache", maxsize=500e9)
+            study = Study(threadlist, maxproc, cache=cache)
+
+    """
+
+    def __init__(self, cachedir, maxsize=None, maxentries=None):
+
+        self.cachedir = os.path.abspath(cachedir)
+        self.maxsize = maxsize
+        self.maxentries = maxentries
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def key(self, run):
+
+        h = hashlib.sha256()
+        h.update(type(run).__name__.encode())
+        h.update(str(run.get_nprocs()).encode())
+        for path in run.cache_files():
+            hash_path(h, path)
+        return h.hexdigest()
+
+    def entry(self, key):
+
+        return os.path.join(self.cachedir, key)
+
+    def restore(self, run, key):
+
+        """
+            Link the results cached under key into the run directory,
+            returns False if there are none
+        """
+
+        meta = os.path.join(self.entry(key), "entry.json")
+        try:
+            with open(meta) as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        for relpath in info["files"]:
+            dst = os.path.join(run.rundir, relpath)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if os.path.lexists(dst):
+                os.remove(dst)
+            link_frozen(os.path.join(self.entry(key), "files", relpath), dst)
+
+        self.mark_used(key, info)
+        return True
+
+    def store(self, run, key, before):
+
+        """
+            Add the files in the run directory which are new or
+            changed since the snapshot before to the cache under key
+        """
+
+        after = snapshot(run.rundir)
+        files = [f for f in sorted(after) if after[f] != before.get(f)
+                 and os.path.basename(f) != "src.snapshot"]
+
+        self.add_entry(key, run.rundir, files, {"rundir": run.rundir})
+
+    def add_entry(self, key, root, files, info):
+
+        """
+            Add read only copies of files (paths relative to folder
+            root) to the cache under key, with info and the list of
+            files saved in its entry.json, then evict old entries
+        """
+
+        # Build in a temporary folder and move into place in one step
+        # so concurrent runs never see a half written entry
+        tmp = tempfile.mkdtemp(dir=self.cachedir, prefix=".tmp")
+        os.chmod(tmp, 0o755)
+        for relpath in files:
+            dst = os.path.join(tmp, "files", relpath)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            freeze_copy(os.path.join(root, relpath), dst)
+        info.update({"files": files, "created": time.time(),
+                     "used": time.time(), "size": folder_size(tmp)})
+        self.write_meta(tmp, info)
+
+        try:
+            os.rename(tmp, self.entry(key))
+        except OSError as e:
+            # Another run with the same key got there first
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            sh.rmtree(tmp, ignore_errors=True)
+
+        evict_lru(self.cachedir, self.maxsize, self.maxentries, keep=[key])
+
+    def write_meta(self, folder, info):
+
+        # Under a unique temporary name, as runs reusing the same
+        # entry may update it at the same time
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(info, f)
+            os.replace(tmp, os.path.join(folder, "entry.json"))
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def mark_used(self, key, info):
+
+        # Record the last use of an entry for eviction, which only
+        # affects the order entries are evicted in if it fails
+        info["used"] = time.time()
+        try:
+            self.write_meta(self.entry(key), info)
+        except (IOError, OSError) as e:
+            print("Could not mark cache entry " + key + " as used: " + str(e))
+
+def reuse_result(run):
+
+    """
+        Called once a run is set up. Links in the results of an
+        identical run from the cache the run was given by Study, if
+        any, and returns True so it need not be performed. Otherwise
+        remembers what to store once the run has finished.
+    """
+
+    cache = getattr(run, "cache", None)
+    if cache is None or getattr(run, "dryrun", False):
+        return False
+
+    run.cachekey = cache.key(run)
+    if cache.restore(run, run.cachekey):
+        print("Results of " + run.rundir + " reused from identical run in cache")
+        return True
+    run.cachebefore = snapshot(run.rundir)
+    return False
+
+def save_result(run):
+
+    # Add a finished run to its cache
+    cache = getattr(run, "cache", None)
+    if (cache is None or getattr(run, "dryrun", False)
+        or getattr(run, "cachekey", None) is None):
+        return
+    try:
+        cache.store(run, run.cachekey, run.cachebefore)
+    except (IOError, OSError) as e:
+        print("Could not cache results of " + run.rundir + ": " + str(e))
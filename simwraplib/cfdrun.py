@@ -39,6 +39,17 @@ class CFDRun(Run):
         self.inputchanges = inputchanges
         self.outputfile = outputfile
         self.dryrun = dryrun
+        self.dependencies = []
+        self.cores = None
+        self.resources = {}
+        self.setupprocs = 1
+        self.setupresources = {}
+        self.retry = None
+        self.attempts = 0
+        self.setup_done = False
+        self.population = None
+        self.environment = None
+        self.sources = None
 
         if (self.basedir == None):
             quit('You must specify a base directory which contains'+
@@ -74,8 +85,7 @@ class CFDRun(Run):
         self.create_rundir(existscheck=existscheck)       
 
         # Snapshot of the source directory
-        cmd = 'tar -cPf ' + self.rundir + 'src.tar ' + self.srcdir
-        sp.Popen(cmd,shell=True)
+        self.snapshot_source()
 
         # Store useful directory paths
         griddir = self.rundir + 'grid_generation/'
@@ -102,16 +112,18 @@ class CFDRun(Run):
         for cmd in [
             'ifort -r8 -o Gen_grid.data.exe main.f90 mesh_tanh_stretch.f90',
             './Gen_grid.data.exe']:
-            comp = sp.Popen(cmd, shell=True, cwd=griddir)
+            comp = sp.Popen(cmd, shell=True, cwd=griddir,
+                            env=self.get_environment())
             comp.wait() 
 
-        # cp setup and lib folders from source
+        # cp setup and lib folders from source, setup is built in place
+        # so is always copied
         try:
             sh.copytree(self.srcdir+'setup/',setupdir)
         except OSError as e:
             pass
         try:
-            sh.copytree(self.srcdir+'lib/',libdir)
+            self.place_tree(self.srcdir+'lib/',libdir)
         except OSError as e:
             pass
         # copy grid.data and setup input file to setup folder
@@ -119,13 +131,15 @@ class CFDRun(Run):
         sh.copy(self.basedir+self.setupinputfile,setupdir+self.setupinputfile)
         # compile and run setup
         for cmd in ['make simple', './a.out']:
-            comp = sp.Popen(cmd, shell=True, cwd=setupdir)
+            comp = sp.Popen(cmd, shell=True, cwd=setupdir,
+                            env=self.get_environment())
             comp.wait()
 
         # Copy required run files into it from base
         basefiles = [ self.inputfile, self.executable ]
         for f in basefiles:
-            sh.copy(self.basedir+f, self.rundir+f)
+            self.place(self.basedir+f, self.rundir+f,
+                       private=(f == self.inputfile))
         setupfiles = [ 
                       'ucvcwc.dble.000000',
                       'uuvvww.dble.000000',
@@ -197,7 +211,9 @@ class CFDRun(Run):
         nprocs = self.get_nprocs()
 
         #Build runstring
-        cmdstg = 'mpiexec -n ' + str(nprocs) + ' ' + self.executable 
+        prefix, bind_opts = self.prepare_binding(nprocs)
+        cmdstg = (prefix + 'mpiexec -n ' + str(nprocs) + bind_opts 
+                  + ' ' + self.executable)
         print((self.rundir + ':\t' + cmdstg))
 
         #Setup standard out and standard error files
@@ -209,7 +225,8 @@ class CFDRun(Run):
 
         #Execute subprocess and create subprocess object
         self.proc = sp.Popen(split_cmdstg, cwd=self.rundir, stdin=None, 
-                             stdout=fstout, stderr=fsterr)
+                             stdout=fstout, stderr=fsterr,
+                             env=self.get_environment())
 
         #If blocking, wait here
         if blocking:
@@ -2,12 +2,14 @@ import shlex
 import os
 import shutil as sh
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 
 from simwraplib.scriptrun import ScriptRun
 from simwraplib.run import Run
 from simwraplib.inpututils import KeywordInputMod
 from simwraplib.platform import get_platform
 from simwraplib.hpc import PBSJob
+from simwraplib.affinity import format_cpulist
 from simwraplib.lammpsrun import LammpsRun
 from simwraplib.openfoamrun import OpenFOAMRun
 from simwraplib.mdrun import MDRun
@@ -94,6 +96,9 @@ class CPLRun(Run):
             else:
                 quit('Unable to obtain base directory for coupler inputs')
 
+        # MD and CFD runs are set up at the same time
+        self.setupprocs = 2
+
         # Set input modifier to be normal kind
         self.inputmod = KeywordInputMod
 
@@ -116,7 +121,8 @@ class CPLRun(Run):
             #Call build and wait until build has finished 
             #before returning control to caller
             split_cmdstg = shlex.split(cmdstg)
-            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir)
+            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir,
+                                  env=self.get_environment())
             self.build.wait()
 
         except:
@@ -142,15 +148,57 @@ class CPLRun(Run):
         self.cfdrun.rundir = self.rundir + self.cfdrunsubdir
 
         self.prepare_inputs()
-        #Call MD and CFD setup to prepare each input as needed
-        self.mdrun.setup()
-        self.cfdrun.setup()
+        # Source snapshots of both go to the same place as the coupler's,
+        # and meshes to its mesh cache
+        for run in (self.mdrun, self.cfdrun):
+            if getattr(run, "sources", None) is None:
+                run.sources = self.sources
+            if getattr(run, "meshcache", None) is None:
+                run.meshcache = getattr(self, "meshcache", None)
+        #Call MD and CFD setup to prepare each input as needed, 
+        #at the same time as they are independent
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            setups = [executor.submit(self.mdrun.setup), 
+                      executor.submit(self.cfdrun.setup)]
+        for setup in setups:
+            setup.result()
 
     def get_nprocs(self):
         self.mdprocs = self.mdrun.get_nprocs()
         self.cfdprocs = self.cfdrun.get_nprocs()
         return self.mdprocs + self.cfdprocs
 
+    def get_features(self):
+
+        # Size of both coupled runs as well as the coupler inputs
+        features = super(CPLRun, self).get_features()
+        for prefix, run in (("md ", self.mdrun), ("cfd ", self.cfdrun)):
+            for key, value in run.get_features().items():
+                features[prefix + key] = value
+        return features
+
+    def use_environment(self, environment):
+
+        # Both coupled runs are set up and run in it too
+        super(CPLRun, self).use_environment(environment)
+        self.mdrun.use_environment(self.environment)
+        self.cfdrun.use_environment(self.environment)
+        return self
+
+    def populate_with(self, population):
+
+        # Both coupled runs share the store too
+        super(CPLRun, self).populate_with(population)
+        self.mdrun.populate_with(population)
+        self.cfdrun.populate_with(population)
+        return self
+
+    def cache_files(self):
+
+        # Results depend on both coupled runs as well as the coupler
+        return (super(CPLRun, self).cache_files() + self.mdrun.cache_files()
+                + self.cfdrun.cache_files())
+
     def prepare_mpiexec(self):
 
         # cplexec wrapper is the easiest way to run but
@@ -215,6 +263,12 @@ class CPLRun(Run):
             else:
                 cmd = self.mpiexec + " " + md + " : " + cfd + extra_cmds
 
+        # Confine both codes to the cores given by the scheduler, the
+        # launcher and every process it starts inherit the mask
+        cores = getattr(self, "cores", None)
+        if cores and self.platform == 'local':
+            cmd = "taskset -c " + format_cpulist(cores) + " " + cmd
+
         return cmd
 
     def finish(self):
@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+import os
+import json
+import hashlib
+import tempfile
+import subprocess as sp
+
+# Variables which only describe the shell used to capture them
+SHELL_VARIABLES = ["_", "PWD", "OLDPWD", "SHLVL"]
+
+# Environments captured in this process, keyed as Environment.key
+_environments = {}
+
+def default_environment_dir():
+
+    return os.path.join(os.path.expanduser("~"), ".simwraplib", "environments")
+
+class Environment:
+
+    """
+        The environment set up by a shell script, such as OpenFOAM's
+        etc/bashrc or a SOURCEME.sh loading modules, captured once by
+        sourcing it in a shell and then passed as env to every
+        subprocess of the runs given it. Utilities are then found on
+        the PATH the script sets up without starting a shell and
+        sourcing the script again for each call.
+
+        Captured environments are kept for the life of the process and
+        in cachedir (default ~/.simwraplib/environments), keyed on the
+        path and contents of the script and the PATH it was sourced
+        from, so a study only sources the script again if it changes.
+
+        Example usage from a higher level:
+
+            env = Environment("/opt/openfoam/etc/bashrc")
+            run = OpenFOAMRun(...).use_environment(env)
+
+            study = Study(threadlist, maxproc,
+                          environment="/opt/openfoam/etc/bashrc")
+
+    """
+
+    def __init__(self, script, cachedir=None, shell="bash"):
+
+        self.script = os.path.abspath(os.path.expanduser(script))
+        if not os.path.isfile(self.script):
+            raise IOError("Environment script " + self.script + " not found")
+        if cachedir is None:
+            cachedir = default_environment_dir()
+        self.cachedir = os.path.abspath(cachedir)
+        self.shell = shell
+
+    def key(self):
+
+        h = hashlib.sha256()
+        h.update(self.script.encode())
+        with open(self.script, "rb") as f:
+            h.update(f.read())
+        h.update(os.environ.get("PATH", "").encode())
+        return h.hexdigest()
+
+    def env(self):
+
+        """
+            The captured environment as a dictonary, sourcing the
+            script only if it has not been captured before
+        """
+
+        key = self.key()
+        if key in _environments:
+            return _environments[key]
+
+        cached = os.path.join(self.cachedir, key + ".json")
+        try:
+            with open(cached) as f:
+                _environments[key] = json.load(f)
+            return _environments[key]
+        except (IOError, ValueError):
+            pass
+
+        env = self.capture()
+        _environments[key] = env
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cachedir, prefix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(env, f)
+            os.replace(tmp, cached)
+        except (IOError, OSError) as e:
+            print("Could not cache environment of " + self.script + ": " + str(e))
+        return env
+
+    def capture(self):
+
+        # Source the script (without passing it any arguments, which
+        # scripts like OpenFOAM's bashrc take as settings) then list
+        # the environment separated by nulls
+        cmd = 'script="$1"; set --; . "$script" > /dev/null 2>&1; env -0'
+        proc = sp.run([self.shell, "-c", cmd, self.shell, self.script],
+                      stdout=sp.PIPE, stderr=sp.PIPE)
+        if proc.returncode != 0:
+            raise OSError("Could not capture environment of " + self.script
+                          + ": " + proc.stderr.decode(errors="replace"))
+
+        env = {}
+        for entry in proc.stdout.decode(errors="replace").split("\0"):
+            name, sep, value = entry.partition("=")
+            if sep and name not in SHELL_VARIABLES:
+                env[name] = value
+        return env
+
+def run_environment(run):
+
+    """
+        Environment for the subprocesses of run, as a dictonary, or
+        None to inherit that of this process
+    """
+
+    environment = getattr(run, "environment", None)
+    if environment is None or isinstance(environment, dict):
+        return environment
+    return environment.env()
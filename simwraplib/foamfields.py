@@ -0,0 +1,278 @@
+#! /usr/bin/env python
+import io
+import os
+import re
+import mmap
+import tempfile
+import numpy as np
+
+# Number of components of each type of value in a list or field
+COMPONENTS = {"scalar": 1, "vector": 3, "symmTensor": 6, "tensor": 9,
+              "label": 1}
+
+# Type of value held by each class of field file
+FIELD_TYPES = {"volScalarField": "scalar", "volVectorField": "vector",
+               "volSymmTensorField": "symmTensor"}
+
+def value_type(kind):
+
+    # Type of values in a list, e.g. vector for List<vector>
+    if kind and "<" in kind:
+        return kind[kind.find("<")+1:kind.find(">")]
+    return kind
+
+def foamfile_header(data):
+
+    """
+        Entries of the FoamFile header at the start of data (the
+        bytes of an OpenFOAM file) as a dictonary of strings
+    """
+
+    entries = {}
+    start = data.find(b"FoamFile")
+    if start < 0:
+        return entries
+    end = data.find(b"}", start)
+    for line in bytes(data[start:end]).decode('utf8', 'replace').splitlines():
+        split = line.strip().rstrip(";").split(None, 1)
+        if len(split) == 2:
+            entries[split[0]] = split[1].strip('"')
+    return entries
+
+def read_foamfile_header(filename):
+
+    # FoamFile header of filename, reading no further than the header
+    lines = []
+    try:
+        with open(filename, 'rb') as f:
+            for line in f:
+                lines.append(line)
+                if line.strip() == b"}":
+                    break
+    except IOError:
+        pass
+    return foamfile_header(b"".join(lines))
+
+def binary_types(header):
+
+    """
+        NumPy types of the scalars and labels in a binary file, from
+        the arch entry of its FoamFile header, or None for ascii
+    """
+
+    if header.get("format") != "binary":
+        return None
+    arch = header.get("arch", "")
+    order = ">" if "MSB" in arch else "<"
+    label = re.search(r"label=(\d+)", arch)
+    scalar = re.search(r"scalar=(\d+)", arch)
+    label = int(label.group(1)) if label else 32
+    scalar = int(scalar.group(1)) if scalar else 64
+    return (np.dtype(order + "f" + str(scalar//8)),
+            np.dtype(order + "i" + str(label//8)))
+
+def list_dtype(types, kind):
+
+    # NumPy type of binary values in a list of kind, None for ascii
+    if types is None:
+        return None
+    scalar, label = types
+    if value_type(kind) == "label":
+        return label
+    return scalar
+
+def locate_list(data, pos, ncomp=1, dtype=None):
+
+    """
+        Find the values of a list written from pos in data, as
+
+            N
+            (
+            ...
+            )
+
+        or N(...) on one line, with N*ncomp values of dtype after the
+        bracket if the file is binary. Returns N and the positions of
+        the first value and of the closing bracket.
+    """
+
+    opening = data.find(b"(", pos)
+    match = re.search(rb"\d+", data[pos:opening])
+    count = int(match.group()) if match else None
+    start = opening + 1
+    if dtype is not None and count is not None:
+        return count, start, start + count*ncomp*dtype.itemsize
+
+    #Short lists may be written on one line, e.g. 2((0 0 0) (1 0 0))
+    lineend = data.find(b"\n", opening)
+    if lineend < 0:
+        lineend = len(data)
+    line = data[opening:lineend]
+    if line.count(b"(") == line.count(b")"):
+        return count, start, opening + line.rfind(b")")
+
+    #Otherwise values end with the first line starting with a bracket
+    end = data.find(b"\n)", start)
+    if end < 0:
+        return count, start, len(data)
+    return count, start, end + 1
+
+def parse_values(payload, ncomp=1, dtype=None):
+
+    # Array of the values in payload, one row per entry if ncomp > 1
+    if dtype is not None:
+        data = np.frombuffer(payload, dtype=dtype)
+        data = data.astype(int if dtype.kind == "i" else float)
+    else:
+        data = np.array(payload.replace(b"(", b" ").replace(b")", b" ").split(),
+                        dtype=float)
+    if ncomp > 1:
+        data = data.reshape(-1, ncomp)
+    return data
+
+def format_list(values, dtype=None, precision=6):
+
+    # List of values written as OpenFOAM does, raw if dtype is given
+    count = values.shape[0]
+    if dtype is not None:
+        return (str(count).encode() + b"\n("
+                + np.ascontiguousarray(values, dtype=dtype).tobytes() + b")")
+
+    fmt = "%." + str(precision) + "g"
+    if values.ndim > 1:
+        fmt = "(" + " ".join([fmt]*values.shape[1]) + ")"
+    out = io.BytesIO()
+    np.savetxt(out, values, fmt=fmt)
+    return str(count).encode() + b"\n(\n" + out.getvalue() + b")"
+
+def find_entry(data, entry):
+
+    # Match for the start of a top level uniform/nonuniform entry
+    return re.search(rb"(?m)^[ \t]*" + re.escape(entry.encode())
+                     + rb"\s+(nonuniform|uniform)\s*", data)
+
+def read_field(filename, entry="internalField"):
+
+    """
+        Values of an OpenFOAM field file (ascii or binary) as a NumPy
+        array, one row per cell for vectors and tensors. A uniform
+        field gives its single value.
+    """
+
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = foamfile_header(mm)
+            ncomp = COMPONENTS[FIELD_TYPES.get(header.get("class"), "scalar")]
+            match = find_entry(mm, entry)
+            if match is None:
+                raise ValueError(entry + " not found in " + filename)
+
+            if match.group(1) == b"uniform":
+                end = mm.find(b";", match.end())
+                value = parse_values(bytes(mm[match.end():end]))
+                return value[0] if value.size == 1 else value
+
+            kindend = mm.find(b"\n", match.end())
+            kind = bytes(mm[match.end():kindend]).decode().split()[0]
+            kind = re.match(r"[^\d(]*", kind).group()
+            dtype = list_dtype(binary_types(header), kind)
+            count, start, end = locate_list(mm, match.end() + len(kind),
+                                            ncomp, dtype)
+            return parse_values(bytes(mm[start:end]), ncomp, dtype)
+
+def write_field(filename, values, binary=None, precision=6,
+                entry="internalField"):
+
+    """
+        Replace the values of an OpenFOAM field file with values, an
+        array with one row per cell (or a single value for a uniform
+        field), keeping the rest of the file as it is. Written in the
+        format of the file unless binary is given.
+    """
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    header = foamfile_header(data)
+    ftype = FIELD_TYPES.get(header.get("class"))
+    if ftype is None:
+        raise ValueError(filename + " is not a " + ", ".join(FIELD_TYPES) + " file")
+    ncomp = COMPONENTS[ftype]
+    values = np.asarray(values, dtype=float)
+    oldtypes = binary_types(header)
+
+    match = find_entry(data, entry)
+    if match is None:
+        raise ValueError(entry + " not found in " + filename)
+
+    #The binary format only applies to nonuniform lists, so the format of
+    #the whole file can only change if there are no others in it
+    isbinary = header.get("format") == "binary"
+    if binary is None:
+        binary = isbinary
+    if binary != isbinary:
+        if len(re.findall(rb"\snonuniform\s", data)) > (match.group(1) == b"nonuniform"):
+            raise ValueError("Format of " + filename + " cannot be changed as it"
+                             + " has other nonuniform values")
+        end = data.find(b"}", data.find(b"FoamFile"))
+        fmt = b"binary" if binary else b"ascii"
+        newheader = re.sub(rb"(format\s+)\w+", rb"\g<1>" + fmt, data[:end], count=1)
+        data = newheader + data[end:]
+        header["format"] = fmt.decode()
+        match = find_entry(data, entry)
+
+    #Span of the existing entry, up to and including its ;
+    if match.group(1) == b"uniform":
+        end = data.find(b";", match.end())
+    else:
+        kind = data[match.end():data.find(b"\n", match.end())].decode().split()[0]
+        kind = re.match(r"[^\d(]*", kind).group()
+        count, start, close = locate_list(data, match.end() + len(kind), ncomp,
+                                          list_dtype(oldtypes, kind))
+        end = data.find(b";", close)
+
+    name = entry.encode() + b"   "
+    if values.size == ncomp and values.ndim <= 1:
+        #A single value makes the field uniform
+        if ncomp == 1:
+            new = name + b"uniform " + ("%.*g" % (precision, values.flat[0])).encode()
+        else:
+            new = (name + b"uniform (" + " ".join("%.*g" % (precision, v)
+                   for v in values).encode() + b")")
+    else:
+        shape = "(N, " + str(ncomp) + ")" if ncomp > 1 else "(N,)"
+        if values.shape[1:] != ((ncomp,) if ncomp > 1 else ()):
+            raise ValueError("Values for " + filename + " should have shape " + shape)
+        dtype = list_dtype(binary_types(header), ftype) if binary else None
+        new = (name + b"nonuniform List<" + ftype.encode() + b"> \n"
+               + format_list(values, dtype, precision) + b"\n")
+
+    write_bytes(filename, data[:match.start()] + new + data[end:])
+
+def read_label_list(filename):
+
+    # Top level list of labels, e.g. a cellProcAddressing file
+    with open(filename, 'rb') as f:
+        data = f.read()
+    header = foamfile_header(data)
+    pos = data.find(b"}", data.find(b"FoamFile")) + 1
+    #Skip comments between header and list
+    pos = re.compile(rb"(\s|//[^\n]*)*").match(data, pos).end()
+    dtype = list_dtype(binary_types(header), "List<label>")
+    count, start, end = locate_list(data, pos, 1, dtype)
+    return parse_values(data[start:end], 1, dtype).astype(int)
+
+def write_bytes(filename, data):
+
+    # Replace filename with data in one step, keeping its mode
+    folder, name = os.path.split(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix="." + name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if os.path.exists(filename):
+            os.chmod(tmp, os.stat(filename).st_mode & 0o7777)
+        os.replace(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+from collections import deque
+
+from .scheduler import PENDING, TaskQueue
+
+def as_runlists(threadlist):
+
+    # Allow single runs in place of a runlist
+    return [t if isinstance(t, (list, tuple)) else [t] for t in threadlist]
+
+def unique_runs(threadlist):
+
+    """
+        Every distinct run object in a threadlist, including any runs
+        they depend on, each listed once in the order first seen
+    """
+
+    runs = []
+    seen = set()
+    stack = [run for runlist in as_runlists(threadlist) for run in runlist]
+    stack.reverse()
+    while stack:
+        run = stack.pop()
+        if id(run) in seen:
+            continue
+        seen.add(id(run))
+        runs.append(run)
+        stack.extend(reversed(getattr(run, "dependencies", [])))
+
+    return runs
+
+class RunGraph(TaskQueue):
+
+    """
+        Dependency graph of runs, handed out to pool workers one run
+        at a time as soon as everything it depends on has finished.
+
+        Each run depends on the run before it in its runlist and on
+        any runs added with run.depends_on(...). A run object which
+        appears in several runlists (e.g. an equilibration run shared
+        by several production runs) is a single node, so it is only
+        performed once. If a run fails, every run downstream of it is
+        skipped while independent branches carry on.
+
+        Example usage from a higher level:
+
+            equil = MDRun(...)
+            threadlist = []
+            for change in changes:
+                prod = MDRun(..., inputchanges=change)
+                threadlist.append([equil, prod])
+
+            study = Study(threadlist, maxproc, dag=True)
+
+    """
+
+    def __init__(self, threadlist):
+
+        self.runs = unique_runs(threadlist)
+        self.runlists = [[run] for run in self.runs]
+        keys = dict((id(run), key) for key, run in enumerate(self.runs))
+        self.parents = dict((key, set()) for key in keys.values())
+        self.children = dict((key, set()) for key in keys.values())
+
+        # Sequence within a runlist and explicit dependencies
+        for runlist in as_runlists(threadlist):
+            for before, after in zip(runlist[:-1], runlist[1:]):
+                self.link(keys[id(before)], keys[id(after)])
+        for key, run in enumerate(self.runs):
+            for dep in getattr(run, "dependencies", []):
+                self.link(keys[id(dep)], key)
+
+        self.check_acyclic()
+
+        self.state = dict((key, "pending") for key in self.parents)
+        self.ready = deque(key for key in sorted(self.parents)
+                           if not self.parents[key])
+        self.started = {}
+        self.delayed = []
+
+    def link(self, parent, child):
+
+        if parent == child:
+            raise ValueError("Run in " + self.runs[child].rundir
+                             + " depends on itself")
+        self.parents[child].add(parent)
+        self.children[parent].add(child)
+
+    def topological_order(self):
+
+        """
+            Keys of all runs ordered so each comes after the runs it
+            depends on (Kahn's algorithm), anything on a cycle is left out
+        """
+
+        nparents = dict((key, len(p)) for key, p in self.parents.items())
+        queue = deque(key for key in sorted(nparents) if nparents[key] == 0)
+        order = []
+        while queue:
+            key = queue.popleft()
+            order.append(key)
+            for child in sorted(self.children[key]):
+                nparents[child] -= 1
+                if nparents[child] == 0:
+                    queue.append(child)
+
+        return order
+
+    def check_acyclic(self):
+
+        order = self.topological_order()
+        if len(order) != len(self.runs):
+            cycle = [self.runs[key].rundir for key in self.parents 
+                     if key not in order]
+            raise ValueError("Dependency cycle between runs in " + ", ".join(cycle))
+
+    def next_task(self):
+
+        # Requeued runs stay "running" until they are done
+        self.ready.extend(key for key, index in self.due())
+        if self.ready:
+            key = self.ready.popleft()
+            self.state[key] = "running"
+            return key, [self.runs[key]]
+        elif "running" in list(self.state.values()):
+            return PENDING
+        else:
+            return None
+
+    def task_done(self, key, success):
+
+        if success:
+            self.state[key] = "done"
+            for child in sorted(self.children[key]):
+                if (self.state[child] == "pending" and
+                    all(self.state[p] == "done" for p in self.parents[child])):
+                    self.ready.append(child)
+        else:
+            self.state[key] = "failed"
+            skipped = self.skip_downstream(key)
+            print("Run in " + self.runs[key].rundir + " failed, skipping "
+                  + str(len(skipped)) + " runs which depend on it")
+
+    def skip_downstream(self, key):
+
+        skipped = []
+        stack = list(self.children[key])
+        while stack:
+            child = stack.pop()
+            if self.state[child] == "pending":
+                self.state[child] = "skipped"
+                skipped.append(child)
+                stack.extend(self.children[child])
+
+        return skipped
+
+    def summary(self):
+
+        # Number of runs in each state
+        counts = {}
+        for state in self.state.values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
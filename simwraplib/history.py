@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+import os
+import json
+import time
+import sqlite3
+import numpy as np
+
+def default_history_file():
+
+    return os.path.join(os.path.expanduser("~"), ".simwraplib", "runtimes.db")
+
+def run_key(run):
+
+    # Runs are only compared with runs of the same type and executable
+    return type(run).__name__, str(run.executable)
+
+class RuntimeHistory:
+
+    """
+        Store of how long previous runs took, kept in an SQLite file
+        so it is shared between studies and worker processes. Each
+        record holds the wall time of a run against its type,
+        executable, number of processors and input size parameters
+        (see Run.get_features), which are used to predict how long
+        a new run will take.
+
+        Predictions for a run come only from runs of the same type
+        and executable. If the same nprocs and inputs have been run
+        before, the median of those times is used. Otherwise a power
+        law is fitted by least squares,
+
+            log(t) = a + b*log(nprocs) + sum_k c_k*log(x_k)
+
+        over the size parameters x_k which vary in the history,
+        dropping parameters while there are too few records to fit them.
+
+        Example usage from a higher level:
+
+            history = RuntimeHistory()
+            study = Study(threadlist, maxproc, history=history)
+
+    """
+
+    def __init__(self, dbfile=None):
+
+        if dbfile is None:
+            dbfile = default_history_file()
+        self.dbfile = dbfile
+        dbdir = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+
+        self.query("CREATE TABLE IF NOT EXISTS runtimes "
+                   "(runtype TEXT, executable TEXT, nprocs INTEGER, "
+                   "features TEXT, seconds REAL, rundir TEXT, finished REAL)")
+
+    def query(self, sql, args=()):
+
+        # A new connection each time so the history can be pickled
+        # and used from any worker process, sqlite handles locking
+        db = sqlite3.connect(self.dbfile, timeout=60)
+        try:
+            with db:
+                return db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+
+    def record(self, run, seconds, nprocs=None):
+
+        """
+            Add the wall time in seconds taken by run
+        """
+
+        if nprocs is None:
+            nprocs = run.get_nprocs()
+        runtype, executable = run_key(run)
+        features = json.dumps(run.get_features(), sort_keys=True)
+        self.query("INSERT INTO runtimes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (runtype, executable, nprocs, features, seconds,
+                    run.rundir, time.time()))
+
+    def records(self, run):
+
+        """
+            List of (nprocs, features, seconds) for previous runs of
+            the same type and executable as run
+        """
+
+        rows = self.query("SELECT nprocs, features, seconds FROM runtimes "
+                          "WHERE runtype=? AND executable=?", run_key(run))
+        return [(n, json.loads(f), s) for n, f, s in rows]
+
+    def last_nprocs(self, run):
+
+        # Processors used the last time a run was in this directory
+        rows = self.query("SELECT nprocs FROM runtimes WHERE rundir=? "
+                          "ORDER BY finished DESC LIMIT 1", (run.rundir,))
+        if not rows:
+            return None
+        return rows[0][0]
+
+    def predict(self, run, nprocs=None):
+
+        """
+            Predicted wall time of run in seconds, or None if there is
+            no history for this type of run
+        """
+
+        records = self.records(run)
+        if not records:
+            return None
+        if nprocs is None:
+            nprocs = run.get_nprocs()
+        features = run.get_features()
+
+        # Same inputs run before
+        same = [s for n, f, s in records if n == nprocs and f == features]
+        if same:
+            return float(np.median(same))
+
+        # Size parameters usable in a power law fit,
+        # those which vary most are kept first
+        names = []
+        for name, value in features.items():
+            values = [f.get(name) for n, f, s in records]
+            if (value > 0 and None not in values and min(values) > 0
+                and len(set(values)) > 1):
+                names.append((-np.ptp(np.log(values)), name))
+        names = [name for spread, name in sorted(names)]
+        if len(set(n for n, f, s in records)) > 1:
+            names.insert(0, None)
+        names = names[:max(0, len(records) - 2)]
+        if not names:
+            return float(np.median([s for n, f, s in records]))
+
+        def row(n, f):
+            return [1.] + [np.log(n) if name is None else np.log(f[name])
+                           for name in names]
+
+        A = np.array([row(n, f) for n, f, s in records])
+        b = np.log([max(s, 1e-3) for n, f, s in records])
+        coeffs = np.linalg.lstsq(A, b, rcond=None)[0]
+
+        return float(np.exp(np.dot(row(nprocs, features), coeffs)))
+
+def record_runtime(run, seconds, nprocs=None):
+
+    # Add to the history the run was given by Study, if any. Batch
+    # jobs are left out as their time includes waiting in the queue
+    history = getattr(run, "history", None)
+    if (history is None or getattr(run, "dryrun", False)
+        or getattr(run, "platform", "local") != "local"):
+        return
+    try:
+        history.record(run, seconds, nprocs)
+    except sqlite3.Error as e:
+        print("Could not record runtime of " + run.rundir + ": " + str(e))
@@ -1,6 +1,9 @@
 
 import string
+import operator
 import os
+import glob
+import shlex
 import numpy as np
 from tempfile import mkstemp
 from shutil import move
@@ -8,6 +11,8 @@ import shutil as sh
 import subprocess as sp
 
 from .read_header import openfoam_HeaderData
+from .foamfields import (COMPONENTS, FIELD_TYPES, read_field, write_field, 
+                         read_label_list, read_foamfile_header)
 
 class cd:
     """Context manager for changing the current working directory"""
@@ -25,6 +30,34 @@ import re
 import shutil
 from tempfile import mkstemp
 
+class rewrite:
+    """Context manager giving (fin, fout) to stream filename into a new
+       version of itself. The new version is written to a temporary file
+       in the same folder and moved over the original in one step on
+       success, so the file is never seen half written. A copy of the
+       original is kept as filename + backup unless backup is None."""
+    def __init__(self, filename, backup=".bak"):
+        self.filename = filename
+        self.backup = backup
+
+    def __enter__(self):
+        folder, name = os.path.split(os.path.abspath(self.filename))
+        fd, self.tmp = mkstemp(dir=folder, prefix="." + name, suffix=".tmp")
+        self.fin = open(self.filename)
+        self.fout = os.fdopen(fd, 'w')
+        return self.fin, self.fout
+
+    def __exit__(self, etype, value, traceback):
+        self.fin.close()
+        self.fout.close()
+        if etype is not None:
+            os.remove(self.tmp)
+            return False
+        sh.copymode(self.filename, self.tmp)
+        if self.backup is not None:
+            sh.copy2(self.filename, self.filename + self.backup)
+        os.replace(self.tmp, self.filename)
+
 
 def sed(pattern, replace, source, dest=None, count=0):
     """Reads a source file and writes the destination file.
@@ -125,6 +158,118 @@ def check_replace_line(line, keyword, keyvals):
     else:
         return line, False
 
+def write_lines(filename, lines):
+
+    # Write lines to filename in one step, through a temporary file
+    # in the same folder, keeping the mode of any file replaced
+    folder, name = os.path.split(os.path.abspath(filename))
+    fd, tmp = mkstemp(dir=folder, prefix="." + name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        if os.path.exists(filename):
+            sh.copymode(filename, tmp)
+        os.replace(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# Folders of a case input holding the files parsed from it, as
+# read_header does, leaving out the mesh and processor folders
+INPUT_FOLDERS = ["constant", "system", "0"]
+
+def input_state(path):
+
+    """
+        Size and modification time of a file or, for an input held in
+        a folder such as an OpenFOAM case, of the files at the top
+        level of its INPUT_FOLDERS and its blockMeshDict
+    """
+
+    if os.path.isdir(path):
+        state = []
+        files = [os.path.join(path, "constant", "polyMesh", "blockMeshDict")]
+        for folder in INPUT_FOLDERS:
+            try:
+                entries = list(os.scandir(os.path.join(path, folder)))
+            except OSError:
+                continue
+            files.extend(e.path for e in entries if e.is_file())
+        for name in files:
+            try:
+                stat = os.stat(name)
+            except OSError:
+                continue
+            state.append((name, stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(state))
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+# Base inputs parsed in this process (and so in workers forked from
+# it), keyed by input modifier, path and the state of the files
+_templates = {}
+
+def get_template(inputmod, filename):
+
+    """
+        Base input filename parsed by inputmod.parse_template, parsed
+        only the first time it is asked for or after it has changed
+    """
+
+    key = (inputmod, os.path.abspath(filename), input_state(filename))
+    if key not in _templates:
+        _templates[key] = inputmod.parse_template(filename)
+    return _templates[key]
+
+class InputTemplate(object):
+
+    """
+        A base input file parsed once and shared by every run set up
+        from it. Holds the lines of the file and, once looked up, the
+        line numbers on which each keyword appears, so an input with 
+        changes is rendered by replacing just those lines.
+    """
+
+    def __init__(self, filename, lines):
+        self.filename = filename
+        self.lines = lines
+        self.positions = {}
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as f:
+            return cls(filename, f.readlines())
+
+    def find(self, keyword, match):
+
+        # Line numbers of lines for which match(line, keyword) is
+        # true, found by one scan the first time keyword is looked up
+        if keyword not in self.positions:
+            self.positions[keyword] = [no for no, line in enumerate(self.lines)
+                                       if match(line, keyword)]
+        return self.positions[keyword]
+
+def starts_with_keyword(line, keyword):
+
+    return keyword_line(line, [keyword]) is not None
+
+def contains_keyword(line, keyword):
+
+    # As check_replace_line, ignoring tabs and repeated spaces
+    ls = " ".join(line.strip().replace("\t","").split())
+    return " ".join(keyword.split()) in ls
+
+def keyword_line(line, keywords):
+
+    # First of keywords which starts line, taking into account it 
+    # might be "turned off" by a comment character before it
+    for keyword in keywords:
+        if (line[0:len(keyword)]   == keyword or 
+            line[1:len(keyword)+1] == keyword): 
+            return keyword
+    return None
+
 class InputMod(object):
 
     def __init__(self, filename):
@@ -133,6 +278,34 @@ class InputMod(object):
     def replace_input(self, keyword, keyvals):    
         raise NotImplementedError
 
+    def apply_changes(self, changes):
+
+        """
+            Make every change in the dictonary changes of the form
+            {keyword: keyvals}. Subclasses apply them all in a single
+            pass over the input, with at most one backup.
+        """
+
+        for keyword, keyvals in changes.items():
+            self.replace_input(keyword, keyvals)
+
+    @classmethod
+    def parse_template(cls, filename):
+
+        # Parsed form of a base input (see get_template), None if
+        # inputs are only changed in place with apply_changes
+        return None
+
+    def render(self, template, changes):
+
+        """
+            Write the base input parsed into template with changes
+            made to this modifier's file, which subclasses do without
+            reading the base input again
+        """
+
+        self.apply_changes(changes)
+
 class ScriptMod(object):
 
     def __init__(self, filename):
@@ -140,30 +313,52 @@ class ScriptMod(object):
     
     def replace_input(self, keyword, keyvals):    
 
-        #We only want to replace at most one time
-        found = False
-        replacefile = self.filename + ".bak"
-        #sh.copy(self.filename, self.filename+".bak")
-        with open(replacefile,'w') as new_file:
-            with open(self.filename) as old_file:
-                if type(keyword) is int:
-                    #Replace line number in Python script
-                    #We add one as line numbers start from one
-                    for no, line in enumerate(old_file):
-                        if no+1 == keyword:
-                            new_file.write(keyvals+"\n")
-                        else:
-                            new_file.write(line)
-                elif type(keyword) is str:
-                    for line in old_file:                      
-                        if not found:
-                            l, found = check_replace_line(line, keyword, keyvals)
-                        else:
-                            l = line
-                        new_file.write(l)
-
-        #Replace original file
-        sh.copy(replacefile, self.filename)
+        self.apply_changes({keyword: keyvals})
+
+    @classmethod
+    def parse_template(cls, filename):
+
+        return InputTemplate.read(filename)
+
+    def render(self, template, changes):
+
+        # As apply_changes, from the parsed base script
+        lines = list(template.lines)
+        for keyword, keyvals in changes.items():
+            if type(keyword) is int:
+                lines[keyword-1] = keyvals+"\n"
+                continue
+            for no in template.find(keyword, contains_keyword)[:1]:
+                lines[no], found = check_replace_line(lines[no], keyword, keyvals)
+        write_lines(self.filename, lines)
+
+    def apply_changes(self, changes):
+
+        """
+            Make every change in the dictonary changes in one pass.
+            An integer keyword replaces that line number of the
+            script, a string replaces the first line containing it.
+        """
+
+        if not changes:
+            return
+
+        #We only want to replace each keyword at most one time
+        pending = dict((k, v) for k, v in changes.items() if type(k) is str)
+        with rewrite(self.filename) as (old_file, new_file):
+            for no, line in enumerate(old_file):
+                #Replace line number in Python script
+                #We add one as line numbers start from one
+                if no+1 in changes:
+                    new_file.write(changes[no+1]+"\n")
+                    continue
+                for keyword in list(pending):
+                    line, found = check_replace_line(line, keyword, 
+                                                     pending[keyword])
+                    if found:
+                        del pending[keyword]
+                        break
+                new_file.write(line)
 
 class KeywordInputMod(InputMod):
 
@@ -229,67 +424,107 @@ class KeywordInputMod(InputMod):
 
         """
 
-        found = False
-        sh.copy(self.filename, self.filename+".bak") 
+        self.apply_changes({keyword: keyvals})
 
-        #fd, tempfile = mkstemp()
-        tempfile = self.filename + ".temp"
-        fout = open(tempfile, 'w')
-        #skipcount = 0
+    def apply_changes(self, changes):
 
-        with open(self.filename) as fin:
-            for line in fin:
-                # Take into account keyword might be "turned off" by a
-                # comment character before it
-                if ((line[0:len(keyword)]   == keyword or 
-                     line[1:len(keyword)+1] == keyword)  
-                     and not found): 
-
-                    # Mark the keyword as found 
-                    found = True
-
-                    # Ensure keyword is activated (i.e. not commented out)
-                    fout.write(keyword+"\n")
-                    print("writing = ", keyword)
-
-                    # Values start on next line
-                    if type(keyvals) is list:
-                        for val in keyvals:
-                            try:
-                                nl = next(fin)
-                            except StopIteration:
-                                nl = ""
-                            if (val != None):
-                                fout.write(str(val) + "\n")
-                                print("Replacing ", nl.replace("\n",""), "with", str(val))
-                            else:
-                                print("NOT replacing ", nl.replace("\n",""))
-                                fout.write(nl)
-                                #skipcount += 1
-                    else:
-                        fout.write(str(val))
+        """ 
+            Replace the values underneath the first appearance of
+            every keyword in the dictonary changes {keyword: keyvals}
+            (see replace_input) in a single pass over the file. A 
+            value of None leaves that line as it is, keywords not 
+            found are appended to the file.
+        """
 
-                #elif skipcount == 0:
-                else:
-                    #print(line, keyword, keyvals, found)
+        if not changes:
+            return
+
+        # A single value replaces one line
+        pending = {}
+        for keyword, keyvals in changes.items():
+            if type(keyvals) is not list:
+                keyvals = [keyvals]
+            pending[keyword] = keyvals
+
+        with rewrite(self.filename) as (fin, fout):
+            for line in fin:
+                keyword = keyword_line(line, pending)
+                if keyword is None:
                     fout.write(line)
-                #else:
-                    #print("Skipping", line, skipcount)
-                    #skipcount -= 1
+                    continue
 
-        #Close new file and replace old one
-        fout.close()
-        sh.move(tempfile, self.filename)
+                # Ensure keyword is activated (i.e. not commented out)
+                keyvals = pending.pop(keyword)
+                fout.write(keyword+"\n")
+                print("writing = ", keyword)
 
-        #Append to file if not found
-        if ( found == False ):
-            with open(self.filename,'a') as f:
-                f.write(keyword+'\n')
+                # Values start on next line
+                for val in keyvals:
+                    try:
+                        nl = next(fin)
+                    except StopIteration:
+                        nl = ""
+                    if (val != None):
+                        fout.write(str(val) + "\n")
+                        print("Replacing ", nl.replace("\n",""), "with", str(val))
+                    else:
+                        print("NOT replacing ", nl.replace("\n",""))
+                        fout.write(nl)
+
+            #Append to file if not found
+            for keyword, keyvals in pending.items():
+                fout.write(keyword+'\n')
                 for keyval in keyvals:
-                    f.write(str(keyval)+'\n')
+                    fout.write(str(keyval)+'\n')
 
-            print('Input string ' + keyword + 
-                  ' not found, appended to file instead.')
+                print('Input string ' + keyword + 
+                      ' not found, appended to file instead.')
+
+    @classmethod
+    def parse_template(cls, filename):
+
+        return InputTemplate.read(filename)
+
+    def render(self, template, changes):
+
+        """
+            As apply_changes, but the lines to replace are found from 
+            the parsed base input so only they are changed
+        """
+
+        lines = list(template.lines)
+        appended = []
+        for keyword, keyvals in changes.items():
+            if type(keyvals) is not list:
+                keyvals = [keyvals]
+
+            found = template.find(keyword, starts_with_keyword)
+            if not found:
+                appended.append(keyword+'\n')
+                appended += [str(keyval)+'\n' for keyval in keyvals]
+                print('Input string ' + keyword + 
+                      ' not found, appended to file instead.')
+                continue
+
+            # Ensure keyword is activated (i.e. not commented out)
+            no = found[0]
+            lines[no] = keyword+"\n"
+            print("writing = ", keyword)
+
+            # Values start on next line
+            for i, val in enumerate(keyvals):
+                at = no + 1 + i
+                old = lines[at] if at < len(lines) else ""
+                if (val != None):
+                    if at < len(lines):
+                        lines[at] = str(val) + "\n"
+                    else:
+                        lines.append(str(val) + "\n")
+                    print("Replacing ", old.replace("\n",""), "with", str(val))
+                else:
+                    print("NOT replacing ", old.replace("\n",""))
+
+        write_lines(self.filename, lines + appended)
 
 
     def replace_input_sed(self, keyword, keyvals):    
@@ -399,28 +634,59 @@ class CommentedInputMod(InputMod):
             you can use keyword="Viscosity" and change this keyval
 
         """
-        f = open(self.filename,'r')
-        fout = open(self.filename+'.tmp','w')
-        
-        lines = f.readlines()
-        keywordfound = False
-        for line in lines:
 
-            try:
-                name = line.split()[1]
-            except IndexError:
-                name = None
-
-            if (name == keyword):
-                keywordfound = True
-                value = line.split()[0]
-                fout.write(line.replace(value,keyval))
-            else:
-                fout.write(line)
+        self.apply_changes({keyword: keyval})
+
+    def apply_changes(self, changes):
+
+        # Replace the values of every keyword in the dictonary 
+        # changes {keyword: keyval} in a single pass over the file
+        if not changes:
+            return
+
+        found = set()
+        with rewrite(self.filename, backup=None) as (f, fout):
+            for line in f:
 
-        if (not keywordfound):
-            print(('Input string '+keyword+' not found.'))
-        sh.move(self.filename+'.tmp',self.filename) 
+                try:
+                    name = line.split()[1]
+                except IndexError:
+                    name = None
+
+                if (name in changes):
+                    found.add(name)
+                    value = line.split()[0]
+                    fout.write(line.replace(value,str(changes[name])))
+                else:
+                    fout.write(line)
+
+        for keyword in changes:
+            if keyword not in found:
+                print(('Input string '+keyword+' not found.'))
+
+    @classmethod
+    def parse_template(cls, filename):
+
+        return InputTemplate.read(filename)
+
+    def render(self, template, changes):
+
+        # As apply_changes, from the parsed base input
+        lines = list(template.lines)
+        for keyword, keyval in changes.items():
+            found = template.find(keyword, commented_keyword)
+            for no in found:
+                value = lines[no].split()[0]
+                lines[no] = lines[no].replace(value,str(keyval))
+            if not found:
+                print(('Input string '+keyword+' not found.'))
+        write_lines(self.filename, lines)
+
+def commented_keyword(line, keyword):
+
+    # Keyword is the word after the value, e.g. 1.6 !Viscosity
+    split = line.split()
+    return len(split) > 1 and split[1] == keyword
 
 class CFDInputMod(CommentedInputMod):
     def __init__(self,filename):
@@ -429,11 +695,35 @@ class CFDInputMod(CommentedInputMod):
 
 class OpenFOAMInputMod(InputMod):
 
-    def __init__(self, fdir):
+    # Dictionaries the mesh and its decomposition are generated from
+    meshdicts = ["blockMeshDict"]
+    decomposedicts = ["decomposeParDict"]
+
+    def __init__(self, fdir, template=None):
         self.fdir = fdir
-        self.headerObj = openfoam_HeaderData(fdir)
+        # Input files changed since the mesh was last generated
+        self.changed = []
+        # MeshCache of meshes generated before, if any
+        self.meshcache = None
+        # Environment for OpenFOAM utilities, None for this process's
+        self.env = None
+        # Header data of the base case parsed once, see get_template
+        if template is None:
+            self.headerObj = openfoam_HeaderData(fdir)
+        else:
+            self.headerObj = template.copy_to(fdir)
         self.HD = self.headerObj.headerDict
 
+    @classmethod
+    def parse_template(cls, fdir):
+
+        return openfoam_HeaderData(fdir)
+
+    def render(self, template, changes):
+
+        # Header data already comes from template, see __init__
+        self.apply_changes(changes)
+
     def replace_input(self, keyword, keyvals):    
 
         """ 
@@ -455,32 +745,62 @@ class OpenFOAMInputMod(InputMod):
             keyvals = [{"numberOfSubdomains":8}, 
                        {"numberOfSubdomains":{simpleCoeffs:{"n":[2,2,2]}}}]
 
+            Call rebuild_mesh once all changes are made to regenerate 
+            the mesh.
+
+        """
+
+        self.apply_changes({keyword: keyvals})
+
+    def apply_changes(self, changes):
+
+        """
+            Make every change in the dictonary changes (see 
+            replace_input), then write each input file changed once.
+            The mesh is not regenerated until rebuild_mesh is called,
+            once all changes to a case have been made.
         """
 
+        if not changes:
+            return
+
+        changed = []
+        for keyword, keyvals in changes.items():
+            fname = self.change_header(keyword, keyvals)
+            if fname not in changed:
+                changed.append(fname)
+        for fname in changed:
+            self.headerObj.header_changer(self.HD[fname])
+            if fname not in self.changed:
+                self.changed.append(fname)
+
+    def change_header(self, keyword, keyvals):
+
+        # Change the header data for one keyword and return the
+        # name of the input file it is in
+
         #Full openfoam form
         if type(keyvals) is dict:
             for k, v in list(keyvals.items()):
                 self.HD[keyword][k] = v
-            #quit()
-            self.headerObj.header_changer(self.HD[keyword])
+            return keyword
 
         #Pre defined options
         else:
             #Otherwise we support a few easy options
             HD = self.HD
-            headerObj = self.headerObj
             #Number of cells
             if ("cell" in keyword.lower()):
                 assert len(keyvals) == 3
                 HD['blockMeshDict']['blocks']['hex'][1] = keyvals
-                headerObj.header_changer(HD['blockMeshDict'])
+                return 'blockMeshDict'
             #Number of processes
             elif ("process" in keyword.lower()):
                 assert len(keyvals) == 3            
                 npx, npy, npz = keyvals
                 HD['decomposeParDict']["numberOfSubdomains"] = npx*npy*npz
                 HD['decomposeParDict']["simpleCoeffs"]["n"][0] = [npx, npy, npz]
-                headerObj.header_changer(HD['decomposeParDict'])
+                return 'decomposeParDict'
             elif (("origin" in keyword.lower()) or 
                 ("domainsize" in keyword.lower())):
                 if ("domainsize" in keyword.lower()):
@@ -501,23 +821,233 @@ class OpenFOAMInputMod(InputMod):
                               [Lx, Ly, Lz],
                               [xo, Ly, Lz]]
                 HD['blockMeshDict']['vertices'] = newvertices
-                headerObj.header_changer(HD['blockMeshDict'])
+                return 'blockMeshDict'
             else:
                 print("Only 'cell', 'domainsize', 'origin' and 'process' keywords currently supported")
                 raise NotImplementedError
 
+    def rebuild_mesh(self, force=False):
+
+        """
+            Regenerate the mesh and its decomposition once, after all
+            changes to the case. Only the steps the changed input files
+            affect are run: clean, blockMesh and decomposePar if the
+            mesh changed, only decomposePar if its decomposition did, 
+            decomposePar -fields if a field in 0/ of a decomposed case
+            did, and nothing otherwise unless force is True.
+        """
+
+        mesh = force or any(f in self.meshdicts for f in self.changed)
+        decompose = mesh or any(f in self.decomposedicts for f in self.changed)
+        fields = any(self.is_field(f) for f in self.changed)
+        self.changed = []
+        if not decompose:
+            if fields and self.processors():
+                self.run_tool("decomposePar -fields -force")
+            return
+
+        #Reuse a mesh generated before from the same dictionaries,
+        #only decomposing this case's fields onto it
+        if self.meshcache is not None:
+            key = self.meshcache.key(self)
+            if not force and self.meshcache.restore(self, key):
+                print("Mesh of " + self.fdir + " reused from mesh cache")
+                if self.processors():
+                    self.run_tool("decomposePar -fields")
+                return
+
+        #Trigger rebuild of code (cwd rather than cd so this is
+        #safe when several runs are set up from threads at once)
+        if mesh:
+            clean = sp.check_output(["python", "clean.py", "-f"], cwd=self.fdir,
+                                    env=self.env)
+            self.run_tool("blockMesh")
+        self.run_tool("decomposePar -force")
+
+        if self.meshcache is not None:
+            self.meshcache.store(self, key)
+
+    def is_field(self, name):
+
+        # True if input file name is a field in the 0/ folder
+        fname = self.HD.files.get(name)
+        return (fname is not None and 
+                os.path.basename(os.path.dirname(os.path.abspath(fname))) == "0")
+
+    def run_tool(self, cmd):
+
+        # Run an OpenFOAM utility in the case folder, found on the PATH
+        # of env without starting a shell
+        try:
+            tool = sp.Popen(shlex.split(cmd), stdout=sp.PIPE, stderr=sp.PIPE, 
+                            encoding='utf8', cwd=self.fdir, env=self.env)
+        except FileNotFoundError:
+            print("WARNING -- " + cmd.split()[0] + " not found, have you called SOURCEME.sh in OpenFOAM APP"
+                  + " or given the run an environment (see Run.use_environment)")
+            return
+        out, err = tool.communicate()
+
+    def processors(self):
+
+        # Processor folders of the decomposed case, in order
+        procs = []
+        for folder in glob.glob(os.path.join(self.fdir, "processor*")):
+            n = folder.split("processor")[-1]
+            if n.isdigit():
+                procs.append(int(n))
+        return sorted(procs)
+
+    def field_file(self, name, processor=None, time="0"):
+
+        if processor is None:
+            return os.path.join(self.fdir, str(time), name)
+        return os.path.join(self.fdir, "processor"+str(processor), str(time), name)
+
+    def read_field(self, name, processor=None, time="0"):
+
+        """
+            Initial values of field name (e.g. "U" or "T") as a NumPy 
+            array with one row per cell, from the case or, if given,
+            from processor folder processor after decomposition. Both
+            ascii and binary writeFormat are read.
+        """
+
+        return read_field(self.field_file(name, processor, time))
+
+    def write_field(self, name, values, processor=None, time="0", 
+                    binary=None, precision=None):
+
+        """
+            Set the initial values of field name to values, an array
+            with one row per cell of the case, or a single value to 
+            make the field uniform. Boundary conditions are kept. If
+            the case has been decomposed each processor's field is 
+            written too, taking its cells from cellProcAddressing.
+            Given processor, values are for that processor's cells
+            only and only its field is written.
+
+            Files keep their format unless binary is given, and ascii
+            values are written to writePrecision of controlDict.
+        """
+
+        if precision is None:
+            try:
+                precision = int(self.HD["controlDict"].get("writePrecision", 6))
+            except (KeyError, ValueError):
+                precision = 6
+
+        if processor is not None:
+            write_field(self.field_file(name, processor, time), values,
+                        binary, precision)
+            return
+
+        values = np.asarray(values, dtype=float)
+        fieldfile = self.field_file(name, None, time)
+        write_field(fieldfile, values, binary, precision)
+        fieldtype = FIELD_TYPES.get(read_foamfile_header(fieldfile).get("class"))
+        uniform = values.ndim <= 1 and values.size == COMPONENTS.get(fieldtype, 1)
+        for proc in self.processors():
+            procvalues = values if uniform else values[self.cell_addressing(proc)]
+            write_field(self.field_file(name, proc, time), procvalues, 
+                        binary, precision)
+
+        #Header data parsed before this is out of date
+        if str(time) == "0" and name in self.HD.parsed:
+            del self.HD.parsed[name]
+
+    def cell_addressing(self, processor):
+
+        """
+            Cells of the whole case held by processor, as an array of
+            cell numbers (all cells if processor is None)
+        """
+
+        if processor is None:
+            return np.arange(self.ncells())
+        return read_label_list(os.path.join(self.fdir, "processor"+str(processor), 
+                               "constant", "polyMesh", "cellProcAddressing"))
+
+    def ncells(self):
+
+        # Number of cells in the mesh, from the note in its owner file
+        # or failing that from the blockMeshDict
+        owner = os.path.join(self.fdir, "constant", "polyMesh", "owner")
+        note = read_foamfile_header(owner).get("note", "")
+        if "nCells:" in note:
+            return int(note.split("nCells:")[1].split()[0])
+        return len(self.block_centres())
+
+    def cell_centres(self, processor=None, time="0"):
 
-        #Trigger rebuild of code
-        with cd(self.fdir):
-            clean = sp.check_output("python clean.py -f", shell=True)
-            blockMesh = sp.Popen("blockMesh", shell=True, stdout=sp.PIPE, stderr=sp.PIPE, encoding='utf8')
-            out, err = blockMesh.communicate()
-            if "not found" in err:
-                print("WARNING -- blockMesh not found, have you called SOURCEME.sh in OpenFOAM APP")
-            decomposeParDict = sp.Popen("decomposePar", shell=True, stdout=sp.PIPE, stderr=sp.PIPE, encoding='utf8')
-            out, err = decomposeParDict.communicate()
-            if "not found" in err:
-                print("WARNING -- decomposePar not found, have you called SOURCEME.sh in OpenFOAM APP")
+        """
+            Cell centres as an array of shape (ncells, 3), from the C
+            field if it has been written (with postProcess -func 
+            writeCellCentres) or otherwise for a single block mesh 
+            from blockMeshDict
+        """
+
+        C = self.field_file("C", processor, time)
+        if os.path.isfile(C):
+            return read_field(C)
+        centres = self.block_centres()
+        if processor is not None:
+            centres = centres[self.cell_addressing(processor)]
+        return centres
+
+    def block_centres(self):
+
+        # Centres of the cells of a single hex block in the order
+        # blockMesh numbers them, x fastest then y then z
+        blockMeshDict = self.HD['blockMeshDict']
+        try:
+            hexverts, ncells = blockMeshDict['blocks']['hex'][:2]
+            grading = blockMeshDict['blocks']['hex'][2]
+            vertices = np.array(blockMeshDict['vertices'], dtype=float)[hexverts]
+            grading = [float(g) for g in grading]
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise NotImplementedError("Cell centres only found from blockMeshDict "
+                                      + "for a single hex block with simpleGrading, "
+                                      + "otherwise write them with postProcess "
+                                      + "-func writeCellCentres")
+        for key in ("convertToMeters", "scale"):
+            if key in blockMeshDict:
+                vertices *= float(blockMeshDict[key])
+
+        fractions = []
+        for n, g in zip(ncells, grading):
+            if g == 1. or n == 1:
+                widths = np.ones(n)
+            else:
+                widths = g**(np.arange(n)/(n-1.))
+            edges = np.concatenate([[0.], np.cumsum(widths)])/widths.sum()
+            fractions.append(0.5*(edges[:-1] + edges[1:]))
+
+        s, t, u = [f.ravel(order='F') for f in 
+                   np.meshgrid(*fractions, indexing='ij')]
+        origin = vertices[0]
+        return (origin + np.outer(s, vertices[1] - origin) 
+                       + np.outer(t, vertices[3] - origin)
+                       + np.outer(u, vertices[4] - origin))
+
+    def set_initial_condition(self, name, function, time="0", binary=None):
+
+        """
+            Set field name from function, called with the cell centres 
+            as an array of shape (ncells, 3) and returning the value in
+            each cell, e.g. a parabolic velocity profile
+
+                def U(C):
+                    u = np.zeros(C.shape)
+                    u[:,0] = C[:,1]*(1. - C[:,1])
+                    return u
+
+                inputmod.set_initial_condition("U", U)
+
+            Written to the case and any processor folders as write_field
+        """
+
+        centres = self.cell_centres(time=time)
+        self.write_field(name, function(centres), time=time, binary=binary)
 
 
 class LineInputMod(InputMod):
@@ -563,16 +1093,36 @@ class LineInputMod(InputMod):
         
         """
 
-        replacefile = self.filename + ".new"
-        sh.copy(self.filename, self.filename+".bak")
-        with open(replacefile,'w') as new_file:
-            with open(self.filename) as old_file:
-                for line in old_file:
-                    l, found = check_replace_line(line, keyword, keyvals)
-                    new_file.write(l)
+        self.apply_changes({keyword: keyvals})
+
+    def apply_changes(self, changes):
+
+        # Make every replacement in the dictonary changes {keyword: 
+        # keyvals} in a single pass, each line is checked against every
+        # keyword in turn as if replace_input was called for each
+        if not changes:
+            return
+
+        with rewrite(self.filename) as (old_file, new_file):
+            for line in old_file:
+                for keyword, keyvals in changes.items():
+                    line, found = check_replace_line(line, keyword, keyvals)
+                new_file.write(line)
 
-        #Replace original file
-        sh.copy(replacefile, self.filename)
+    @classmethod
+    def parse_template(cls, filename):
+
+        return InputTemplate.read(filename)
+
+    def render(self, template, changes):
+
+        # As apply_changes, only checking lines of the parsed base
+        # input which contain each keyword
+        lines = list(template.lines)
+        for keyword, keyvals in changes.items():
+            for no in template.find(keyword, contains_keyword):
+                lines[no], found = check_replace_line(lines[no], keyword, keyvals)
+        write_lines(self.filename, lines)
 
 
 class LammpsInputMod(LineInputMod):
@@ -580,59 +1130,238 @@ class LammpsInputMod(LineInputMod):
         super(LammpsInputMod, self).__init__(filename)
 
 #List of Dictonary classes with added routines to add and multiple inputs
-class InputList(list):
-    def __init__(self,*arg,**kw):
-        super(InputList, self).__init__(*arg, **kw)
-
-        self.valid_chars = "-.() _%s%s" % (string.ascii_letters, string.digits)
+def input_filename(change, seperator=""):
 
-    #Define Addition operation as elementwise addition
-    def __add__(self, x):
+    """
+        Filename for the inputs in dictonary change, each key followed
+        by its value(s) with . replaced by p and anything other than
+        letters, digits and the seperator removed
+    """
 
-        if (type(x) == InputDict):
-            Listx = x.expand()
-        elif (type(x) == InputList):
-            Listx = x
+    invalid = re.compile("[^A-Za-z0-9" + re.escape(seperator) + "]")
+    filename = ''
+    for key, value in list(change.items()):
+        if type(value) is float:
+            value = np.round(value,2)
+
+        # Combine key and value with invalid characters removed
+        kvstr = key
+        if type(value) is list:
+            for v in value:
+                kvstr += seperator + str(v)
         else:
-            raise TypeError("Unsupported type " + str(type(x))  
-                            + " for input addition" + 
-                            " -- must be InputList or InputDict type")
-
-        returnlist = InputList()
-        ziplist = list(zip(self,Listx))
-        for entry in ziplist:
-            tempdict = {}
-            for dic in entry:
-                tempdict.update(dic)
-            returnlist.append(tempdict)
+            kvstr += seperator + str(value)
+        filename += invalid.sub('', kvstr.replace('.','p'))
 
-        return returnlist
+    return filename
+
+def as_sweep(x, operation="addition"):
+
+    # Sweep over the inputs of an InputList, InputDict or Sweep
+    if isinstance(x, Sweep):
+        return x
+    elif isinstance(x, InputDict):
+        return x.sweep()
+    elif isinstance(x, InputList):
+        return RowSweep(x)
+    raise TypeError("Unsupported type " + str(type(x))  
+                    + " for input " + operation + 
+                    " -- must be InputList, InputDict or Sweep type")
+
+class Sweep:
 
-    __radd__=__add__
+    """
+        Lazy sequence of input changes, one dictonary per run, as
+        built by adding (elementwise) and multiplying (all
+        permutations) InputLists and InputDicts. Nothing is expanded
+        up front: the length is worked out from the parts and row k is
+        built when asked for, so a product of many parameters can be
+        indexed, sliced, counted and iterated over without holding
+        every combination in memory.
+
+        Example usage from a higher level:
+
+            changes = (InputDict({"a": range(20)}) * InputDict({"b": range(20)})
+                       * InputDict({"c": range(20)}))
+            len(changes)            #8000
+            changes[4321]           #{'a': 10, 'b': 16, 'c': 1}
+            for change in changes[:100]:
+                ...
+
+    """
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def row(self, k):
+
+        # Dictonary of changes for row 0 <= k < len(self)
+        raise NotImplementedError
+
+    def __getitem__(self, k):
+
+        if isinstance(k, slice):
+            return IndexSweep(self, range(len(self))[k])
+        k = operator.index(k)
+        n = len(self)
+        if k < 0:
+            k += n
+        if k < 0 or k >= n:
+            raise IndexError("Sweep index out of range")
+        return self.row(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.row(k)
+
+    def __repr__(self):
+        return "<" + type(self).__name__ + " of " + str(len(self)) + " inputs>"
+
+    #Define Addition operation as elementwise addition
+    def __add__(self, x):
+        return ZipSweep([self, as_sweep(x, "addition")])
+
+    def __radd__(self, x):
+        return ZipSweep([as_sweep(x, "addition"), self])
 
     #Define multiplication operation as all permutations of inputs
     def __mul__(self, x):
+        return ProductSweep([self, as_sweep(x, "multiplication")])
 
-        if (type(x) == InputDict):
-            Listx = x.expand()  
-        elif (type(x) == InputList):
-            Listx = x
-        else:
-            raise TypeError("Unsupported type " + str(type(x))  
-                            + " for input multiplication" + 
-                            " -- must be InputList or InputDict type")
-
-        returnlist = InputList()
-        for entry1 in self:
-            for entry2 in Listx:
-                newdict = {}
-                newdict.update(entry1)
-                newdict.update(entry2)
-                returnlist.append(newdict)
+    def __rmul__(self, x):
+        return ProductSweep([as_sweep(x, "multiplication"), self])
 
-        return returnlist
+    def zip_inputs(self, x):
+        return self + x
+
+    def outer_product_inputs(self, x):
+        return self * x
+
+    def expand(self):
+
+        # Every row, as an InputList
+        return InputList(self)
+
+    def filename(self, k, seperator=""):
+        return input_filename(self[k], seperator)
+
+    def filenames(self, seperator=""):
+        return [input_filename(change, seperator) for change in self]
+
+class RowSweep(Sweep):
+
+    # Sweep over a list of dictonaries given in full
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row(self, k):
+        return dict(self.rows[k])
+
+class ValueSweep(Sweep):
+
+    # Sweep of a single key over a sequence of values
+    def __init__(self, key, values):
+        self.key = key
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def row(self, k):
+        return {self.key: self.values[k]}
+
+class IndexSweep(Sweep):
+
+    # Rows of sweep at the indices in a range, e.g. from a slice
+    def __init__(self, sweep, indices):
+        self.sweep = sweep
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def row(self, k):
+        return self.sweep.row(self.indices[k])
+
+class ZipSweep(Sweep):
+
+    """
+        Elementwise sum of sweeps, row k combining row k of each (later
+        sweeps taking precedence for keys in more than one), as long as
+        the shortest
+    """
+
+    def __init__(self, sweeps):
+        self.sweeps = []
+        for sweep in sweeps:
+            if type(sweep) is ZipSweep:
+                self.sweeps.extend(sweep.sweeps)
+            else:
+                self.sweeps.append(sweep)
+
+    def __len__(self):
+        return min(len(sweep) for sweep in self.sweeps)
+
+    def row(self, k):
+        change = {}
+        for sweep in self.sweeps:
+            change.update(sweep.row(k))
+        return change
 
-    __rmul__=__mul__
+class ProductSweep(Sweep):
+
+    """
+        Every permutation of the rows of sweeps, in the order of nested
+        loops over them with the last innermost. Row k is found from
+        the digits of k in the mixed radix of their lengths.
+    """
+
+    def __init__(self, sweeps):
+        self.sweeps = []
+        for sweep in sweeps:
+            if type(sweep) is ProductSweep:
+                self.sweeps.extend(sweep.sweeps)
+            else:
+                self.sweeps.append(sweep)
+
+    def __len__(self):
+        n = 1
+        for sweep in self.sweeps:
+            n *= len(sweep)
+        return n
+
+    def row(self, k):
+        rows = []
+        for sweep in reversed(self.sweeps):
+            k, digit = divmod(k, len(sweep))
+            rows.append(sweep.row(digit))
+        change = {}
+        for row in reversed(rows):
+            change.update(row)
+        return change
+
+class InputList(list):
+    def __init__(self,*arg,**kw):
+        super(InputList, self).__init__(*arg, **kw)
+
+        self.valid_chars = "-.() _%s%s" % (string.ascii_letters, string.digits)
+
+    #Define Addition operation as elementwise addition, giving a Sweep
+    def __add__(self, x):
+        return RowSweep(self) + as_sweep(x, "addition")
+
+    def __radd__(self, x):
+        return as_sweep(x, "addition") + RowSweep(self)
+
+    #Define multiplication operation as all permutations of inputs, giving a Sweep
+    def __mul__(self, x):
+        return RowSweep(self) * as_sweep(x, "multiplication")
+
+    def __rmul__(self, x):
+        return as_sweep(x, "multiplication") * RowSweep(self)
 
     #Define Addition operation as elementwise addition
     def zip_inputs(self, x):
@@ -651,69 +1380,38 @@ class InputList(list):
     def filenames(self, seperator=""):
 
         #Generate list containing filenames
-        filenames = []
-        for name in self:
-            filename = ''
-            for key, value in list(name.items()):
-                if type(value) is float:
-                    value = np.round(value,2)
-                if type(value) is int:
-                    value = value
-
-                # Combine key and value with invalid characters removed
-                kvstr = key
-                if type(value) is list:
-                    for v in value:
-                        kvstr += seperator + str(v)
-                else:
-                    kvstr += seperator + str(value)
-                kvstr = kvstr.replace('.','p')
-                filename = filename + (''.join(c for c in kvstr 
-                                       if c in (self.valid_chars[6:] + seperator)))
-
-            filenames.append(filename)
-
-            #print(name,filename)
-
-
-        #First remove any invalid characters
-        #filenames=[(''.join(c for c in str(name.items()) 
-        #                  if c in self.valid_chars[6:]))
-        #                  for name in self]
-         
-        return filenames
+        return [input_filename(name, seperator) for name in self]
 
 #Dictonary class with added routines to add and multiple inputs
 class InputDict(dict):
     def __init__(self,*arg,**kw):
         super(InputDict, self).__init__(*arg, **kw)
 
+    #Sweep over every permutation of the values of each key, the
+    #last key varying fastest
+    def sweep(self):
+
+        sweeps = [ValueSweep(key, values) for key, values in self.items()]
+        if len(sweeps) == 1:
+            return sweeps[0]
+        return ProductSweep(sweeps)
+
     #Expand InputDict with multiple values per entry into InputList
     def expand(self):
 
-        expansion = list(self.values())[0]
-        returnlist = InputList({list(self.keys())[0]:e} for e in expansion)
+        returnlist = InputList(self.sweep())
         
         return returnlist       
 
-    #Wrapper to convert InputDict to InputList then add
+    #Wrappers to convert InputDict to a Sweep then add or multiply
     def __add__(self, x):
+        return self.sweep() + as_sweep(x, "addition")
 
-        # Convert to lists
-        templist = self.expand()
-        returnlist = templist + x
-
-        return returnlist
-
-    __radd__=__add__
+    def __radd__(self, x):
+        return as_sweep(x, "addition") + self.sweep()
 
-    #Wrapper to convert InputDict to InputList then multiply
     def __mul__(self, x):
+        return self.sweep() * as_sweep(x, "multiplication")
 
-        # Convert to lists
-        templist = self.expand()
-        returnlist = templist * x
-
-        return returnlist
-
-    __rmul__=__mul__
+    def __rmul__(self, x):
+        return as_sweep(x, "multiplication") * self.sweep()
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+import os
+import time
+import shutil as sh
+import sqlite3
+
+def run_id(run):
+
+    return os.path.abspath(run.rundir)
+
+class StudyJournal:
+
+    """
+        Record on disk of the state of every run in a study (pending,
+        setup, running, done or failed) with its exit code, number of
+        attempts and timings, kept in an SQLite file so that it is
+        updated from any worker process and survives the driver script
+        being killed. Runs are identified by their run directory.
+
+        When the same study is launched again, runs recorded as done
+        are skipped. Runs which were part way through (or failed) are
+        cleaned up with clean_up and performed again.
+
+        Example usage from a higher level:
+
+            study = Study(threadlist, maxproc, studyfolder="study",
+                          journal=True)
+
+    """
+
+    def __init__(self, dbfile):
+
+        self.dbfile = dbfile
+        dbdir = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        self.query("CREATE TABLE IF NOT EXISTS runs "
+                   "(rundir TEXT PRIMARY KEY, state TEXT, created INTEGER, "
+                   "attempts INTEGER, returncode INTEGER, setup REAL, "
+                   "start REAL, end REAL)")
+
+    def query(self, sql, args=(), many=False):
+
+        # A new connection each time so the journal can be pickled
+        # and used from any worker process, sqlite handles locking
+        db = sqlite3.connect(self.dbfile, timeout=60)
+        try:
+            with db:
+                if many:
+                    return db.executemany(sql, args).fetchall()
+                return db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+
+    def add(self, runs):
+
+        # Runs not seen before start as pending
+        self.query("INSERT OR IGNORE INTO runs (rundir, state, attempts) "
+                   "VALUES (?, 'pending', 0)",
+                   [(run_id(run),) for run in runs], many=True)
+
+    def state(self, run):
+
+        rows = self.query("SELECT state FROM runs WHERE rundir=?",
+                          (run_id(run),))
+        if not rows:
+            return None
+        return rows[0][0]
+
+    def states(self):
+
+        # Dictonary of state for every run directory
+        return dict(self.query("SELECT rundir, state FROM runs"))
+
+    def created(self, run):
+
+        rows = self.query("SELECT created FROM runs WHERE rundir=?",
+                          (run_id(run),))
+        return bool(rows and rows[0][0])
+
+    def mark(self, run, state, returncode=None):
+
+        """
+            Record that run has reached state, along with the time
+            and for done or failed runs the exit code
+        """
+
+        now = time.time()
+        if state == "setup":
+            # Only directories made by the study are removed on resume
+            created = not os.path.isdir(run.rundir)
+            self.query("UPDATE runs SET state=?, created=MAX(IFNULL(created, 0), ?),"
+                       " setup=? WHERE rundir=?",
+                       (state, int(created), now, run_id(run)))
+        elif state == "running":
+            self.query("UPDATE runs SET state=?, start=?, attempts=attempts+1"
+                       " WHERE rundir=?", (state, now, run_id(run)))
+        elif state in ("done", "failed"):
+            self.query("UPDATE runs SET state=?, returncode=?, end=? "
+                       "WHERE rundir=?", (state, returncode, now, run_id(run)))
+        else:
+            self.query("UPDATE runs SET state=? WHERE rundir=?",
+                       (state, run_id(run)))
+
+    def summary(self):
+
+        # Number of runs in each state
+        return dict(self.query("SELECT state, COUNT(*) FROM runs GROUP BY state"))
+
+    def clean_up(self, run):
+
+        """
+            Remove what a run which did not finish left behind, so it
+            can be set up again. A run directory created by the study
+            is removed, otherwise only the output files and the linked
+            executable of a minimal copy are.
+        """
+
+        if not os.path.isdir(run.rundir):
+            pass
+        elif self.created(run):
+            sh.rmtree(run.rundir)
+        else:
+            outputfile = getattr(run, "outputfile", None)
+            leftovers = []
+            if outputfile:
+                leftovers += [outputfile, outputfile + "_err"]
+            if getattr(run, "minimalcopy", False):
+                leftovers.append(run.executable)
+            for f in leftovers:
+                path = os.path.join(run.rundir, str(f))
+                if os.path.islink(path) or os.path.isfile(path):
+                    os.remove(path)
+
+        self.mark(run, "pending")
+
+def journal_state(run, state, returncode=None):
+
+    # Record state in the journal the run was given by Study, if any
+    journal = getattr(run, "journal", None)
+    if journal is None:
+        return
+    try:
+        journal.mark(run, state, returncode)
+    except sqlite3.Error as e:
+        print("Could not record state of " + run.rundir + " in journal: " + str(e))
+
+def journal_done(run):
+
+    # True if the journal records run as done, e.g. by an earlier launch
+    journal = getattr(run, "journal", None)
+    return journal is not None and journal.state(run) == "done"
@@ -32,7 +32,8 @@ class LammpsRun(Run, metaclass=inheritdocstring):
                  extrafiles=None, 
                  finishargs={},
                  dryrun=False,
-                 deleteoutput=False):
+                 deleteoutput=False,
+                 varmode=False):
 
         #Inherit constructor from base class
         super(LammpsRun, self).__init__(srcdir=srcdir, 
@@ -58,6 +59,14 @@ class LammpsRun(Run, metaclass=inheritdocstring):
         self.restartfile = restartfile
         self.deleteoutput = deleteoutput
 
+        # In var mode changes to variables are passed to LAMMPS as
+        # -var arguments and every run reads the one input file in
+        # basedir, which is not copied (see prepare_inputs)
+        self.varmode = varmode
+        self.inputvars = {}
+        if varmode and inputfile in self.copyfiles:
+            self.copyfiles.remove(inputfile)
+
         extraargs["qscript_on_ARCHER"] = (
 """
 module load python-compute/2.7.6
@@ -102,7 +111,8 @@ cd $PBS_O_WORKDIR
             #Call build and wait until build has finished 
             #before returning control to caller
             split_cmdstg = shlex.split(cmdstg)
-            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir)      
+            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir,
+                                  env=self.get_environment())
             self.build.wait()
 
         except:
@@ -112,9 +122,103 @@ cd $PBS_O_WORKDIR
         return
 
 
+    def input_path(self):
+
+        # Input file read by this run, shared from basedir in var mode
+        if self.varmode:
+            return os.path.abspath(self.basedir+self.inputfile)
+        return self.rundir+self.inputfile
+
+    def prepare_inputs(self, extrachanges=None, **kwargs):
+
+        """
+            Make alterations to the base input file, or in var mode
+            turn changes to variables into -var arguments, e.g.
+
+                changes = {"variable maxz": "equal 1.0", "Cd": 5.0}
+
+            gives -var maxz 1.0 -var Cd 5.0. Variables set this way must
+            be declared with index style in the input, e.g.
+
+                variable maxz index 2.0
+
+            as LAMMPS ignores a later index definition of a variable 
+            given on the command line. Any other change, such as to a
+            command like read_data or to a variable not declared in the
+            input, raises a ValueError as it would otherwise be ignored.
+            The arguments are recorded in lammps.vars in the run directory.
+        """
+
+        if not self.varmode:
+            return super(LammpsRun, self).prepare_inputs(extrachanges, **kwargs)
+
+        if (extrachanges):
+            self.inputchanges.update(extrachanges)
+
+        self.inputvars = {}
+        for key, values in self.inputchanges.items():
+            split = key.split()
+            name = split[1] if (split[0] == "variable" and len(split) > 1) else split[0]
+            if type(values) is not list:
+                values = str(values).split()
+            values = [str(v) for v in values]
+            #Drop the style, "equal 1.0" is passed as 1.0
+            if len(values) > 1 and values[0] in ("equal", "index", "string"):
+                values = values[1:]
+            self.inputvars[name] = values
+
+        self.check_input_variables()
+
+        with open(self.rundir + "lammps.vars", "w") as f:
+            f.write(self.var_arguments() + "\n")
+
+    def check_input_variables(self):
+
+        # Variables set with -var must be index style in the input
+        template = self.input_template()
+        if template is None:
+            return
+        for name in self.inputvars:
+            found = template.find("variable " + name + " ", 
+                                  lambda line, kw: " ".join(line.split()[:2]) + " " == kw)
+            if not found:
+                raise ValueError("Change to " + name + " cannot be made in var mode"
+                                 + " as it is not a variable declared in "
+                                 + self.input_path())
+            for no in found:
+                split = template.lines[no].split()
+                if len(split) > 2 and split[2] != "index":
+                    raise ValueError("Variable " + name + " in " + self.input_path() 
+                                     + " must have index style to be set with -var,"
+                                     + " not " + split[2])
+        if (self.startfile != None and "startfile" not in self.inputvars
+            and not any("startfile" in line for line in template.lines)):
+            raise ValueError("In var mode the input " + self.input_path() 
+                             + " should read its start file as ${startfile}")
+
+    def var_arguments(self):
+
+        # Command line arguments setting the variables of var mode
+        args = ""
+        for name, values in self.inputvars.items():
+            args += " -var " + name + " " + " ".join(shlex.quote(v) for v in values)
+        #Relative to the run directory LAMMPS runs in, so the arguments
+        #(and the cache key from lammps.vars) are the same for every run
+        if self.startfile != None:
+            args += " -var startfile " + shlex.quote(self.startfile)
+        return args
+
+    def cache_files(self):
+
+        # In var mode the variables, in lammps.vars, determine the results
+        files = super(LammpsRun, self).cache_files()
+        if self.varmode:
+            files += [self.input_path(), self.rundir + "lammps.vars"]
+        return files
+
     def get_nprocs(self):
 
-        with open(self.rundir+self.inputfile,'r') as f:
+        with open(self.input_path(),'r') as f:
 
             for line in f:
                 if ('processors' in line):
@@ -128,6 +232,11 @@ cd $PBS_O_WORKDIR
 
     def prepare_cmd_arguments(self, fdir=''):
 
+        #Every run reads the same input, changes are passed as -var
+        if self.varmode:
+            self.cmd_args = ' -in ' + self.input_path() + self.var_arguments()
+            return self.cmd_args
+
         self.cmd_args = ' -in ' + fdir + self.inputfile
 
         #Add restart to first line of input file
@@ -162,18 +271,19 @@ cd $PBS_O_WORKDIR
                           " is ", line.split()[3]))
 
         if self.deleteoutput:
-            try:
-                os.remove(self.rundir+self.executable)
-                os.remove(self.rundir+"/"+self.restartfile)
-                if (not self.minimalcopy) and (self.srcdir != None):
-                    os.remove(self.rundir+"/src.tar")
-                os.remove(self.rundir+"/"+self.inputfile+".bak")
-                os.remove(self.rundir+"/"+self.inputfile+".new")
-                os.remove(self.rundir+"/log.lammps")
-                os.remove(self.rundir+"/lammps.out")
-                os.remove(self.rundir+"/lammps.out_err")
-            except OSError as e:
-                print(e)
+            files = [self.executable, self.restartfile, 
+                     self.inputfile+".bak", "log.lammps", 
+                     "lammps.out", "lammps.out_err", "lammps.vars"]
+            if (not self.minimalcopy) and (self.srcdir != None):
+                files.append("src.snapshot")
+            # Inputs rendered from a template leave no .bak
+            for f in files:
+                if not os.path.exists(self.rundir+"/"+f):
+                    continue
+                try:
+                    os.remove(self.rundir+"/"+f)
+                except OSError as e:
+                    print(e)
 
 
 
@@ -101,7 +101,8 @@ class MDRun(Run, metaclass=inheritdocstring):
             #Call build and wait until build has finished 
             #before returning control to caller
             split_cmdstg = shlex.split(cmdstg)
-            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir)      
+            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir,
+                                  env=self.get_environment())
             self.build.wait()
 
         except:
@@ -122,18 +123,18 @@ class MDRun(Run, metaclass=inheritdocstring):
 
     def setup(self, existscheck=False):
 
+        self.check_startfile()
+
         # Do the normal creation of the run directory
         self.create_rundir(existscheck=existscheck)
 
-        # Make a snapshot of the source code and store in a tarball
+        # Make a snapshot of the source code, shared between runs
         if not self.minimalcopy:
-            cmd = 'tar -cPf ' + self.rundir + 'src.tar ' + self.srcdir+'/*.f90'
-            print(cmd)
-            sp.Popen(cmd,shell=True)
+            self.snapshot_source(include=["*.f90"])
 
         try:
             # Copy post_proc folder from base directory (if not there already)
-            sh.copytree(self.basedir+'post_proc/',self.rundir+'post_proc/')
+            self.place_tree(self.basedir+'post_proc/',self.rundir+'post_proc/')
         except OSError:
             pass
 
@@ -144,7 +145,8 @@ class MDRun(Run, metaclass=inheritdocstring):
             if (self.basedir+f == self.rundir+f):
                 pass
             else:
-                sh.copy2(self.basedir+f, self.rundir+f)
+                self.place(self.basedir+f, self.rundir+f,
+                           private=(f == self.inputfile))
 
         # Make changes to the input file once it has been copied
         self.prepare_inputs()
@@ -270,7 +272,8 @@ class MDRun(Run, metaclass=inheritdocstring):
    
                 #Run gnuplot and generate outputs
                 cmdstr = ' gnuplot ' + value
-                gnurun = sp.Popen(shlex.split(cmdstr),cwd=self.rundir)
+                gnurun = sp.Popen(shlex.split(cmdstr),cwd=self.rundir,
+                                  env=self.get_environment())
                 print(('Running gnuplot script ' + value +
                       ' with output ' + outfile))
                 gnurun.wait()
@@ -299,7 +302,8 @@ class MDRun(Run, metaclass=inheritdocstring):
                 sh.copy(self.basedir+'reorder_restart',
                         self.rundir +'reorder_restart')
                 cmd = './reorder_restart -r ' + statefile + ' -i ' + inputfile
-                run = sp.Popen(shlex.split(cmd),cwd=self.rundir)
+                run = sp.Popen(shlex.split(cmd),cwd=self.rundir,
+                               env=self.get_environment())
                 run.wait() 
                 sh.move(self.rundir+'final_state2',
                         self.rundir+statefile)
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+import os
+import glob
+import json
+import shutil as sh
+import hashlib
+
+from simwraplib.cache import ResultCache, hash_file, link_frozen
+
+class MeshCache(ResultCache):
+
+    """
+        Cache of generated OpenFOAM meshes, keyed on a hash of the
+        dictionaries the mesh and its decomposition are generated from
+        (blockMeshDict and decomposeParDict). A run whose dictionaries
+        match an entry gets its constant/polyMesh and the mesh of every
+        processor folder from the cache, hard linked to read only
+        copies (or copied if link is False) instead of running blockMesh and decomposePar,
+        so runs differing only in transportProperties, controlDict or
+        initial conditions mesh once between them. Fields are still
+        decomposed for each run from its own 0/ folder.
+
+        Entries beyond maxsize bytes or maxentries in total are
+        evicted, least recently used first.
+
+        Example usage from a higher level:
+
+            meshcache = MeshCache("/scratch/me/meshcache", maxsize=50e9)
+            study = Study(threadlist, maxproc, meshcache=meshcache)
+
+    """
+
+    def __init__(self, cachedir, maxsize=None, maxentries=None, link=True):
+
+        super(MeshCache, self).__init__(cachedir, maxsize, maxentries)
+        self.link = link
+
+    def key(self, inputmod):
+
+        h = hashlib.sha256()
+        for name in inputmod.meshdicts + inputmod.decomposedicts:
+            # Looked up in the index of case files, as testing for the
+            # name in HD itself would parse the dictionary
+            fname = inputmod.HD.files.get(name)
+            if fname is not None:
+                h.update(name.encode())
+                h.update(hash_file(fname).encode())
+        return h.hexdigest()
+
+    def mesh_files(self, fdir):
+
+        """
+            Paths relative to case fdir of the files of its mesh and
+            of each processor's mesh, leaving out blockMeshDict which
+            older versions of OpenFOAM keep in constant/polyMesh
+        """
+
+        files = []
+        folders = ([os.path.join(fdir, "constant", "polyMesh")]
+                   + glob.glob(os.path.join(fdir, "processor*", "constant", "polyMesh")))
+        for folder in folders:
+            for root, dirs, names in os.walk(folder):
+                for name in names:
+                    if name != "blockMeshDict":
+                        files.append(os.path.relpath(os.path.join(root, name), fdir))
+        return sorted(files)
+
+    def restore(self, inputmod, key):
+
+        """
+            Put the mesh cached under key into the case of inputmod,
+            returns False if there is none
+        """
+
+        meta = os.path.join(self.entry(key), "entry.json")
+        try:
+            with open(meta) as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        #Remove the old mesh and decomposition first
+        fdir = inputmod.fdir
+        for relpath in self.mesh_files(fdir):
+            os.remove(os.path.join(fdir, relpath))
+        for folder in glob.glob(os.path.join(fdir, "processor*")):
+            sh.rmtree(folder)
+
+        copy = link_frozen if self.link else sh.copy2
+        for relpath in info["files"]:
+            dst = os.path.join(fdir, relpath)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            copy(os.path.join(self.entry(key), "files", relpath), dst)
+
+        self.mark_used(key, info)
+        return True
+
+    def store(self, inputmod, key):
+
+        # Add the mesh of the case of inputmod to the cache under key
+        fdir = inputmod.fdir
+        files = self.mesh_files(fdir)
+        if not files:
+            return
+
+        self.add_entry(key, fdir, files, {"fdir": fdir})
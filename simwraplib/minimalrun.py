@@ -5,7 +5,7 @@ import shlex
 
 from simwraplib.platform import get_platform
 from simwraplib.hpc import PBSJob
-from simwraplib.inpututils import MDInputMod 
+from simwraplib.inpututils import MDInputMod, KeywordInputMod
 from simwraplib.run import Run
 
 class MinimalRun(Run):
@@ -142,7 +142,8 @@ reconstructPar > log.reconstructPar 2>&1
             #Call build and wait until build has finished 
             #before returning control to caller
             split_cmdstg = shlex.split(cmdstg)
-            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir)
+            self.build = sp.Popen(split_cmdstg, cwd=self.srcdir,
+                                  env=self.get_environment())
             self.build.wait()
 
         except:
@@ -205,7 +206,11 @@ reconstructPar > log.reconstructPar 2>&1
 
         #Openfoam input is a sirectory, not a file. Check this
         if os.path.isdir(self.rundir+self.inputfile):
-            self.inputmod = self.inputmod(self.rundir+self.inputfile)
+            template = self.input_template()
+            if not isinstance(self.inputmod, type):
+                self.inputmod = type(self.inputmod)
+            self.inputmod = self.inputmod(self.rundir+self.inputfile, 
+                                          template=template)
         else:
             raise IOError("OpenFOAM input " + self.rundir+self.inputfile + " not found")
 
@@ -214,9 +219,12 @@ reconstructPar > log.reconstructPar 2>&1
         if (extrachanges):
             self.inputchanges.update(extrachanges)
 
-        for key in self.inputchanges:
-            values = self.inputchanges[key]
-            self.inputmod.replace_input(key, values)    
+        # All changes made before the mesh is regenerated once, and
+        # only if they affect it
+        self.inputmod.meshcache = getattr(self, "meshcache", None)
+        self.inputmod.env = self.get_environment()
+        self.inputmod.render(template, self.inputchanges)
+        self.inputmod.rebuild_mesh()
         
         return
 
@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+import os
+import stat
+import fcntl
+import fnmatch
+import shutil as sh
+import tempfile
+
+from simwraplib.cache import hash_file
+
+# ioctl to share the blocks of one file with another on filesystems
+# with copy on write (btrfs, xfs, ...), from linux/fs.h
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    sh.copystat(src, dst)
+
+def reflink_or_copy(src, dst):
+
+    try:
+        reflink(src, dst)
+    except (OSError, IOError):
+        sh.copy2(src, dst)
+
+class Population:
+
+    """
+        Populates run directories from one store of base files per
+        study, instead of a full copy of the executable, start files
+        and support folders in every run directory. Each unique file
+        (by sha256 of its contents) is copied into storedir once and
+        made read only, then placed in run directories according to
+        mode:
+
+            "hardlink" - a hard link to the stored file, falling back
+                         to a reflink or copy across filesystems
+            "reflink"  - a copy on write clone of the stored file where
+                         the filesystem supports it, otherwise a copy
+            "symlink"  - a symbolic link to the stored file
+
+        The hash of each base file is indexed in storedir/.index by
+        its path, size and modification time, so the processes of a
+        study only read a file to hash it again once it changes.
+
+        Files written by prepare_inputs (the input file or folder) or
+        matching one of the patterns in private are always given a
+        private copy. As linked files are read only, a run which tries
+        to write to any other file fails rather than changing it for
+        every run.
+
+        Example usage from a higher level:
+
+            population = Population("study/.basefiles", mode="hardlink")
+            run = MDRun(...).populate_with(population)
+
+            study = Study(threadlist, maxproc, populate="hardlink")
+
+    """
+
+    modes = ("hardlink", "reflink", "symlink")
+
+    def __init__(self, storedir, mode="hardlink", private=None):
+
+        if mode not in self.modes:
+            raise ValueError("Population mode " + str(mode) + " not one of "
+                             + ", ".join(self.modes))
+        self.storedir = os.path.abspath(storedir)
+        self.indexdir = os.path.join(self.storedir, ".index")
+        self.mode = mode
+        if private is None:
+            private = []
+        elif isinstance(private, str):
+            private = [private]
+        self.private = private
+
+    def is_private(self, path):
+
+        name = os.path.basename(path.rstrip(os.sep))
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(path, p)
+                   for p in self.private)
+
+    def store(self, src):
+
+        """
+            Path of the stored copy of file src, which is added to
+            the store if no file with the same contents is there yet
+        """
+
+        stored = os.path.join(self.storedir, hash_file(src, self.indexdir))
+        if os.path.isfile(stored):
+            return stored
+
+        # Copy in under a temporary name and link into place in one
+        # step, so concurrent runs never link a half written file or
+        # replace a file another has already linked
+        if not os.path.isdir(self.storedir):
+            os.makedirs(self.storedir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.storedir, prefix=".tmp")
+        os.close(fd)
+        try:
+            reflink_or_copy(src, tmp)
+            mode = os.stat(tmp).st_mode
+            os.chmod(tmp, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            os.link(tmp, stored)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+        return stored
+
+    def place(self, src, dst, private=False):
+
+        """
+            Put the file src at dst, linked from the store or for
+            private files copied
+        """
+
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if private or self.is_private(src):
+            sh.copy2(src, dst)
+            return dst
+
+        stored = self.store(src)
+        if self.mode == "symlink":
+            os.symlink(stored, dst)
+        elif self.mode == "reflink":
+            reflink_or_copy(stored, dst)
+        else:
+            try:
+                os.link(stored, dst)
+            except OSError:
+                reflink_or_copy(stored, dst)
+        return dst
+
+    def place_tree(self, src, dst, private=False):
+
+        # Folder src placed at dst, with every file in it placed as above
+        if private or self.is_private(src):
+            sh.copytree(src, dst)
+        else:
+            sh.copytree(src, dst, copy_function=self.place)
+        return dst
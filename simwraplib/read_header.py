@@ -1,7 +1,120 @@
 import glob
 import re
 import os 
+import copy
+import mmap
 import shutil as sh
+from collections.abc import MutableMapping
+
+from simwraplib.foamfields import (COMPONENTS, FIELD_TYPES, value_type, 
+                                   read_foamfile_header, binary_types, 
+                                   list_dtype, locate_list, parse_values)
+
+# Classes of the field files in 0/ which are read
+FIELD_CLASSES = list(FIELD_TYPES)
+
+def field_class(filename):
+
+    """
+        Class given in the FoamFile header of an OpenFOAM file (e.g.
+        volVectorField), reading no further than the header
+    """
+
+    return read_foamfile_header(filename).get("class")
+
+class NonUniformList(object):
+
+    """
+        Stands in for the values of a nonuniform list in a parsed 
+        OpenFOAM file, which can be millions of entries, recording
+        where in the file they are. The values are read into a NumPy 
+        array only if asked for with values(), by memory mapping the 
+        file, so a case can be parsed to change a few settings without
+        reading its fields. Values in binary files are read as dtype.
+    """
+
+    def __init__(self, fname, kind, count, start=None, end=None, values=None,
+                 dtype=None):
+        self.fname = fname
+        self.kind = kind
+        self.count = count
+        self.start = start
+        self.end = end
+        self.inline = values
+        self.dtype = dtype
+
+    def __len__(self):
+        return self.count or 0
+
+    def __repr__(self):
+        return "NonUniformList(" + str(self.kind) + ", " + str(self.count) + ")"
+
+    def values(self):
+
+        # Values as an array, one row per entry for vectors and tensors
+        ncomp = COMPONENTS.get(value_type(self.kind), 1)
+        if self.inline is not None:
+            return parse_values(self.inline.encode(), ncomp)
+        with open(self.fname, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                payload = mm[self.start:self.end]
+        return parse_values(payload, ncomp, self.dtype)
+
+def nonuniform_lists(header):
+
+    # Every NonUniformList anywhere in a parsed header
+    if isinstance(header, NonUniformList):
+        yield header
+    elif isinstance(header, dict):
+        for value in header.values():
+            for lst in nonuniform_lists(value):
+                yield lst
+    elif isinstance(header, list):
+        for value in header:
+            for lst in nonuniform_lists(value):
+                yield lst
+
+class LazyHeaderDict(MutableMapping):
+
+    """
+        Dictonary of parsed input files, keyed by file name, where a
+        file is only parsed the first time its entry is used. Changing
+        numberOfSubdomains then only parses decomposeParDict, not every
+        dictionary and field of the case.
+    """
+
+    def __init__(self, reader, files):
+        self.reader = reader
+        self.files = files
+        self.parsed = {}
+
+    def __getitem__(self, name):
+        if name not in self.parsed:
+            if name not in self.files:
+                raise KeyError(name)
+            self.parsed[name] = self.reader.read_header_file(self.files[name])
+        return self.parsed[name]
+
+    def __setitem__(self, name, header):
+        self.parsed[name] = header
+        if name not in self.files and "fname" in header:
+            self.files[name] = header["fname"]
+
+    def __delitem__(self, name):
+        if name not in self.files and name not in self.parsed:
+            raise KeyError(name)
+        self.files.pop(name, None)
+        self.parsed.pop(name, None)
+
+    def __iter__(self):
+        for name in self.files:
+            yield name
+        for name in self.parsed:
+            if name not in self.files:
+                yield name
+
+    def __len__(self):
+        return len(set(self.files) | set(self.parsed))
 
 class openfoam_HeaderData:
 
@@ -27,7 +140,6 @@ class openfoam_HeaderData:
         headerfiles = self.get_header_files()
                       #["blockMeshDict", "transportProperties", "controlDict", 
                       #  "environmentalProperties", "decomposeParDict"]
-        fieldfiles = self.get_field_files()
         
         if readfields:
             fieldfiles = self.get_field_files()
@@ -35,15 +147,56 @@ class openfoam_HeaderData:
         else:
             readfiles = headerfiles
 
-        headerDict = {}
+        # Files are only parsed when their header is first used
+        files = {}
         for filename in readfiles:
             if os.path.isfile(filename):
-                with open(filename) as f:
-                    lines = self.lines_generator_strip(f)
-                    header = self.header_parser(lines)
-                    header["fname"] = filename
-                headerDict[filename.split("/")[-1]] = header
-        self.headerDict = headerDict
+                files[filename.split("/")[-1]] = filename
+        self.headerDict = LazyHeaderDict(self, files)
+
+    def read_header_file(self, filename):
+
+        """
+            Parse one input file into a dictonary, leaving the values
+            of any nonuniform lists in the file (see NonUniformList)
+        """
+
+        self.types = binary_types(read_foamfile_header(filename))
+        with open(filename, 'rb') as f:
+            self.fobj = f
+            self.fname = filename
+            try:
+                lines = self.lines_generator_strip(self.lines_decoded(f))
+                header = self.header_parser(lines)
+            finally:
+                self.fobj = None
+        header["fname"] = filename
+        return header
+
+    def copy_to(self, fdir):
+
+        """
+            Copy of this header data for a copy of the case in fdir,
+            without parsing its files again
+        """
+
+        if (fdir[-1] != '/'): fdir += '/'
+        new = copy.deepcopy(self)
+        new.fdir = fdir
+
+        def moved(fname):
+            if fname.startswith(self.fdir):
+                return fdir + fname[len(self.fdir):]
+            return fname
+
+        HD = new.headerDict
+        for name, fname in HD.files.items():
+            HD.files[name] = moved(fname)
+        for header in HD.parsed.values():
+            header["fname"] = moved(header.get("fname", ""))
+            for lst in nonuniform_lists(header):
+                lst.fname = moved(lst.fname)
+        return new
 
     def get_header_files(self):
         paths = [self.fdir + f for f in ['constant', 'system']]
@@ -59,28 +212,24 @@ class openfoam_HeaderData:
 
     def get_field_files(self):
 
+        # Field files in 0/, identified by the class in their FoamFile
+        # header so the (possibly very large) field data is not read
         path = self.fdir + "0/"
         files = glob.glob(path + "/*")
         filenames = []
         for filename in files:
-            try:
-                with open(filename) as f:
-                    for line in f:
-                        if "class" in line:
-                            fname = filename.split("/")[-1]
-                            if "volScalarField" in line:
-                                filenames.append(filename)
-                            elif "volVectorField":
-                                filenames.append(filename)
-                            elif "volSymmTensorField":
-                                filenames.append(filename)
-                            else:
-                                continue
-            except IOError:
-                pass
+            if field_class(filename) in FIELD_CLASSES:
+                filenames.append(filename)
 
         return filenames
 
+    def lines_decoded(self, f, encoding='utf8'):
+
+        # Lines of file f opened in binary, so the position in the
+        # file is known when skipping the data of nonuniform lists
+        for line in iter(f.readline, b""):
+            yield line.decode(encoding, 'replace')
+
     def lines_generator(self, lines):
         for line in lines:
             if not line:
@@ -154,7 +303,9 @@ class openfoam_HeaderData:
             #Otherwise we have to parse as needed
             elif len(split) > 2:
                 key = split[0]
-                if ("[" in line):
+                if (split[1] == "nonuniform" and type(Out) is dict):
+                    Out[key] = self.skip_list(line)
+                elif ("[" in line):
                     indx = line.find("]")
                     afterunits = line[indx+1:].replace(";","")
                     Out[key] = self.stringtolist(afterunits)
@@ -184,6 +335,51 @@ class openfoam_HeaderData:
 
         return Out
 
+    def skip_list(self, line):
+
+        """
+            Skip over the values of a nonuniform list which starts on 
+            line, e.g.
+
+                internalField   nonuniform List<vector> 
+                400
+                (
+                (0 0 0)
+                ...
+                )
+                ;
+
+            returning a NonUniformList recording where they are in 
+            the file rather than the values themselves
+        """
+
+        split = line.rstrip(";").split()
+        kind = split[2] if len(split) > 2 else None
+
+        #Short lists may be written on one line, e.g. 2(1 2)
+        if ")" in line:
+            indx = line.find("(")
+            count = re.match(r"\d*", " ".join(split[3:])).group()
+            return NonUniformList(self.fname, kind, 
+                                  int(count) if count else None,
+                                  values=line[indx:].rstrip(";"))
+
+        f = self.fobj
+        dtype = list_dtype(self.types, kind)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count, start, closing = locate_list(mm, f.tell(), 
+                                        COMPONENTS.get(value_type(kind), 1), dtype)
+
+        #Carry on parsing after the list and any ; closing the entry
+        f.seek(closing)
+        if f.readline().strip() in (b")", b");"):
+            position = f.tell()
+            if f.readline().strip() != b";":
+                f.seek(position)
+
+        return NonUniformList(self.fname, kind, count, start, closing, 
+                              dtype=dtype)
+
     def find_nth(self, haystack, needle, n):
         start = haystack.find(needle)
         while start >= 0 and n > 1:
@@ -197,17 +393,43 @@ class openfoam_HeaderData:
         try:
             fname = ChangeDict["fname"]
             sh.copy(fname, fname+".bak")
-            #Create temp file
-            with open(fname+"new",'w+') as new_file:
-                with open(fname) as old_file:
-                    lines = self.lines_generator(old_file)
-                    self.header_change(lines, new_file, ChangeDict)
+            #Create temp file, read and written as latin-1 without
+            #newline translation so every byte not changed, including
+            #binary list data, is copied as it is
+            self.types = binary_types(read_foamfile_header(fname))
+            with open(fname+"new",'w', encoding='latin-1', newline='') as new_file:
+                with open(fname, 'rb') as old_file:
+                    self.fobj = old_file
+                    try:
+                        lines = self.lines_generator(
+                                    self.lines_decoded(old_file, 'latin-1'))
+                        self.header_change(lines, new_file, ChangeDict)
+                    finally:
+                        self.fobj = None
 
         except KeyError:
             raise KeyError("fname not found in dictonary, specify a file dictonary")
 
         sh.move(fname+"new", fname)
 
+    def copy_list(self, new_file, kind):
+
+        """
+            Copy the values of a nonuniform list of kind, from the
+            current position in the file being changed up to and 
+            including the line closing the list, to new_file. Binary
+            values are copied by their length, not read as lines.
+        """
+
+        f = self.fobj
+        dtype = list_dtype(self.types, kind)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count, start, closing = locate_list(mm, f.tell(), 
+                                        COMPONENTS.get(value_type(kind), 1), dtype)
+            new_file.write(mm[f.tell():closing].decode('latin-1'))
+        f.seek(closing)
+        new_file.write(f.readline().decode('latin-1'))
+
     def header_change(self, lines, new_file, ChangeDict):
         ft = True
         prevline = ""
@@ -275,8 +497,15 @@ class openfoam_HeaderData:
                 #Otherwise we have to parse as needed
                 elif len(split) > 2:
                     key = split[0]
+                    #Values of nonuniform lists are copied unchanged
+                    if (split[1] == "nonuniform" and type(Out) is dict):
+                        new_file.write(l)
+                        if ")" not in line:
+                            self.copy_list(new_file, split[2])
+                        prevline = line
+                        continue
                     #Read units
-                    if ("[" in line):
+                    elif ("[" in line):
                         indx = line.find("]")
                         afterunits = line[indx+1:].replace(";","")
                         Out[key] = self.stringtolist(afterunits)
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+import os
+import re
+import subprocess as sp
+
+# Failures of the launcher or machine rather than of the run itself,
+# which are worth trying again
+TRANSIENT = [r"ORTE (was unable|has lost communication|does not know)",
+             r"mpirun was unable to (launch|start|find)",
+             r"There are not enough slots available",
+             r"HYD\w*_\w+.*(error|failed)",
+             r"PMIx? ?\w*.*(error|failed)",
+             r"(unable to|could not) (connect|reach|contact)",
+             r"Connection (refused|reset|timed out)",
+             r"Resource temporarily unavailable",
+             r"Stale (NFS )?file handle",
+             r"Cannot allocate memory",
+             r"oom-kill|Out of memory"]
+
+# Failures which will happen again however many times the run is tried
+PERMANENT = [r"Segmentation fault|SIGSEGV|signal 11",
+             r"Floating point exception|SIGFPE",
+             r"No such file or directory",
+             r"FOAM FATAL (IO )?ERROR",
+             r"^ERROR( on proc \d+)?:",
+             r"Input error|Unknown keyword|syntax error"]
+
+class RetryPolicy:
+
+    """
+        How to respond to a run which fails, the run is tried up to
+        attempts times in total if its failure is transient, waiting
+        backoff seconds before the first retry and factor times longer
+        before each one after that (up to maxdelay). Licenses are not
+        held while waiting, so the rest of the study carries on.
+
+        A failure is sorted into transient (e.g. an MPI launch error
+        or node hiccup) or permanent by scanning the run's standard
+        error (outputfile_err in the rundir) and the error raised for
+        the regular expressions in permanent and then transient, which
+        default to PERMANENT and TRANSIENT. Failures matching neither
+        are treated as default. Errors raised before the executable
+        is started (e.g. in setup) are always permanent.
+
+        Example usage from a higher level:
+
+            policy = RetryPolicy(attempts=5, backoff=60.)
+            run = MDRun(...).retry_with(policy)
+
+            study = Study(threadlist, maxproc, retry=RetryPolicy())
+
+    """
+
+    def __init__(self, attempts=3, backoff=10., factor=2., maxdelay=600.,
+                 transient=None, permanent=None, default="permanent"):
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.maxdelay = maxdelay
+        if transient is None:
+            transient = TRANSIENT
+        if permanent is None:
+            permanent = PERMANENT
+        self.transient = [re.compile(p, re.MULTILINE) for p in transient]
+        self.permanent = [re.compile(p, re.MULTILINE) for p in permanent]
+        self.default = default
+
+    def classify(self, run, error):
+
+        """
+            Return "transient" or "permanent" for error raised by run
+        """
+
+        if not isinstance(error, sp.CalledProcessError):
+            return "permanent"
+
+        text = str(error.cmd)
+        stderrfile = run.rundir + run.outputfile + "_err"
+        if os.path.isfile(stderrfile):
+            with open(stderrfile, "r") as f:
+                text += "\n" + f.read()
+
+        if any(p.search(text) for p in self.permanent):
+            return "permanent"
+        if any(p.search(text) for p in self.transient):
+            return "transient"
+        return self.default
+
+    def delay(self, attempt):
+
+        # Seconds to wait before trying again after attempt failed
+        return min(self.backoff*self.factor**(attempt-1), self.maxdelay)
+
+    def retry(self, run, error, attempt):
+
+        """
+            Seconds to wait before trying run again after its attempt
+            failed with error, or None if it should not be tried again
+        """
+
+        if attempt >= self.attempts:
+            return None
+        kind = self.classify(run, error)
+        if kind != "transient":
+            return None
+
+        delay = self.delay(attempt)
+        print("Run in " + run.rundir + " failed with a transient error (attempt "
+              + str(attempt) + " of " + str(self.attempts) + "), retrying in "
+              + str(delay) + " seconds")
+        return delay
+
+def retry_delay(run, error):
+
+    """
+        Count a failed attempt of run and return the seconds to wait
+        before trying it again under its retry policy, or None if it
+        should not be
+    """
+
+    run.attempts = getattr(run, "attempts", 0) + 1
+    policy = getattr(run, "retry", None)
+    if policy is None:
+        return None
+    return policy.retry(run, error, run.attempts)
@@ -6,10 +6,15 @@ import subprocess as sp
 import inspect
 import shlex
 import sys
+import tarfile
 
 import simwraplib.userconfirm as uc
 from simwraplib.platform import get_platform
 from simwraplib.hpc import PBSJob
+from simwraplib.affinity import binding
+from simwraplib.source import archive_source
+from simwraplib.inpututils import get_template
+from simwraplib.environment import Environment, run_environment
 
 def get_subprocess_error(e):
     print("subprocess ERROR")
@@ -71,7 +76,8 @@ class Run(object):
                                FROM THE BASE DIRECTORY
                 restartfile  - initial state "restart" file, assumed to be
                                already located at the given path that is
-                               RELATIVE TO THE RUN DIRECTORY
+                               RELATIVE TO THE RUN DIRECTORY, which need
+                               only exist once the run is set up
    
             New files: 
 
@@ -216,13 +222,13 @@ class Run(object):
                 self.startfile = initstate
             else:
                 raise IOError("initstate "+self.basedir+initstate+" not found")
+        #A restart file may be written by a run this one depends on, 
+        #so it is only checked for once the run is set up
         elif (restartfile != None):
-            if os.path.isfile(self.basedir+restartfile):
-                self.startfile = restartfile
-            else:
-                raise IOError("restartfile "+self.basedir+restartfile+" not found")
+            self.startfile = restartfile
         else:
             self.startfile = None
+        self.restartfile = restartfile
 
         if (extrafiles):
             if type(extrafiles) is str:
@@ -237,6 +243,17 @@ class Run(object):
         self.dryrun = dryrun
         self.deleteoutput = deleteoutput
         self.minimalcopy = minimalcopy # If true, copy only input
+        self.dependencies = [] # Runs which must finish first, see depends_on
+        self.cores = None # Cores to bind to, set by the Study scheduler
+        self.resources = {} # Memory, licenses etc needed, see requires
+        self.setupprocs = 1 # Processors used by setup, see setup_requires
+        self.setupresources = {}
+        self.retry = None # RetryPolicy for failures, see retry_with
+        self.attempts = 0 # Failed attempts at this run so far
+        self.setup_done = False # Set up by this process, see thread.setup_run
+        self.population = None # Shared store of base files, see populate_with
+        self.environment = None # Captured setup environment, see use_environment
+        self.sources = None # Shared SourceSnapshot, otherwise src.tar in rundir
 
         # Keep a list of files to iterate over later
         if type(executable) is str:
@@ -283,7 +300,8 @@ class Run(object):
             #before returning control to caller
             split_cmdstg = shlex.split(cmdstg)
             if self.srcdir != None:
-                self.build = sp.Popen(split_cmdstg, cwd=self.srcdir)      
+                self.build = sp.Popen(split_cmdstg, cwd=self.srcdir,
+                                      env=self.get_environment())
                 self.build.wait()
             else:
                 raise OSError("src directory not specified, cannot build")
@@ -291,6 +309,179 @@ class Run(object):
             print("Build Failed, try building manually before running simwraplib")
             raise
 
+    def depends_on(self, *runs):
+
+        """
+            Declare other runs which must have finished successfully
+            before this one starts, when performed by a Study with
+            dag=True. Returns self so calls can be chained.
+
+        """
+
+        self.dependencies.extend(runs)
+
+        return self
+
+    def requires(self, **resources):
+
+        """
+            Declare resources other than processors this run needs
+            while it executes, e.g. run.requires(memory=8000) for 
+            memory in MB or run.requires(licenses=1). A Study given
+            capacities for these only starts the run once all are 
+            free. Returns self so calls can be chained.
+
+        """
+
+        self.resources.update(resources)
+
+        return self
+
+    def setup_requires(self, nprocs=1, **resources):
+
+        """
+            Declare the processors and other resources this run's 
+            setup uses (e.g. meshing or compiling), which are acquired
+            from the Study scheduler like those for execution so setups
+            do not oversubscribe the machine. Defaults to a single
+            processor, nprocs=0 with no resources lets setup start
+            straight away. Returns self so calls can be chained.
+
+        """
+
+        self.setupprocs = nprocs
+        self.setupresources = dict(resources)
+
+        return self
+
+    def get_setup_needs(self):
+
+        # Processors and dictonary of other resources used by setup
+        return (getattr(self, "setupprocs", 1), 
+                dict(getattr(self, "setupresources", {})))
+
+    def retry_with(self, policy):
+
+        """
+            Try this run again after transient failures according to
+            policy, a RetryPolicy. Returns self so calls can be chained.
+
+        """
+
+        self.retry = policy
+
+        return self
+
+    def populate_with(self, population):
+
+        """
+            Link the files copied from the base directory into the
+            run directory from the shared store of population, a
+            Population, rather than copying them for every run. 
+            Returns self so calls can be chained.
+
+        """
+
+        self.population = population
+
+        return self
+
+    def use_environment(self, environment):
+
+        """
+            Run every subprocess of this run (build, setup utilities 
+            and the run itself) in environment, an Environment captured
+            from a setup script (or the name of the script), instead of
+            the environment of this process. 
+            Returns self so calls can be chained.
+
+        """
+
+        if isinstance(environment, str):
+            environment = Environment(environment)
+        self.environment = environment
+
+        return self
+
+    def get_environment(self):
+
+        # Environment for subprocesses, None to inherit this process's
+        return run_environment(self)
+
+    def place(self, src, dst, private=False):
+
+        # Copy a base file into the run directory, or link it from the
+        # population store unless private (e.g. the input file)
+        population = getattr(self, "population", None)
+        if population is None:
+            sh.copy2(src, dst)
+        else:
+            population.place(src, dst, private=private)
+
+    def place_tree(self, src, dst, private=False):
+
+        # As place for a folder and everything in it
+        population = getattr(self, "population", None)
+        if population is None:
+            sh.copytree(src, dst)
+        else:
+            population.place_tree(src, dst, private=private)
+
+    def get_resources(self):
+
+        """
+            Dictonary of resources other than processors needed by
+            this run. Anything not declared with requires is inferred
+            by the Study from its per processor defaults.
+        """
+
+        return dict(getattr(self, "resources", {}))
+
+    def get_features(self):
+
+        """
+            Numeric input parameters which set the size of this run
+            (e.g. number of cells, density or domain size), used to 
+            predict its runtime from previous runs (see RuntimeHistory).
+            Taken from inputchanges, where a list of numbers gives its
+            product, e.g. total cells from the cells in each direction.
+        """
+
+        features = {}
+        for key, value in self.inputchanges.items():
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            try:
+                size = 1.
+                for v in value:
+                    size *= float(v)
+            except (TypeError, ValueError):
+                continue
+            features[str(key)] = size
+
+        return features
+
+    def cache_files(self):
+
+        """
+            Paths of every file which determines the results of this
+            run, used to recognise an identical run (see ResultCache): 
+            the executable, the files copied from the base directory 
+            and the input file once modified by prepare_inputs.
+        """
+
+        files = []
+        if getattr(self, "executable_on_path", False):
+            files.append(which(self.executable))
+        for f in getattr(self, "copyfiles", [self.executable, self.inputfile]):
+            if f == self.inputfile:
+                files.append(self.rundir + f)
+            elif not (getattr(self, "executable_on_path", False) 
+                      and f == self.executable):
+                files.append(self.basedir + f)
+
+        return files
+
     def copyfile(self, f):
 
         if f is None:
@@ -311,7 +502,8 @@ class Run(object):
             if os.path.isdir(self.rundir+f):
                 self.remove_directory(folder=self.rundir+f, confirm=False)
             try:
-                sh.copytree(self.basedir+f, self.rundir+f)
+                self.place_tree(self.basedir+f, self.rundir+f,
+                                private=(f == self.inputfile))
             except OSError:
                 raise OSError("Error copying folder base = " + self.basedir+f
                                 + " to run = " + self.rundir+f)
@@ -325,21 +517,30 @@ class Run(object):
                     if exc.errno != errno.EEXIST:
                         raise
             try:
-                sh.copy(self.basedir+f, self.rundir+f)
+                self.place(self.basedir+f, self.rundir+f,
+                           private=(f == self.inputfile))
             except OSError:
                 raise OSError("Error copying file = " + self.basedir+d
                                     + " to run dir = " + self.rundir)
     
+    def check_startfile(self):
+
+        # Restart files may be written after the run is created, by a
+        # run it depends on, so must exist by the time it is set up
+        if (self.restartfile != None 
+            and not os.path.isfile(self.basedir+self.restartfile)):
+            raise IOError("restartfile "+self.basedir+self.restartfile+" not found")
+
     def setup(self, existscheck=False):
 
+        self.check_startfile()
+
         # Do the normal creation of the run directory
         self.create_rundir(existscheck=existscheck)
 
-        # Make a snapshot of the source code and store in a tarball
+        # Make a snapshot of the source code, shared between runs
         if not self.minimalcopy:
-            if self.srcdir != None:
-                cmd = 'tar -cPf ' + self.rundir + 'src.tar ' + self.srcdir
-                sp.Popen(cmd, shell=True)
+            self.snapshot_source()
 
         # Copy files and save new locations to instance variables
         for f in self.copyfiles:
@@ -357,6 +558,29 @@ class Run(object):
         # Make changes to the input file once it has been copied
         self.prepare_inputs()
 
+    def snapshot_source(self, include=None):
+
+        """
+            Record the state of the source code in srcdir (only files
+            with names matching include if given). By default it is
+            archived in src.tar in the run directory, so the run is
+            self contained. Runs given a SourceSnapshot (see Study's
+            sources) only record which shared snapshot they used, in
+            src.snapshot, with the snapshot itself kept once for every
+            run with the same source.
+        """
+
+        if self.srcdir is None:
+            return
+        sources = getattr(self, "sources", None)
+        try:
+            if sources is None:
+                archive_source(self.srcdir, self.rundir + "src.tar", include)
+            else:
+                sources.record(self, include)
+        except (IOError, OSError, tarfile.TarError) as e:
+            print("Could not snapshot source in " + self.srcdir + ": " + str(e))
+
     def prepare_inputs(self, extrachanges=None, **kwargs):
 
         """
@@ -375,14 +599,38 @@ class Run(object):
         if (extrachanges):
             self.inputchanges.update(extrachanges)
 
-        for key in self.inputchanges:
-            values = self.inputchanges[key]
-            print("run prepare_inputs, key=", key, "values=",values)
-
-            mod.replace_input(key, values)    
+        # Written from the base input parsed once, where the input
+        # modifier supports it, otherwise all changes made in one pass
+        # over the input file
+        template = self.input_template()
+        if template is not None:
+            mod.render(template, self.inputchanges)
+        else:
+            mod.apply_changes(self.inputchanges)
         
         return
 
+    def input_template(self):
+
+        """
+            The base input file parsed by the input modifier, shared by
+            every run in this process set up from the same base input,
+            or None if the modifier does not support it
+        """
+
+        inputfile = getattr(self, "inputfile", None)
+        inputmod = getattr(self, "inputmod", None)
+        if inputfile is None or inputmod is None:
+            return None
+        if not isinstance(inputmod, type):
+            inputmod = type(inputmod)
+        if getattr(inputmod, "parse_template", None) is None:
+            return None
+        base = self.basedir+inputfile
+        if not os.path.exists(base):
+            return None
+        return get_template(inputmod, base)
+
     def create_rundir(self, existscheck=False, **kwargs):
 
         # Create run directory (and results dir inside it). If it already
@@ -467,6 +715,19 @@ class Run(object):
     def get_nprocs(self, *args, **kwargs):  
         raise NotImplementedError
 
+    def prepare_binding(self, nprocs):
+
+        """
+            Command prefix and mpiexec options which bind the run to 
+            the cores in self.cores (see affinity.binding), empty 
+            unless the run is local and has been given cores.
+        """
+
+        if (getattr(self, "cores", None) is None or self.platform != 'local'):
+            return "", ""
+
+        return binding(self.cores, nprocs, self.prepare_mpiexec())
+
     def prepare_cmd_string(self, executable, nprocs, extra_cmds=""):
 
         self.mpiexec = self.prepare_mpiexec()
@@ -476,12 +737,15 @@ class Run(object):
         if (".py" in executable) and not ("python" in executable):
              executable = "python " + executable
 
+        #Bind to cores given by the scheduler, if any
+        prefix, bind_opts = self.prepare_binding(nprocs)
+
         if self.cmd_includes_procs():
-            cmd = (self.mpiexec + " -n " + str(nprocs) 
+            cmd = (prefix + self.mpiexec + " -n " + str(nprocs) + bind_opts
                    + " "  + executable + " " + cmd_args
                    + " " + extra_cmds)
         else:
-            cmd = (self.mpiexec + " " + executable 
+            cmd = (prefix + self.mpiexec + bind_opts + " " + executable 
                    + " " + cmd_args + " " + extra_cmds)
 
 
@@ -575,7 +839,8 @@ class Run(object):
             if print_output:
                 self.proc = sp.Popen(split_cmdstg, cwd=self.rundir, stdin=None, 
                                      stdout=sp.PIPE, stderr=sp.STDOUT, 
-                                     universal_newlines=True, shell=shell)
+                                     universal_newlines=True, shell=shell,
+                                     env=self.get_environment())
                 for stdout_line in iter(self.proc.stdout.readline, ""):
                     lastline = stdout_line.replace("\n","")
                     print(lastline)
@@ -588,17 +853,22 @@ class Run(object):
 
                 #Execute subprocess and create subprocess object
                 self.proc = sp.Popen(split_cmdstg, cwd=self.rundir, stdin=None, 
-                                     stdout=fstout, stderr=fsterr, shell=shell)
+                                     stdout=fstout, stderr=fsterr, shell=shell,
+                                     env=self.get_environment())
             else:
                 self.CalledProcessError = sp.CalledProcessError
                 self.proc = sp.Popen(split_cmdstg, cwd=self.rundir, stdin=None, 
                                      stdout=sp.PIPE, stderr=sp.PIPE, 
-                                     universal_newlines=True, shell=shell)
+                                     universal_newlines=True, shell=shell,
+                                     env=self.get_environment())
 
 
             #If blocking, wait here
             if blocking:
                 return_code = self.proc.wait()
+                if not print_output and out_to_file:
+                    fstout.close()
+                    fsterr.close()
                 if return_code:
                     if not print_output:
                         with open(stderrfile, "r") as f:
@@ -613,6 +883,63 @@ class Run(object):
 
         return
 
+    async def execute_async(self, nprocs=0, shell=False, extra_cmds=""):
+
+        """
+            Coroutine version of execute which runs the executable as
+            an asyncio subprocess, so a single event loop can supervise
+            many runs. Output is written to outputfile and outputfile_err
+            and the exit code stored as self.returncode. Raises
+            CalledProcessError if the run fails, as execute_local does
+            when blocking.
+        """
+
+        import asyncio
+
+        # Job submission blocks on qstat so keep it off the event loop
+        if ("cx" in self.platform or "archer" in self.platform):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, lambda:
+                  self.execute_pbs(blocking=True, extra_cmds=extra_cmds))
+            return 0
+
+        # Store the number of processors required
+        if nprocs==0:
+            nprocs = self.get_nprocs()
+
+        cmd = self.prepare_cmd_string(self.executable, nprocs,
+                                      extra_cmds=extra_cmds)
+
+        #Setup standard out and standard error files
+        stdoutfile = self.rundir+self.outputfile
+        stderrfile = self.rundir+self.outputfile+'_err'
+
+        if (self.dryrun):
+            print('DRYRUN -- no execution in ' + self.rundir + ' \nRun would be: ' + cmd)
+            self.returncode = 0
+            return self.returncode
+
+        print(self.rundir + '    :    ' + cmd)
+        with open(stdoutfile,'w') as fstout, open(stderrfile,'w') as fsterr:
+            if shell:
+                self.proc = await asyncio.create_subprocess_shell(cmd,
+                                 cwd=self.rundir, stdin=None,
+                                 stdout=fstout, stderr=fsterr,
+                                 env=self.get_environment())
+            else:
+                self.proc = await asyncio.create_subprocess_exec(
+                                 *shlex.split(cmd), cwd=self.rundir,
+                                 stdin=None, stdout=fstout, stderr=fsterr,
+                                 env=self.get_environment())
+            self.returncode = await self.proc.wait()
+
+        if self.returncode:
+            with open(stderrfile, "r") as f:
+                error = f.read()
+            raise sp.CalledProcessError(self.returncode, cmd + "\n" + error)
+
+        return self.returncode
+
 #    def execute_local(self, blocking=False, nprocs=0, 
 #                      print_output=False, extra_cmds=""):
 
@@ -805,7 +1132,8 @@ class Run(object):
    
                 #Run gnuplot and generate outputs
                 cmdstr = ' gnuplot ' + value
-                gnurun = sp.Popen(shlex.split(cmdstr),cwd=self.rundir)
+                gnurun = sp.Popen(shlex.split(cmdstr),cwd=self.rundir,
+                                  env=self.get_environment())
                 print('Running gnuplot script ' + value +
                       ' with output ' + outfile)
                 gnurun.wait()
@@ -834,7 +1162,8 @@ class Run(object):
                 sh.copy(self.basedir+'reorder_restart',
                         self.rundir +'reorder_restart')
                 cmd = './reorder_restart -r ' + statefile + ' -i ' + inputfile
-                run = sp.Popen(shlex.split(cmd),cwd=self.rundir)
+                run = sp.Popen(shlex.split(cmd),cwd=self.rundir,
+                               env=self.get_environment())
                 run.wait() 
                 sh.move(self.rundir+'final_state2',
                         self.rundir+statefile)
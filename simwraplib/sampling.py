@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+import numpy as np
+
+from simwraplib.inpututils import InputList
+
+# Primitive polynomials (degree s, coefficients a) and initial direction
+# numbers m for Sobol dimensions 2 onwards, from Joe and Kuo's
+# new-joe-kuo-6.21201 table. Dimension 1 is the van der Corput sequence.
+SOBOL_TABLE = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+    (7, 4, [1, 3, 7, 13, 13, 15, 69]),
+]
+
+# Bits in each Sobol coordinate, enough for 2**30 points
+SOBOL_BITS = 30
+
+class Parameter:
+
+    """
+        Range of values of one input, from low to high. Integer
+        parameters take whole values from low to high inclusive, log
+        parameters are spread evenly in log(value) rather than value.
+        Values are rounded to sigfigs significant figures or to
+        decimals places if either is given.
+
+        Example usage from a higher level:
+
+            parameters = {"LIQUIDDENSITY": (0.6, 0.85),
+                          "INPUTTEMPERATURE": Parameter(0.5, 2.5, sigfigs=3),
+                          "NSTEPS": Parameter(1000, 100000, integer=True, log=True)}
+
+    """
+
+    def __init__(self, low, high, integer=False, log=False,
+                 sigfigs=None, decimals=None):
+
+        if high < low:
+            raise ValueError("Parameter range " + str((low, high))
+                             + " has high below low")
+        if log and low <= 0:
+            raise ValueError("Log scale parameter range " + str((low, high))
+                             + " must be positive")
+        self.low = low
+        self.high = high
+        self.integer = integer
+        self.log = log
+        self.sigfigs = sigfigs
+        self.decimals = decimals
+
+    def values(self, u):
+
+        """
+            Values of the parameter at positions u (an array of
+            numbers in [0, 1)) through its range
+        """
+
+        low, high = self.low, self.high
+        if self.integer:
+            #Each whole value gets an equal share of [0, 1)
+            high = high + 1
+        if self.log:
+            values = np.exp(np.log(low) + u*(np.log(high) - np.log(low)))
+        else:
+            values = low + u*(high - low)
+
+        if self.integer:
+            return np.clip(np.floor(values), self.low, self.high).astype(int)
+        if self.sigfigs is not None:
+            scale = np.floor(np.log10(np.where(values == 0, 1, np.abs(values))))
+            decimals = self.sigfigs - 1 - scale
+            values = np.round(values*10**decimals)/10**decimals
+        if self.decimals is not None:
+            values = np.round(values, self.decimals)
+        return values
+
+def as_parameter(spec):
+
+    # Parameter from a Parameter or a (low, high) pair
+    if isinstance(spec, Parameter):
+        return spec
+    low, high = spec
+    return Parameter(low, high)
+
+def design(parameters, unit):
+
+    """
+        InputList with one dictonary of changes per row of unit, an
+        array of positions in [0, 1) with a column per parameter
+    """
+
+    names = list(parameters.keys())
+    columns = [as_parameter(parameters[name]).values(unit[:, i]).tolist()
+               for i, name in enumerate(names)]
+    return InputList(dict(zip(names, row)) for row in zip(*columns))
+
+def latin_hypercube(parameters, n, seed=None):
+
+    """
+        n samples of parameters (a dictonary of Parameters or (low,
+        high) ranges, by input name) as an InputList. The range of
+        each parameter is split into n equal intervals with one sample
+        in each, paired at random between parameters.
+    """
+
+    rng = np.random.default_rng(seed)
+    d = len(parameters)
+    strata = np.argsort(rng.random((n, d)), axis=0)
+    unit = (strata + rng.random((n, d)))/n
+    return design(parameters, unit)
+
+def sobol_directions(d):
+
+    # Direction numbers as integers of SOBOL_BITS bits, one row per dimension
+    if d > len(SOBOL_TABLE) + 1:
+        raise ValueError("Sobol sampling supports at most "
+                         + str(len(SOBOL_TABLE) + 1) + " parameters")
+    v = np.zeros((d, SOBOL_BITS), dtype=np.int64)
+    v[0] = 1 << np.arange(SOBOL_BITS - 1, -1, -1)
+    for dim in range(1, d):
+        s, a, m = SOBOL_TABLE[dim - 1]
+        m = list(m)
+        for j in range(s, SOBOL_BITS):
+            new = m[j - s] ^ (m[j - s] << s)
+            for k in range(1, s):
+                if (a >> (s - 1 - k)) & 1:
+                    new ^= m[j - k] << k
+            m.append(new)
+        v[dim] = [m[j] << (SOBOL_BITS - 1 - j) for j in range(SOBOL_BITS)]
+    return v
+
+def sobol(parameters, n, seed=None):
+
+    """
+        The first n points of the Sobol sequence over parameters (a
+        dictonary of Parameters or (low, high) ranges, by input name)
+        as an InputList. Points are most evenly spread when n is a
+        power of two. The first point is at the low end of every range
+        unless a seed is given, which applies a random digital shift.
+    """
+
+    d = len(parameters)
+    v = sobol_directions(d)
+    index = np.arange(n, dtype=np.int64)
+    points = np.zeros((n, d), dtype=np.int64)
+    for bit in range(SOBOL_BITS):
+        mask = (index >> bit) & 1
+        if not mask.any():
+            break
+        points ^= mask[:, None]*v[:, bit]
+
+    if seed is not None:
+        rng = np.random.default_rng(seed)
+        points ^= rng.integers(0, 1 << SOBOL_BITS, size=d, dtype=np.int64)
+    return design(parameters, points/float(1 << SOBOL_BITS))
+
+def primes(d):
+
+    # First d prime numbers
+    found = []
+    candidate = 2
+    while len(found) < d:
+        if all(candidate % p for p in found):
+            found.append(candidate)
+        candidate += 1
+    return found
+
+def halton(parameters, n, seed=None):
+
+    """
+        Points 1 to n of the Halton sequence over parameters (a
+        dictonary of Parameters or (low, high) ranges, by input name)
+        as an InputList, using successive primes as the base of each
+        parameter. A seed applies a random shift to each parameter.
+    """
+
+    d = len(parameters)
+    unit = np.zeros((n, d))
+    for i, base in enumerate(primes(d)):
+        index = np.arange(1, n + 1)
+        scale = 1.0
+        while index.any():
+            index, digit = np.divmod(index, base)
+            scale /= base
+            unit[:, i] += digit*scale
+
+    if seed is not None:
+        rng = np.random.default_rng(seed)
+        unit = (unit + rng.random(d)) % 1.0
+    return design(parameters, unit)
@@ -0,0 +1,623 @@
+#! /usr/bin/env python
+import time
+import heapq
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait as wait_connections
+
+from .affinity import CorePool
+
+def walltime_seconds(walltime):
+
+    """
+        Convert a walltime string of the form HH:MM:SS (as used
+        for PBS submission) to seconds. Returns None if unknown.
+    """
+
+    if walltime is None:
+        return None
+    try:
+        seconds = 0.
+        for part in str(walltime).split(":"):
+            seconds = 60.*seconds + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+def estimate_runtime(run, nprocs=None):
+
+    """
+        Best guess at how long a run will take in seconds, used to
+        order and backfill runs. Predicted from previous runs if the
+        run has a RuntimeHistory, otherwise the requested walltime.
+    """
+
+    history = getattr(run, "history", None)
+    if history is not None:
+        predicted = history.predict(run, nprocs)
+        if predicted is not None:
+            return predicted
+
+    return walltime_seconds(getattr(run, "walltime", None))
+
+def setup_needs(run):
+
+    """
+        Processors and other resources used while run is set up
+        (meshing, compiling etc), see Run.setup_requires
+    """
+
+    get_setup_needs = getattr(run, "get_setup_needs", None)
+    if get_setup_needs is None:
+        return 1, {}
+    return get_setup_needs()
+
+def get_corepool(maxproc, affinity):
+
+    """
+        CorePool to bind runs to cores if affinity is requested and
+        there are at least maxproc physical cores, otherwise None
+    """
+
+    if not affinity:
+        return None
+
+    corepool = CorePool()
+    if maxproc > len(corepool):
+        print("Only " + str(len(corepool)) + " physical cores available for "
+              + str(maxproc) + " processors, runs will not be bound to cores")
+        return None
+
+    return corepool
+
+def as_needs(nproc, resources=None):
+
+    """
+        Resource vector as a dictonary of amounts keyed by resource
+        name, with the number of processors under "cores"
+    """
+
+    if isinstance(nproc, dict):
+        return dict(nproc)
+    needs = dict(resources or {})
+    needs["cores"] = nproc
+    return needs
+
+def infer_needs(nproc, resources=None, perproc=None):
+
+    """
+        Resources for a run on nproc processors, with any the run
+        did not declare inferred from the per processor amounts
+    """
+
+    needs = as_needs(nproc, resources)
+    for k, v in (perproc or {}).items():
+        if k not in needs:
+            needs[k] = v*nproc
+    return needs
+
+def fits(needs, avail):
+
+    # Resources missing from avail are not limited
+    return all(avail[k] >= v for k, v in needs.items() if k in avail)
+
+def take(avail, needs):
+
+    for k, v in needs.items():
+        if k in avail:
+            avail[k] -= v
+
+def give(avail, needs):
+
+    for k, v in needs.items():
+        if k in avail:
+            avail[k] += v
+
+def check_needs(needs, capacity):
+
+    for k, v in needs.items():
+        if k in capacity and v > capacity[k]:
+            raise ValueError("Requested " + str(v) + " " + k + " which is"
+                             + " greater than scheduler maximum of "
+                             + str(capacity[k]))
+
+class Request:
+
+    """
+        A run waiting on the scheduler for nproc licenses and any
+        other resources (e.g. memory in MB or named tokens for 
+        software licenses), given as a dictonary of amounts
+    """
+
+    def __init__(self, ident, nproc, runtime=None, arrival=0, resources=None):
+
+        self.ident = ident
+        self.nproc = nproc
+        self.runtime = runtime
+        self.arrival = arrival
+        self.needs = as_needs(nproc, resources)
+
+    def priority(self):
+
+        # Largest first, then longest first, then first come
+        runtime = self.runtime if self.runtime is not None else float("inf")
+        return (-self.nproc, -runtime, self.arrival)
+
+class BackfillPolicy:
+
+    """
+        Choose which waiting requests to start (EASY backfilling).
+
+        Waiting requests are placed largest first. The head of the
+        queue starts as soon as it fits. If it does not fit, it is given
+        a reservation at the "shadow" time when enough running requests
+        are expected to have finished, and smaller requests are only
+        started in the meantime if they are expected to finish before
+        the shadow time, or use cores the head will not need then.
+        Requests with no runtime estimate are only ever backfilled onto
+        those spare cores, so the head is never delayed.
+
+        Other resources (memory, licenses etc) are treated like cores,
+        a request only fits when every resource it needs is free and
+        the reservation is for the time all of them will be.
+
+    """
+
+    def select(self, waiting, running, free, now):
+
+        """
+            waiting - list of Request objects
+            running - list of (needs, expected end time) tuples, where
+                      needs is a resource dictonary or number of cores
+            free    - resources currently free as a dictonary (see 
+                      as_needs) or the number of free licenses
+            now     - current time
+
+            Returns the list of requests to start now.
+        """
+
+        queue = sorted(waiting, key=lambda r: r.priority())
+        running = [(as_needs(needs), end) for needs, end in running]
+        free = as_needs(free)
+        start = []
+
+        # Start from the head while it fits
+        while queue and fits(queue[0].needs, free):
+            head = queue.pop(0)
+            start.append(head)
+            take(free, head.needs)
+            running.append((head.needs, self.endtime(head, now)))
+
+        if not queue:
+            return start
+
+        # Head does not fit, reserve for it and backfill behind it
+        head = queue.pop(0)
+        shadow, extra = self.reservation(head, running, free)
+        for req in queue:
+            if not fits(req.needs, free):
+                continue
+            end = self.endtime(req, now)
+            if end <= shadow and shadow != float("inf"):
+                pass
+            elif fits(req.needs, extra):
+                take(extra, req.needs)
+            else:
+                continue
+            start.append(req)
+            take(free, req.needs)
+
+        return start
+
+    def endtime(self, req, now):
+
+        if req.runtime is None:
+            return float("inf")
+        return now + req.runtime
+
+    def reservation(self, head, running, free):
+
+        """
+            Time at which head is expected to fit and the resources
+            left over once it starts then
+        """
+
+        avail = dict(free)
+        shadow = float("inf")
+        for needs, end in sorted(running, key=lambda r: r[1]):
+            give(avail, needs)
+            if fits(head.needs, avail):
+                shadow = end
+                break
+
+        take(avail, head.needs)
+        return shadow, avail
+
+def simulate(requests, parents, capacity, policy=None):
+
+    """
+        Expected schedule when requests (a dictonary of Request objects
+        keyed by their ident, all with runtimes) are started by policy, 
+        each once the requests in its set of parents have finished.
+        capacity is the number of licenses or dictonary of resources.
+        Returns the total duration and a dictonary of start times, 
+        requests which could never start are left out.
+    """
+
+    if policy is None:
+        policy = BackfillPolicy()
+    free = as_needs(capacity)
+
+    # Requests too big to ever start hold up everything after them
+    requests = dict((key, req) for key, req in requests.items()
+                    if fits(req.needs, free))
+    remaining = dict((key, set(parents.get(key, ()))) for key in requests)
+    waiting = [requests[key] for key in requests if not remaining[key]]
+    running = {}
+    starts = {}
+    now = 0.
+
+    while waiting or running:
+        for req in policy.select(waiting, list(running.values()), free, now):
+            waiting.remove(req)
+            take(free, req.needs)
+            running[req.ident] = (req.needs, now + req.runtime)
+            starts[req.ident] = now
+        if not running:
+            break
+
+        # Advance to the next request to finish
+        done = min(running, key=lambda key: running[key][1])
+        needs, now = running.pop(done)
+        give(free, needs)
+        for key in requests:
+            if done in remaining[key]:
+                remaining[key].remove(done)
+                if not remaining[key]:
+                    waiting.append(requests[key])
+
+    return now, starts
+
+# Returned by a task queue when nothing is ready until other tasks finish
+PENDING = "pending"
+
+class TaskQueue:
+
+    """
+        Source of runlists for pool workers, handed out in order.
+        next_task returns a (key, runlist) pair, PENDING if nothing
+        can start until another task is done, or None when there is no
+        work left. task_done is told whether each task succeeded.
+
+        A task can be requeued to resume from one of its runs after a
+        delay (see RetryPolicy), while other tasks are handed out.
+    """
+
+    def __init__(self, runlists):
+
+        self.runlists = list(runlists)
+        self.queue = deque((key, 0) for key in range(len(self.runlists)))
+        self.started = {}
+        self.delayed = []
+
+    def next_task(self):
+
+        self.queue.extend(self.due())
+        if self.queue:
+            key, index = self.queue.popleft()
+            self.started[key] = index
+            return key, self.runlists[key][index:]
+        elif self.delayed:
+            return PENDING
+        else:
+            return None
+
+    def task_done(self, key, success):
+
+        return
+
+    def requeue(self, key, index, attempts, delay):
+
+        """
+            Hand out task key again after delay seconds, starting from
+            run index of the runlist it was last given, which has 
+            already been tried attempts times
+        """
+
+        index += self.started.get(key, 0)
+        self.runlists[key][index].attempts = attempts
+        heapq.heappush(self.delayed, (time.time() + delay, key, index))
+
+    def due(self):
+
+        # Requeued tasks whose delay is over
+        ready = []
+        while self.delayed and self.delayed[0][0] <= time.time():
+            when, key, index = heapq.heappop(self.delayed)
+            ready.append((key, index))
+        return ready
+
+    def timeout(self):
+
+        # Seconds until the next requeued task is due, None if none are
+        if not self.delayed:
+            return None
+        return max(0., self.delayed[0][0] - time.time())
+
+class SchedulerClient:
+
+    """
+        Stand in for a Multiphore in a worker process, which asks the
+        Scheduler in the parent process for licenses over a pipe.
+
+        A worker may hold several grants at once from different
+        threads (e.g. a run executing while the next is set up), each
+        acquired and released with its own tag. Requests which wait
+        for a reply are made one at a time.
+    """
+
+    def __init__(self, ident, conn):
+
+        self.ident = ident
+        self.conn = conn
+        self.create_locks()
+
+    def create_locks(self):
+
+        self.sendlock = threading.Lock()
+        self.waitlock = threading.Lock()
+
+    def __getstate__(self):
+
+        # Locks are made again in the worker process
+        state = dict(self.__dict__)
+        del state["sendlock"], state["waitlock"]
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.create_locks()
+
+    def send(self, msg):
+
+        with self.sendlock:
+            self.conn.send(msg)
+
+    def acquire(self, nproc=1, blocking=True, wait=None, runtime=None,
+                resources=None, tag=None):
+
+        # Grant is True, or the list of cores to use with affinity
+        with self.waitlock:
+            self.send(("acquire", nproc, runtime, blocking, resources, tag))
+            granted = self.conn.recv()
+        if isinstance(granted, Exception):
+            raise granted
+        return granted
+
+    def release(self, nproc=1, resources=None, tag=None):
+
+        # Scheduler gives back everything granted under tag
+        self.send(("release", nproc, tag))
+
+    def next_task(self):
+
+        # Next (key, runlist) for a pool worker, None when all are done
+        with self.waitlock:
+            self.send(("ready",))
+            return self.conn.recv()
+
+    def task_done(self, key, success=True):
+
+        self.send(("done", key, success))
+
+    def requeue(self, key, index, attempts, delay):
+
+        # Hand the task back to be given out again after delay
+        self.send(("requeue", key, index, attempts, delay))
+
+class Scheduler:
+
+    """
+        Central scheduler which hands out licenses for up to maxproc
+        processors to worker processes. Workers are given a
+        SchedulerClient which they use in place of a Multiphore.
+        Requests are kept in a ready queue and started according to
+        policy (largest first with backfilling by default) as soon as
+        licenses are released, rather than whoever asks first.
+
+        Example usage from a higher level:
+
+            scheduler = Scheduler(maxproc)
+            workers = {}
+            for runlist in threadlist:
+                client = scheduler.client()
+                workers[client.ident] = Thread(client, runlist)
+
+            for worker in workers.values():
+                worker.start()
+            scheduler.serve(workers)
+
+        Other resources which runs compete for are given as a 
+        dictonary of capacities, e.g. resources={"memory": 64000,
+        "licenses": 4}. A run then starts only once its cores and
+        every resource it needs are free. Runs declare their needs
+        with run.requires(...), and anything not declared is taken
+        as perproc times the number of processors, e.g. 
+        perproc={"memory": 2000}. Resources the scheduler is not
+        given a capacity for are not limited.
+
+        If affinity is True, each grant is the list of physical cores
+        (see CorePool) the run should be bound to, so concurrent runs
+        never share a core.
+
+        When used with a pool of pool_worker processes, tasks is a 
+        TaskQueue (or a RunGraph) of runlists which are sent to workers
+        as they ask for more work.
+
+    """
+
+    def __init__(self, maxproc, policy=None, tasks=None, affinity=False,
+                 resources=None, perproc=None):
+
+        self.maxproc = maxproc
+        self.capacity = as_needs(maxproc, resources)
+        self.free = dict(self.capacity)
+        self.perproc = dict(perproc or {})
+        if policy is None:
+            self.policy = BackfillPolicy()
+        else:
+            self.policy = policy
+        self.corepool = get_corepool(maxproc, affinity)
+        self.cores = {}
+
+        # Runlists handed out to pool workers as they become idle
+        if tasks is None:
+            self.tasks = TaskQueue([])
+        else:
+            self.tasks = tasks
+        self.idle = []
+        self.assigned = {}
+
+        self.conns = {}
+        self.waiting = []
+        self.running = {}
+        self.arrivals = 0
+
+    def client(self):
+
+        """
+            Create a new connection to the scheduler for one worker
+        """
+
+        parent_conn, child_conn = multiprocessing.Pipe()
+        ident = len(self.conns)
+        self.conns[ident] = parent_conn
+        return SchedulerClient(ident, child_conn)
+
+    def serve(self, workers):
+
+        """
+            Handle requests until every worker process has exited.
+            workers is a dictonary of started processes keyed by
+            the ident of the client they were given.
+        """
+
+        alive = dict(workers)
+        while alive:
+
+            sentinels = dict((w.sentinel, ident) for ident, w in alive.items())
+            conns = dict((self.conns[ident], ident) for ident in alive)
+            ready = wait_connections(list(conns) + list(sentinels),
+                                     timeout=self.tasks.timeout())
+
+            # Handle messages before exits so final releases are seen
+            for r in ready:
+                if r in conns:
+                    self.receive(conns[r])
+            for r in ready:
+                if r in sentinels:
+                    ident = sentinels[r]
+                    self.receive(ident)
+                    self.remove(ident)
+                    del alive[ident]
+
+            self.feed()
+            self.dispatch()
+
+    def receive(self, ident):
+
+        conn = self.conns[ident]
+        try:
+            while conn.poll():
+                msg = conn.recv()
+                if msg[0] == "acquire":
+                    self.request(ident, *msg[1:])
+                elif msg[0] == "release":
+                    self.release(ident, *msg[2:])
+                elif msg[0] == "ready":
+                    self.idle.append(ident)
+                elif msg[0] == "done":
+                    del self.assigned[ident]
+                    self.tasks.task_done(msg[1], msg[2])
+                elif msg[0] == "requeue":
+                    del self.assigned[ident]
+                    self.tasks.requeue(*msg[1:])
+        except (EOFError, OSError):
+            pass
+
+    def request(self, ident, nproc, runtime=None, blocking=True, 
+                resources=None, tag=None):
+
+        conn = self.conns[ident]
+        req = Request(ident, nproc, runtime, self.arrivals)
+        req.needs = infer_needs(nproc, resources, self.perproc)
+        req.tag = tag
+        try:
+            check_needs(req.needs, self.capacity)
+        except ValueError as e:
+            conn.send(e)
+            return
+
+        self.arrivals += 1
+        if blocking:
+            self.waiting.append(req)
+        elif fits(req.needs, self.free) and not self.waiting:
+            self.start(req, time.time())
+        else:
+            conn.send(False)
+
+    def release(self, ident, tag=None):
+
+        # Give back everything held by this client under tag
+        key = (ident, tag)
+        if key in self.running:
+            give(self.free, self.running.pop(key)[0])
+        if key in self.cores:
+            self.corepool.give(self.cores.pop(key))
+
+    def remove(self, ident):
+
+        # Reclaim resources from a worker which exited holding them
+        for key in [key for key in self.running if key[0] == ident]:
+            self.release(*key)
+        self.waiting = [r for r in self.waiting if r.ident != ident]
+
+        # Task the worker was performing is lost
+        if ident in self.idle:
+            self.idle.remove(ident)
+        if ident in self.assigned:
+            self.tasks.task_done(self.assigned.pop(ident), False)
+
+    def feed(self):
+
+        # Hand tasks to idle workers, who wait while tasks are pending
+        while self.idle:
+            task = self.tasks.next_task()
+            if task is PENDING:
+                break
+            ident = self.idle.pop(0)
+            if task is not None:
+                self.assigned[ident] = task[0]
+            self.conns[ident].send(task)
+
+    def start(self, req, now):
+
+        key = (req.ident, req.tag)
+        take(self.free, req.needs)
+        self.running[key] = (req.needs, self.policy.endtime(req, now))
+        if self.corepool is not None:
+            self.cores[key] = self.corepool.take(req.nproc)
+            self.conns[req.ident].send(self.cores[key])
+        else:
+            self.conns[req.ident].send(True)
+
+    def dispatch(self):
+
+        now = time.time()
+        selected = self.policy.select(self.waiting, list(self.running.values()),
+                                      self.free, now)
+        for req in selected:
+            self.waiting.remove(req)
+            self.start(req, now)
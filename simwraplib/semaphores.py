@@ -1,66 +1,123 @@
 #! /usr/bin/env python2.7
-from multiprocessing import BoundedSemaphore
-import time 
+from multiprocessing import Condition, RawValue, RawArray
 
 class DummySemaphore:
-    
-    def acquire(self, nprocs):
-        return 
-    
-    def release(self, nprocs):
+
+    def acquire(self, nprocs=1, blocking=True, wait=None, runtime=None,
+                resources=None, tag=None):
+        return True
+
+    def release(self, nprocs, resources=None, tag=None):
         return
 
 class Multiphore():
 
-    """ 
+    """
         Generalisation of the Semaphore to ensure threads calling multiple cpus
-        subproccesses only run when they can acquire all required licenses for 
+        subproccesses only run when they can acquire all required licenses for
         number of cpus. Corresponding multiple release also provided.
 
+        All licenses for a request are taken in one atomic step under a
+        shared condition variable, so waiting threads are woken as soon as
+        enough licenses are released instead of sleeping and retrying.
+        Requests are served in the order they arrive (each caller takes a
+        ticket) so a large run cannot be starved by a stream of smaller ones.
+
+        Other resources can be limited alongside cpus by giving their
+        capacities as a dictonary, e.g. resources={"memory": 64000} for 
+        memory in MB or {"licenses": 4} for software licenses. A request
+        then only succeeds once every resource it asks for is free.
+        Resources without a capacity here are not limited.
+
     """
 
-    def __init__(self,maxprocs):
+    def __init__(self,maxprocs,resources=None):
 
         self.maxprocs = maxprocs
-        self.sema = BoundedSemaphore(maxprocs)
-
-    def acquire(self,nproc=1,blocking=True,wait=5.0):
+        self.cond = Condition()
+        self.free = RawValue('i', maxprocs)
+        self.names = sorted(resources or {})
+        self.capacity = [float(resources[k]) for k in self.names]
+        self.freeres = RawArray('d', self.capacity)
+        self.next_ticket = RawValue('i', 0)
+        self.serving = RawValue('i', 0)
+
+    def acquire(self,nproc=1,blocking=True,wait=None,runtime=None,
+                resources=None,tag=None):
+
+        """
+            Take nproc licenses and any other resources (a dictonary of
+            amounts), waiting until they are all free if blocking. 
+            Returns True if they were acquired and False if 
+            non-blocking and they are not available. The wait
+            argument is kept for backward compatibility and is unused,
+            as are the runtime estimate (see Scheduler for ordering
+            by size and runtime) and tag, as every acquire is separate.
+        """
 
         #Check requested processes not greater than maximum
         if nproc > self.maxprocs:
             raise ValueError("Requested acquire greater than semaphore maximum")
+        amounts = self.amounts(resources)
+        for name, n, cap in zip(self.names, amounts, self.capacity):
+            if n > cap:
+                raise ValueError("Requested " + str(n) + " " + name 
+                                 + " greater than semaphore maximum")
 
-        #Priority for larger runs
-        time.sleep(wait/nproc) 
+        with self.cond:
 
-        #Keep looping until all cpus have a license
-        acquired = [False for n in range(0,nproc)]
-        while False in acquired:
+            #Non-blocking only succeeds if nobody is queued ahead of us
+            if blocking == False:
+                if (self.serving.value == self.next_ticket.value and
+                    self.available(nproc, amounts)):
+                    self.take(nproc, amounts)
+                    return True
+                return False
 
-            # Attempt to get all licenses from semaphore      
-            for n in range(0,len(acquired)):
-                avail = self.sema.acquire(False)
-                acquired[n] = avail
-                #print(nproc,acquired,False in acquired)
+            #Take a ticket and sleep until it is our turn and all
+            #resources are available, then take them all at once
+            ticket = self.next_ticket.value
+            self.next_ticket.value += 1
+            while (self.serving.value != ticket or 
+                   not self.available(nproc, amounts)):
+                self.cond.wait()
+            self.take(nproc, amounts)
+            self.serving.value += 1
 
-            if blocking == False:
-                return acquired
+            #Next in line may already fit in what remains
+            self.cond.notify_all()
+
+        return True
+
+    def release(self,nproc=1,resources=None,tag=None):
+
+        # Return all licenses and wake anyone waiting on them
+        amounts = self.amounts(resources)
+        with self.cond:
+            if self.free.value + nproc > self.maxprocs:
+                raise ValueError("Multiphore released too many times")
+            self.free.value += nproc
+            for i, n in enumerate(amounts):
+                self.freeres[i] += n
+            self.cond.notify_all()
+
+    def amounts(self, resources):
+
+        # Requested amount of each limited resource, in order of names
+        resources = resources or {}
+        return [float(resources.get(k, 0)) for k in self.names]
 
-            #If all licenses not available, release all acquired and wait
-            if False in acquired:
-                for n in acquired:
-                    if n == True:
-                        self.sema.release()
-                acquired = [False for n in range(0,nproc)]
-                time.sleep(wait)
+    def available(self, nproc, amounts):
 
+        return (self.free.value >= nproc and
+                all(self.freeres[i] >= n for i, n in enumerate(amounts)))
 
-    def release(self,nproc=1):
+    def take(self, nproc, amounts):
 
-        # Release all licenses from semaphore
-        for n in range(0,nproc): 
-            self.sema.release()
+        self.free.value -= nproc
+        for i, n in enumerate(amounts):
+            self.freeres[i] -= n
 
     def get_value(self):
 
-        return self.sema.get_value()
+        return self.free.value
@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+import os
+import json
+import fnmatch
+import hashlib
+import tarfile
+import tempfile
+
+from simwraplib.cache import hash_file
+
+# Build products and version control files left out of snapshots
+EXCLUDE = [".git", ".svn", ".hg", "__pycache__", "*.o", "*.mod", "*.a",
+           "*.so", "*.pyc", "*.exe", "*.tar", "*.tar.gz", "*.bak", "core"]
+
+def default_snapshot_dir():
+
+    return os.path.join(os.path.expanduser("~"), ".simwraplib", "sources")
+
+def archive_source(srcdir, filename, include=None):
+
+    """
+        Tar of the source code in srcdir (only files with names
+        matching include if given) written to filename, as kept in
+        each run directory when runs are not given a SourceSnapshot
+    """
+
+    with tarfile.open(filename, "w") as tar:
+        for root, dirs, names in os.walk(srcdir):
+            dirs.sort()
+            for name in sorted(names):
+                if include and not any(fnmatch.fnmatch(name, p) for p in include):
+                    continue
+                path = os.path.join(root, name)
+                tar.add(path, arcname=os.path.relpath(path, srcdir), 
+                        recursive=False)
+
+class SourceSnapshot:
+
+    """
+        Compressed snapshots of source code directories, one per
+        distinct state of the source, named by a sha256 hash of the
+        path and contents of every file in it. A snapshot is written
+        once, the first time a run is set up from that source, and
+        shared by every later run and study while the source does not
+        change. Each run directory only gets a small src.snapshot file
+        recording the source directory, hash and snapshot used.
+
+        Files and folders matching the patterns in exclude (default
+        EXCLUDE, e.g. object files and version control) are left out.
+
+        Example usage from a higher level:
+
+            sources = SourceSnapshot("/scratch/me/sources")
+            study = Study(threadlist, maxproc, sources=sources)
+
+    """
+
+    def __init__(self, snapshotdir=None, exclude=None):
+
+        if snapshotdir is None:
+            snapshotdir = default_snapshot_dir()
+        self.snapshotdir = os.path.abspath(snapshotdir)
+        if exclude is None:
+            exclude = EXCLUDE
+        self.exclude = exclude
+
+    def excluded(self, name):
+
+        return any(fnmatch.fnmatch(name, p) for p in self.exclude)
+
+    def files(self, srcdir, include=None):
+
+        """
+            Sorted paths relative to srcdir of the files to snapshot,
+            only those with names matching include if given
+        """
+
+        files = []
+        for root, dirs, names in os.walk(srcdir):
+            dirs[:] = sorted(d for d in dirs if not self.excluded(d))
+            for name in sorted(names):
+                if self.excluded(name):
+                    continue
+                if include and not any(fnmatch.fnmatch(name, p) for p in include):
+                    continue
+                files.append(os.path.relpath(os.path.join(root, name), srcdir))
+        return files
+
+    def take(self, srcdir, include=None):
+
+        """
+            Snapshot of srcdir, written if there is none for its
+            current contents yet. Returns the archive and its hash.
+        """
+
+        files = self.files(srcdir, include)
+        h = hashlib.sha256()
+        for relpath in files:
+            h.update(relpath.encode())
+            h.update(hash_file(os.path.join(srcdir, relpath)).encode())
+        digest = h.hexdigest()
+
+        archive = os.path.join(self.snapshotdir, digest + ".tar.gz")
+        if os.path.isfile(archive):
+            return archive, digest
+
+        # Written under a temporary name and moved into place in one
+        # step so a snapshot is never seen half written
+        if not os.path.isdir(self.snapshotdir):
+            os.makedirs(self.snapshotdir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.snapshotdir, prefix=".tmp")
+        os.close(fd)
+        try:
+            with tarfile.open(tmp, "w:gz") as tar:
+                for relpath in files:
+                    tar.add(os.path.join(srcdir, relpath), arcname=relpath)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, archive)
+        except:
+            os.remove(tmp)
+            raise
+
+        return archive, digest
+
+    def record(self, run, include=None):
+
+        # Snapshot the source of run and note which in its run directory
+        archive, digest = self.take(run.srcdir, include)
+        with open(run.rundir + "src.snapshot", "w") as f:
+            json.dump({"srcdir": os.path.abspath(run.srcdir), "hash": digest,
+                       "snapshot": archive}, f, indent=4)
+        return digest
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .journal import journal_done
+
+def inside(path, folder):
+
+    path, folder = os.path.abspath(path), os.path.abspath(folder)
+    return os.path.commonpath([path, folder]) == folder
+
+def input_paths(run):
+
+    # Folders and files setting up run reads from, including each
+    # copied base file (e.g. a restart file written by an earlier run)
+    paths = [getattr(run, "basedir", None), getattr(run, "srcdir", None)]
+    basedir = getattr(run, "basedir", None)
+    if basedir:
+        for f in getattr(run, "copyfiles", []):
+            if isinstance(f, str):
+                paths.append(basedir + f)
+        if getattr(run, "startfile", None):
+            paths.append(basedir + run.startfile)
+    return [path for path in paths if path]
+
+def independent(run, earlier):
+
+    """
+        True if run can be set up before the runs in earlier have
+        finished: it does not depend on them, nor take its base files,
+        start file or source from their run directories or share one
+        with them.
+    """
+
+    dependencies = getattr(run, "dependencies", [])
+    paths = input_paths(run)
+    for other in earlier:
+        if other is run or other in dependencies:
+            return False
+        if inside(run.rundir, other.rundir) or inside(other.rundir, run.rundir):
+            return False
+        for path in paths:
+            if inside(path, other.rundir):
+                return False
+    return True
+
+class SetupStage:
+
+    """
+        Bounded pool of threads which set up the next runs in a
+        runlist while the current one executes, so processors are not
+        left idle while files are copied, meshes generated or code
+        compiled. Up to ahead runs are prepared at once, by calling
+        setup on each. Runs which are not independent of those before
+        them (e.g. restarting from an earlier run directory) are set
+        up in turn as before.
+
+        Example usage from a higher level:
+
+            study = Study(threadlist, maxproc, setup_ahead=2)
+
+    """
+
+    def __init__(self, setup, ahead=1):
+
+        self.setup = setup
+        self.ahead = ahead
+        self.executor = ThreadPoolExecutor(max_workers=ahead)
+        self.futures = {}
+
+    def prepare(self, runlist, index):
+
+        # Start setting up the runs after index, stopping at the
+        # first which has to wait for the ones before it
+        for later in runlist[index+1:index+1+self.ahead]:
+            if id(later) in self.futures:
+                continue
+            if (getattr(later, "setup_done", False) or journal_done(later)
+                or not independent(later, runlist[:runlist.index(later)])):
+                break
+            self.futures[id(later)] = self.executor.submit(self.setup, later)
+
+    def result(self, run):
+
+        """
+            Wait for run to be set up and return what setup returned,
+            setting it up now if it was not started early
+        """
+
+        future = self.futures.pop(id(run), None)
+        if future is None:
+            return self.setup(run)
+        return future.result()
+
+    def close(self):
+
+        # Setups not yet started are dropped, those in progress finish
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.futures = {}
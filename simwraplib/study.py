@@ -1,13 +1,32 @@
+import os
+import asyncio
+import datetime
 import multiprocessing
 import subprocess as sp
 
 from .platform import get_platform
-from .thread import Thread
-from .semaphores import DummySemaphore, Multiphore
+from .thread import Thread, pool_worker
+from .semaphores import DummySemaphore
+from .scheduler import (Scheduler, TaskQueue, Request, walltime_seconds,
+                        infer_needs, simulate)
+from .graph import RunGraph, as_runlists, unique_runs
+from .history import RuntimeHistory
+from .journal import StudyJournal, run_id
+from .cache import ResultCache
+from .meshcache import MeshCache
+from .environment import Environment
+from .population import Population
+from .source import SourceSnapshot
+from .asyncengine import AsyncEngine
 
 class Study:
 
-    def __init__(self, threadlist, maxproc=None, studyfolder=None):
+    def __init__(self, threadlist, maxproc=None, studyfolder=None,
+                 pool=None, start_method=None, dag=False,
+                 engine="process", affinity=False, resources=None,
+                 perproc=None, history=None, retry=None, journal=None,
+                 cache=None, populate=None, sources=None, setup_ahead=0,
+                 meshcache=None, environment=None, autorun=True):
 
         """
             A single study of multiple MDThreads, each carrying
@@ -20,41 +39,225 @@ class Study:
                              series of Run objects to be executed 
                              sequentially
                 
-                maxproc - maximum number of licenses the semaphore may
-                          release at once. 
+                maxproc - maximum number of licenses the scheduler may
+                          hand out at once. Runs waiting for licenses are
+                          started largest first, with smaller runs
+                          backfilled onto idle cores when this will
+                          not delay the largest (see BackfillPolicy).
 
                 studyfolder - Group all runs into a study folder wih 
                               all copied src and executable setup files 
                               in run.setup checked and if the same,
                               copied only once for the study. 
 
+                pool - if True, runlists are performed by a fixed pool 
+                       of maxproc long lived worker processes which take
+                       runlists from a queue, rather than one process per
+                       runlist. An integer gives the pool size directly.
+
+                start_method - multiprocessing start method used for 
+                               pool workers ('fork', 'forkserver' or 
+                               'spawn'), default for the platform if None.
+                               With 'spawn' and 'forkserver' the calling 
+                               script must be protected by 
+                               if __name__ == "__main__":
+
+                dag - if True, runs are performed as a dependency graph 
+                      (see RunGraph) by a pool of workers. Each run
+                      waits only for the run before it in its runlist 
+                      and runs given to run.depends_on, a run object
+                      shared between runlists is performed once and a
+                      failure only skips the runs downstream of it.
+
+                engine - "process" performs runs from worker processes,
+                         "asyncio" performs them all from one asyncio 
+                         event loop (see AsyncEngine), with each 
+                         executable an asyncio subprocess.
+
+                affinity - if True, each local run is bound to its own
+                           set of physical cores, kept within one NUMA
+                           node where possible (see CorePool), so
+                           concurrent runs do not share or migrate 
+                           between cores. Needs at least maxproc
+                           physical cores.
+
+                resources - capacities of resources other than 
+                            processors which local runs compete for,
+                            e.g. {"memory": 64000, "licenses": 4} with
+                            memory in MB. A run only starts once all 
+                            the resources it needs are free.
+
+                perproc - amount of each resource a run needs per 
+                          processor if it does not declare it with
+                          run.requires(...), e.g. {"memory": 2000}.
+
+                history - RuntimeHistory (or the name of its file, or
+                          True for the default file) in which the wall
+                          time of every local run is recorded. Runtimes
+                          predicted from it are used to start the 
+                          longest runs first and to backfill, and
+                          a dryrun prints the expected duration of
+                          the study (see expected_duration).
+
+                retry - RetryPolicy for runs which have not been given
+                        their own with run.retry_with(...). Runs which 
+                        fail with a transient error are tried again
+                        after a backoff, without holding licenses while
+                        waiting, and pool workers requeue them and 
+                        carry on with other runs in the meantime.
+
+                journal - StudyJournal (or the name of its file, or True
+                          for study_journal.db in the folder containing
+                          the run directories, i.e. the studyfolder) 
+                          which records the state of every run. If the 
+                          study is launched again, runs already done 
+                          are skipped and any left part way through or 
+                          failed are cleaned up and performed again.
+
+                cache - ResultCache (or the name of its folder) of the
+                        results of finished runs. A run identical to 
+                        one in the cache (same executable, base files 
+                        and modified input) has the cached results 
+                        linked into its run directory instead of
+                        being performed again.
+
+                populate - "hardlink", "reflink" or "symlink" to store
+                           each unique base file (executable, start
+                           files, support folders) once for the study
+                           in .basefiles in the folder containing the
+                           run directories, and link it into every run
+                           directory, or a Population. Input files
+                           changed by prepare_inputs are still copied.
+
+                sources - SourceSnapshot (or the name of its folder,
+                          or True for ~/.simwraplib/sources) where each
+                          distinct state of the runs' source code is
+                          archived once. Run directories then only
+                          record the hash of the snapshot used, rather
+                          than holding their own src.tar.
+
+                setup_ahead - number of later runs in each runlist to
+                              set up (copies, meshing, compiling) while
+                              the current run executes, see SetupStage.
+                              Runs which restart from an earlier run's 
+                              directory are still set up in turn. To
+                              overlap setup between runlists in a pool,
+                              give a pool larger than maxproc.
+
+                meshcache - MeshCache (or the name of its folder) of 
+                            OpenFOAM meshes. Runs whose blockMeshDict 
+                            and decomposeParDict match one meshed 
+                            before get its mesh and decomposition 
+                            linked in instead of meshing again.
+
+                environment - Environment (or the name of a setup 
+                              script, e.g. OpenFOAM's etc/bashrc) 
+                              captured once for the study and passed to
+                              every subprocess of runs not given their
+                              own with run.use_environment(...).
+
+                autorun - if True, the study is run (and blocks until
+                          finished) from the constructor. Otherwise call
+                          run(), or with the asyncio engine, start() to
+                          get futures without blocking or 
+                          await run_async() from a running event loop.
+
         """
 
         self.threadlist = threadlist
         self.maxproc = maxproc
+        self.start_method = start_method
+        self.dag = dag
+        self.engine = engine
+        self.affinity = affinity
+        self.resources = resources
+        self.perproc = perproc
+        self.setup_ahead = setup_ahead
+        if history is True:
+            history = RuntimeHistory()
+        elif isinstance(history, str):
+            history = RuntimeHistory(history)
+        self.history = history
+        if isinstance(cache, str):
+            cache = ResultCache(cache)
+        self.cache = cache
+        if sources is True:
+            sources = SourceSnapshot()
+        elif isinstance(sources, str):
+            sources = SourceSnapshot(sources)
+        self.sources = sources
+        if isinstance(meshcache, str):
+            meshcache = MeshCache(meshcache)
+        self.meshcache = meshcache
+        # Captured here, once, so forked workers inherit it
+        if isinstance(environment, str):
+            environment = Environment(environment)
+        if environment is not None:
+            environment.env()
+        self.environment = environment
+        if dag and not pool:
+            pool = True
+        self.pool = pool
         #Get platform and check if different from specified in run objects
         self.platform = get_platform()
         first_run = True
-        for thread in threadlist:
-            for run in thread:
-                if (self.platform != run.platform):
-                    print(("Platform inconsistent in run", run.platform, self.platform))
-                self.platform = run.platform
-                if studyfolder is not None:
-                    topdir = run.rundir.split("/")[-1]
-                    if topdir is "":
-                        topdir = run.rundir.split("/")[-2]
-                        run.rundir= (  "/".join(run.rundir.split("/")[:-2]) 
-                                     + "/" + studyfolder + "/" + topdir + "/")
-                    else:
-                        run.rundir= (  "/".join(run.rundir.split("/")[:-1])
-                                     + "/" + studyfolder + "/" + topdir + "/")
-                    if not first_run:
-                        run.minimalcopy = True
-                    else:
-                        first_run = False
-
-        #Get semaphore is possible, otherwise use dummy routine
+        for run in unique_runs(threadlist):
+            if (self.platform != run.platform):
+                print(("Platform inconsistent in run", run.platform, self.platform))
+            self.platform = run.platform
+            if history is not None:
+                run.history = history
+            if retry is not None and getattr(run, "retry", None) is None:
+                run.retry = retry
+            if cache is not None:
+                run.cache = cache
+            if sources is not None:
+                run.sources = sources
+            if meshcache is not None:
+                run.meshcache = meshcache
+            if (environment is not None 
+                and getattr(run, "environment", None) is None):
+                run.use_environment(environment)
+            if studyfolder is not None:
+                topdir = run.rundir.split("/")[-1]
+                if topdir is "":
+                    topdir = run.rundir.split("/")[-2]
+                    run.rundir= (  "/".join(run.rundir.split("/")[:-2]) 
+                                 + "/" + studyfolder + "/" + topdir + "/")
+                else:
+                    run.rundir= (  "/".join(run.rundir.split("/")[:-1])
+                                 + "/" + studyfolder + "/" + topdir + "/")
+                if not first_run:
+                    run.minimalcopy = True
+                else:
+                    first_run = False
+
+        # Share one copy of each base file between the run directories
+        if isinstance(populate, str):
+            populate = Population(os.path.join(self.common_folder(), ".basefiles"),
+                                  mode=populate)
+        self.populate = populate
+        if populate is not None:
+            for run in unique_runs(threadlist):
+                run.populate_with(populate)
+
+        # Parse each base input once here, so runs set up in this
+        # process or in workers forked from it render their inputs
+        # without reading the base input again
+        for run in unique_runs(threadlist):
+            if getattr(run, "input_template", None) is not None:
+                run.input_template()
+
+        # Pick up from an earlier launch of the same study
+        if journal is True:
+            journal = os.path.join(self.common_folder(), "study_journal.db")
+        if isinstance(journal, str):
+            journal = StudyJournal(journal)
+        self.journal = journal
+        if journal is not None:
+            threadlist = self.threadlist = self.resume()
+
+        #Get scheduler if possible, otherwise use dummy semaphore
         if (get_platform() == 'local'):
 
             # Get number of cpus on computer if not specified
@@ -62,33 +265,238 @@ class Study:
                 print(("Maximum number concurrent processors not specified, " +
                       "attempting to use total number of CPUs..."))
                 try:
-                    ncpus = multiprocessing.cpu_count()
+                    maxproc = multiprocessing.cpu_count()
                 except NotImplementedError:
                     raise
+                self.maxproc = maxproc
+
+            self.scheduler = Scheduler(maxproc, affinity=affinity,
+                                       resources=resources, perproc=perproc)
+
+        elif engine == "asyncio":
 
-            self.semaphore = Multiphore(maxproc)
+            # Job submission is not limited by local processors
+            self.maxproc = maxproc = float("inf")
+
+        elif pool:
+
+            # Pool workers still need the scheduler to hand out runlists
+            self.scheduler = Scheduler(float("inf"))
 
         else:
 
             print('Semaphore not available, creating dummy instead.')
+            self.scheduler = None
             self.semaphore = DummySemaphore()
 
         self.threads = []
-        for runlist in threadlist:
-            thread = Thread(self.semaphore, runlist)
-            self.threads.append(thread)
-            #thread.start()
+        if engine == "asyncio":
+            self.scheduler = None
+            self.asyncengine = AsyncEngine(threadlist, maxproc, dag=dag,
+                                           affinity=affinity,
+                                           resources=resources,
+                                           perproc=perproc)
+        elif pool:
+            self.create_pool()
+        else:
+            for runlist in threadlist:
+                if self.scheduler is not None:
+                    thread = Thread(self.scheduler.client(), runlist,
+                                    ahead=setup_ahead)
+                else:
+                    thread = Thread(self.semaphore, runlist, ahead=setup_ahead)
+                self.threads.append(thread)
+                #thread.start()
 
         #The jobs should not be run in the constructor surely?!
-        self.run()
+        if autorun:
+            self.run()
 
         #for thread in self.threads:
         #    thread.join()
 
+    def create_pool(self):
+
+        # Pool size is the slot count unless given explicitly
+        if self.pool is True:
+            if self.maxproc is None:
+                poolsize = multiprocessing.cpu_count()
+            else:
+                poolsize = self.maxproc
+        else:
+            poolsize = int(self.pool)
+        if self.dag:
+            self.graph = RunGraph(self.threadlist)
+            self.scheduler.tasks = self.graph
+            ntasks = len(self.graph.runs)
+        else:
+            self.scheduler.tasks = TaskQueue(self.threadlist)
+            ntasks = len(self.threadlist)
+        poolsize = max(1, min(poolsize, ntasks))
+
+        context = multiprocessing.get_context(self.start_method)
+        for n in range(poolsize):
+            client = self.scheduler.client()
+            worker = context.Process(target=pool_worker,
+                                     args=(client, self.setup_ahead))
+            worker.semaphore = client
+            self.threads.append(worker)
+
+    def start(self):
+
+        """
+            Start all runs on the asyncio engine without blocking and
+            return a list of futures, one per runlist (or per run with
+            dag=True), which complete when each has finished or hold 
+            the exception if it failed.
+        """
+
+        if self.engine != "asyncio":
+            raise NotImplementedError("start() requires engine='asyncio'")
+
+        return self.asyncengine.start()
+
+    async def run_async(self):
+
+        """
+            Coroutine which performs all runs on the asyncio engine and
+            returns the result (or exception) of each once finished
+        """
+
+        if self.engine != "asyncio":
+            raise NotImplementedError("run_async() requires engine='asyncio'")
+
+        results = await self.asyncengine.run()
+        for result in results:
+            if isinstance(result, BaseException):
+                print("Study run failed: " + repr(result))
+
+        return results
+
+    def common_folder(self):
+
+        # Deepest folder containing every run directory
+        rundirs = [os.path.dirname(os.path.abspath(run.rundir.rstrip(os.sep)))
+                   for run in unique_runs(self.threadlist)]
+        return os.path.commonpath(rundirs)
+
+    def resume(self):
+
+        """
+            Add every run to the journal, clean up runs left part way
+            through by an earlier launch and return the threadlist 
+            without runlists which were already performed in full.
+        """
+
+        runs = unique_runs(self.threadlist)
+        self.journal.add(runs)
+        states = self.journal.states()
+        for run in runs:
+            run.journal = self.journal
+            if states[run_id(run)] in ("setup", "running", "failed"):
+                print("Cleaning up " + run.rundir + " which was left " 
+                      + states[run_id(run)] + " by an earlier launch")
+                self.journal.clean_up(run)
+
+        done = [run for run in runs if states[run_id(run)] == "done"]
+        if done:
+            print("Resuming study, " + str(len(done)) + " of " + str(len(runs))
+                  + " runs already done will be skipped")
+
+        return [runlist for runlist in as_runlists(self.threadlist)
+                if not all(states[run_id(run)] == "done" for run in runlist)]
+
+    def expected_duration(self, maxproc=None):
+
+        """
+            Expected wall time in seconds to perform every run on 
+            maxproc processors (the study's own maxproc if None), 
+            simulating the scheduler with runtimes predicted from the 
+            history, or the requested walltime where there is none. 
+            Also prints the estimate.
+        """
+
+        if maxproc is None:
+            maxproc = self.maxproc
+        if maxproc is None:
+            maxproc = multiprocessing.cpu_count()
+
+        # Each run waits for the run before it in its runlist, and
+        # with dag also for its dependencies (each shared run once)
+        if self.dag:
+            graph = RunGraph(self.threadlist)
+            tasks = [(key, run) for key, run in enumerate(graph.runs)]
+            parents = graph.parents
+        else:
+            tasks = []
+            parents = {}
+            for i, runlist in enumerate(as_runlists(self.threadlist)):
+                for j, run in enumerate(runlist):
+                    tasks.append(((i, j), run))
+                    if j > 0:
+                        parents[(i, j)] = set([(i, j-1)])
+
+        requests = {}
+        unknown = 0
+        for arrival, (key, run) in enumerate(tasks):
+            nprocs = self.guess_nprocs(run)
+            runtime = None
+            if self.history is not None:
+                runtime = self.history.predict(run, nprocs)
+            if runtime is None:
+                runtime = walltime_seconds(getattr(run, "walltime", None)) or 0.
+                unknown += 1
+            req = Request(key, nprocs, runtime, arrival)
+            req.needs = infer_needs(nprocs, run.get_resources(), self.perproc)
+            requests[key] = req
+
+        capacity = infer_needs(maxproc, self.resources)
+        duration, starts = simulate(requests, parents, capacity)
+
+        print("Expected duration of study on " + str(maxproc) + " processors: "
+              + str(datetime.timedelta(seconds=int(duration)))
+              + " (" + str(len(starts)) + " of " + str(len(requests))
+              + " runs, " + str(unknown) + " with no history so taken"
+              + " as their requested walltime)")
+
+        return duration
+
+    def guess_nprocs(self, run):
+
+        # Runs read nprocs from their input files, which may not 
+        # have been set up yet, so fall back on the last run there
+        try:
+            return run.get_nprocs()
+        except Exception:
+            nprocs = None
+            if self.history is not None:
+                nprocs = self.history.last_nprocs(run)
+            if nprocs is None:
+                nprocs = 1
+            return nprocs
+
     def run(self):
 
+        if self.history is not None and all(run.dryrun for run in
+                                            unique_runs(self.threadlist)):
+            self.expected_duration()
+
+        if self.engine == "asyncio":
+            return asyncio.run(self.run_async())
+
         for thread in self.threads:
             thread.start()
 
+        # Hand out licenses until every thread has finished
+        if self.scheduler is not None:
+            workers = dict((thread.semaphore.ident, thread) 
+                           for thread in self.threads)
+            self.scheduler.serve(workers)
+
         for thread in self.threads:
             thread.join()
+
+        if self.dag:
+            print("Study finished, runs by state: " + str(self.graph.summary()))
+        if self.journal is not None:
+            print("Study journal, runs by state: " + str(self.journal.summary()))
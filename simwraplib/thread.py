@@ -1,6 +1,17 @@
 #! /usr/bin/env python
 from .mdrun import MDRun
+from .scheduler import estimate_runtime, setup_needs
+from .history import record_runtime
+from .retry import retry_delay
+from .journal import journal_state, journal_done
+from .cache import reuse_result, save_result
+from .staging import SetupStage
+from .semaphores import DummySemaphore
 import multiprocessing
+import functools
+import time
+import traceback
+import sys
 
 class Thread(multiprocessing.Process):
 
@@ -11,10 +22,14 @@ class Thread(multiprocessing.Process):
         Constructor arguments:
         
             semaphore - semaphore object from which MDThread will
-                        request a license during execution in run()
+                        request a license during execution in run(),
+                        either a Multiphore or a SchedulerClient
             
             runlist - list of MDRun objects to be executed sequentially
 
+            ahead - number of later runs in runlist to set up while
+                    the current one executes (see SetupStage)
+
         Example usage from a higher level:
 
             semaphore = multiprocessing.Semaphore(maxlicenses)
@@ -31,30 +46,169 @@ class Thread(multiprocessing.Process):
     """
 
 
-    def __init__(self, semaphore, runlist):
+    def __init__(self, semaphore, runlist, ahead=0):
 
         multiprocessing.Process.__init__(self)
         self.semaphore = semaphore
         self.runlist = runlist
+        self.ahead = ahead
 
     def run(self):
 
-        # Perform runs per thread sequetially
-        for run in self.runlist:
+        try:
+            perform_runlist(self.semaphore, self.runlist, ahead=self.ahead)
+        except Exception:
+            # Report the failure and exit, licenses are already released
+            traceback.print_exc()
+            sys.exit(1)
 
-            #Setup run
-            run.setup()
+        return
 
-            # Check number of processors required for this run
-            # and wait until all are avialable using Multiphore  
-            runprocs = run.get_nprocs()
-            self.semaphore.acquire(runprocs)
+class Requeue(Exception):
 
-            # Execute and finish the run once license acquired
-            run.execute(blocking=True)
-            run.finish()
+    """
+        Raised by perform_runlist in a pool worker when a run should be
+        tried again later. The runlist from index onwards is handed back
+        to the Scheduler to requeue after delay seconds.
+    """
 
-            # Release all licenses from Multiphore
-            self.semaphore.release(runprocs)
+    def __init__(self, index, attempts, delay):
+
+        Exception.__init__(self, "Requeue run " + str(index) + " in "
+                           + str(delay) + " seconds")
+        self.index = index
+        self.attempts = attempts
+        self.delay = delay
+
+def perform_runlist(semaphore, runlist, requeue=False, ahead=0):
+
+    # Later runs are set up while earlier ones execute if ahead > 0
+    stage = None
+    if ahead > 0:
+        stage = SetupStage(functools.partial(setup_run, semaphore=semaphore),
+                           ahead)
+
+    # Perform runs per thread sequetially
+    try:
+        for index, run in enumerate(runlist):
+
+            # Skip runs finished before the study was restarted
+            if journal_done(run):
+                continue
+
+            if stage is not None:
+                stage.prepare(runlist, index)
+
+            # Retry transient failures according to the run's retry policy
+            while True:
+                try:
+                    attempt_run(semaphore, run, stage)
+                    break
+                except Exception as e:
+                    delay = retry_delay(run, e)
+                    if delay is None:
+                        if index < len(runlist) - 1:
+                            print("Run in " + run.rundir + " failed, " 
+                                  + str(len(runlist) - index - 1) + " later runs"
+                                  + " in its runlist will not be performed")
+                        raise
+                    if requeue:
+                        raise Requeue(index, run.attempts, delay)
+                    time.sleep(delay)
+    finally:
+        if stage is not None:
+            stage.close()
+
+def setup_run(run, semaphore=None):
 
-        return
+    """
+        Setup run, holding the processors and resources its setup 
+        needs from semaphore, and return True if the results of an 
+        identical run which finished before were reused instead
+    """
+
+    setupprocs, resources = setup_needs(run)
+    if semaphore is None or (setupprocs == 0 and not resources):
+        semaphore = DummySemaphore()
+
+    # Tagged so it is held separately from another run executing
+    tag = ("setup", id(run))
+    semaphore.acquire(setupprocs, resources=resources, tag=tag)
+    try:
+        journal_state(run, "setup")
+        run.setup()
+        run.setup_done = True
+        return reuse_result(run)
+    except Exception as e:
+        journal_state(run, "failed", getattr(e, "returncode", None))
+        raise
+    finally:
+        semaphore.release(setupprocs, resources=resources, tag=tag)
+
+def attempt_run(semaphore, run, stage=None):
+
+    #Setup run (or wait for stage to), unless it is being retried 
+    #after it was set up. A run handed back to a pool is a copy which
+    #was never set up, as is anything setup built, so is set up again
+    if not getattr(run, "setup_done", False):
+        if stage is None:
+            reused = setup_run(run, semaphore)
+        else:
+            reused = stage.result(run)
+        if reused:
+            journal_state(run, "done", 0)
+            return
+
+    # Check number of processors and other resources required for 
+    # this run and wait until all are avialable using Multiphore  
+    runprocs = run.get_nprocs()
+    resources = run.get_resources()
+    runtime = estimate_runtime(run, runprocs)
+    grant = semaphore.acquire(runprocs, runtime=runtime, resources=resources)
+
+    # Scheduler may hand out specific cores to bind the run to
+    if isinstance(grant, list):
+        run.cores = grant
+
+    try:
+        # Execute and finish the run once license acquired
+        journal_state(run, "running")
+        start = time.time()
+        run.execute(blocking=True)
+        record_runtime(run, time.time() - start, runprocs)
+        run.finish()
+        save_result(run)
+        journal_state(run, "done", 0)
+    except Exception as e:
+        journal_state(run, "failed", getattr(e, "returncode", None))
+        raise
+    finally:
+        # Release all licenses from Multiphore, even on failure
+        semaphore.release(runprocs, resources=resources)
+
+def pool_worker(client, ahead=0):
+
+    """
+        Target of a long lived worker process in a Study pool, which
+        asks the Scheduler for runlists through its SchedulerClient and
+        performs them in turn until there are none left.
+    """
+
+    while True:
+        task = client.next_task()
+        if task is None:
+            break
+
+        # A failed runlist is reported rather than ending the worker,
+        # and runs to retry are handed back so others can go first
+        key, runlist = task
+        try:
+            perform_runlist(client, runlist, requeue=True, ahead=ahead)
+            success = True
+        except Requeue as r:
+            client.requeue(key, r.index, r.attempts, r.delay)
+            continue
+        except Exception:
+            traceback.print_exc()
+            success = False
+        client.task_done(key, success)